@@ -12,20 +12,21 @@ from rich.live import Live
 from .utils import (
     generate_story,
     load_config,
-    load_api_key
+    load_api_key,
+    parse_filters
 )
 
 logger = logging.getLogger("chapter")
 console = Console()
 
 
-def generate_chapter_tui():
-    """TUI for generating a single chapter."""
+def generate_chapter_tui(profile: Optional[str] = None, stub_model: bool = False):
+    """TUI for generating a single chapter (optionally profiled, see generate_story)."""
     console.clear()
     console.print(Panel("Generate a Single Chapter", style="bold blue"))
 
     config = load_config()
-    api_key = load_api_key(config)
+    api_key = None if stub_model else load_api_key(config)
 
     query = Prompt.ask("[bold blue]Enter your story query")
     style = Prompt.ask("[bold blue]Enter the story style",
@@ -56,6 +57,8 @@ def generate_chapter_tui():
             )
         )
         force = Confirm.ask("Force regeneration (ignore cache)?")
+        filters = parse_filters(Prompt.ask(
+            "[bold blue]Enter metadata filters, e.g. type=manuscript (optional)", default=""))
     else:
         top_n = 3
         temperature = config['generation']['temperature']
@@ -63,6 +66,7 @@ def generate_chapter_tui():
         max_iterations = config['evaluation']['max_iterations']
         min_quality = config['evaluation']['min_quality_score']
         force = False
+        filters = None
 
     log_level = "INFO"  # Set log level for generate_story
 
@@ -98,6 +102,9 @@ def generate_chapter_tui():
                     api_key,
                     log_level,
                     force,
+                    filters,
+                    profile=profile,
+                    stub_model=stub_model,
                 )
 
         console.print(
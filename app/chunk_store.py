@@ -0,0 +1,261 @@
+import json
+import logging
+import mmap
+import threading
+import zlib
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Union
+
+import numpy as np
+
+# Set up a logger for this module.
+logger = logging.getLogger('chunk_store')
+logger.info("Chunk store module initialized")
+
+# Compression codecs; 'zstd' needs the zstandard package.
+CODECS = ('zstd', 'zlib')
+
+# Uncompressed bytes of chunk text per block. Reading one chunk decompresses one block.
+DEFAULT_BLOCK_BYTES = 64 * 1024
+
+# Size of the shared dictionary, and how much text it is built from.
+_DICTIONARY_BYTES = 32 * 1024
+_SAMPLE_BYTES = 1 << 20
+
+# Decompressed blocks kept for repeated and sequential reads.
+_CACHED_BLOCKS = 16
+
+_SETTINGS_FILE = 'texts.json'
+_BLOCKS_FILE = 'texts.z'
+_BLOCK_OFFSETS_FILE = 'text_blocks.i64'
+_INDEX_FILE = 'text_index.i64'
+_DICTIONARY_FILE = 'text_dictionary.bin'
+
+
+def _zstandard() -> Optional[Any]:
+    try:
+        import zstandard
+        return zstandard
+    except ImportError:
+        return None
+
+
+def default_codec() -> str:
+    """Returns 'zstd' if the zstandard package is installed, else 'zlib'."""
+    return 'zstd' if _zstandard() is not None else 'zlib'
+
+
+def _build_dictionary(codec: str, samples: List[bytes]) -> bytes:
+    """Builds the shared dictionary from the first chunks of text."""
+    if codec == 'zstd':
+        zstandard = _zstandard()
+        try:
+            return zstandard.train_dictionary(_DICTIONARY_BYTES, samples).as_bytes()
+        except Exception as e:
+            # Training needs a fair number of samples; fall back to raw text
+            logger.debug(f"Could not train a zstd dictionary ({e}), using sample text")
+    # Pieces from evenly spaced chunks; zlib finds matches in the whole preset dictionary
+    text = b"".join(samples)
+    if len(text) <= _DICTIONARY_BYTES:
+        return text
+    piece = 512
+    step = len(text) // (_DICTIONARY_BYTES // piece)
+    return b"".join(text[start:start + piece] for start in range(0, len(text), step))[:_DICTIONARY_BYTES]
+
+
+class ChunkTextWriter:
+    """Writes chunk texts compressed in blocks, with an index for random access.
+
+    Consecutive chunks are packed into blocks of about `block_bytes` of
+    UTF-8 text, and each block is compressed on its own with a dictionary
+    shared by all blocks. The dictionary is built from the first
+    `_SAMPLE_BYTES` of text, which are held back until then. Small blocks
+    compress well even though each one starts without history.
+
+    Files written to `directory`:
+
+    - `texts.z`: the compressed blocks, one after another.
+    - `text_blocks.i64`: where each block starts in texts.z, followed by the end of the last one.
+    - `text_index.i64`: (block, start, end) of each chunk in its decompressed block.
+    - `text_dictionary.bin`: the shared dictionary.
+    - `texts.json`: the codec and sizes, written by close().
+    """
+
+    def __init__(self, directory: Union[str, Path], codec: Optional[str] = None,
+                 block_bytes: int = DEFAULT_BLOCK_BYTES):
+        codec = codec or default_codec()
+        if codec not in CODECS:
+            raise ValueError(f"Unknown codec '{codec}', expected one of {', '.join(CODECS)}")
+        if codec == 'zstd' and _zstandard() is None:
+            raise ValueError("The zstd codec needs the zstandard package (pip install zstandard)")
+        self.directory = Path(directory)
+        self.codec = codec
+        self.block_bytes = block_bytes
+        self.chunks = 0
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self._samples: Optional[List[bytes]] = []
+        self._sample_bytes = 0
+        self._compress = None
+        self._block = bytearray()
+        self._blocks = 0
+        self._file = open(self.directory / _BLOCKS_FILE, 'wb')
+        self._block_offsets = open(self.directory / _BLOCK_OFFSETS_FILE, 'wb')
+        self._index = open(self.directory / _INDEX_FILE, 'wb')
+        self._block_offsets.write(np.zeros(1, dtype=np.int64).tobytes())
+
+    def add(self, text: str) -> None:
+        """Appends the text of the next chunk."""
+        data = text.encode('utf-8')
+        self.chunks += 1
+        self.raw_bytes += len(data)
+        if self._samples is not None:
+            self._samples.append(data)
+            self._sample_bytes += len(data)
+            if self._sample_bytes >= _SAMPLE_BYTES:
+                self._start()
+            return
+        self._append(data)
+
+    def close(self) -> None:
+        """Writes the last block and the settings."""
+        if self._samples is not None:
+            self._start()
+        if self._block:
+            self._flush()
+        for f in (self._file, self._block_offsets, self._index):
+            f.close()
+        settings = {'codec': self.codec, 'block_bytes': self.block_bytes, 'blocks': self._blocks,
+                    'chunks': self.chunks, 'raw_bytes': self.raw_bytes, 'compressed_bytes': self.compressed_bytes}
+        with open(self.directory / _SETTINGS_FILE, 'w', encoding='utf-8') as f:
+            json.dump(settings, f, indent=2)
+
+    def abort(self) -> None:
+        """Closes the files without finishing them."""
+        for f in (self._file, self._block_offsets, self._index):
+            f.close()
+
+    def _start(self) -> None:
+        """Builds the dictionary from the held-back chunks and writes them."""
+        samples, self._samples = self._samples, None
+        dictionary = _build_dictionary(self.codec, samples) if samples else b""
+        with open(self.directory / _DICTIONARY_FILE, 'wb') as f:
+            f.write(dictionary)
+        if self.codec == 'zstd':
+            zstandard = _zstandard()
+            compressor = zstandard.ZstdCompressor(level=9, dict_data=zstandard.ZstdCompressionDict(dictionary)
+                                                  if dictionary else None)
+            self._compress = compressor.compress
+        else:
+            self._compress = lambda block: _zlib_compress(block, dictionary)
+        for data in samples:
+            self._append(data)
+
+    def _append(self, data: bytes) -> None:
+        if self._block and len(self._block) + len(data) > self.block_bytes:
+            self._flush()
+        start = len(self._block)
+        self._block += data
+        self._index.write(np.array([self._blocks, start, len(self._block)], dtype=np.int64).tobytes())
+
+    def _flush(self) -> None:
+        compressed = self._compress(bytes(self._block))
+        self._file.write(compressed)
+        self.compressed_bytes += len(compressed)
+        self._block_offsets.write(np.array([self.compressed_bytes], dtype=np.int64).tobytes())
+        self._blocks += 1
+        self._block = bytearray()
+
+
+def _zlib_compress(block: bytes, dictionary: bytes) -> bytes:
+    compressor = zlib.compressobj(9, zdict=dictionary) if dictionary else zlib.compressobj(9)
+    return compressor.compress(block) + compressor.flush()
+
+
+class ChunkTextStore:
+    """Reads chunk texts written by ChunkTextWriter, decompressing only the blocks asked for.
+
+    The compressed file is memory-mapped; the index takes 24 bytes per
+    chunk. Recently decompressed blocks are cached, so reading the chunks
+    of a block one after another decompresses it once. Safe to use from
+    several threads.
+    """
+
+    def __init__(self, directory: Union[str, Path]):
+        self.directory = Path(directory)
+        with open(self.directory / _SETTINGS_FILE, 'r', encoding='utf-8') as f:
+            self.settings: Dict[str, Any] = json.load(f)
+        self.codec = self.settings['codec']
+        self._index = np.fromfile(self.directory / _INDEX_FILE, dtype=np.int64).reshape(-1, 3)
+        self._block_offsets = np.fromfile(self.directory / _BLOCK_OFFSETS_FILE, dtype=np.int64)
+        dictionary = (self.directory / _DICTIONARY_FILE).read_bytes()
+        if self.codec == 'zstd':
+            zstandard = _zstandard()
+            if zstandard is None:
+                raise ValueError(f"{directory} is compressed with zstd, which needs the zstandard package "
+                                 f"(pip install zstandard)")
+            decompressor = zstandard.ZstdDecompressor(dict_data=zstandard.ZstdCompressionDict(dictionary)
+                                                      if dictionary else None)
+            self._decompress = decompressor.decompress
+        else:
+            self._decompress = lambda block: (zlib.decompressobj(zdict=dictionary) if dictionary
+                                              else zlib.decompressobj()).decompress(block)
+        with open(self.directory / _BLOCKS_FILE, 'rb') as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self._block_offsets[-1] else b""
+        self._cache: "OrderedDict[int, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def get(self, chunk_id: int) -> str:
+        """Returns the text of one chunk."""
+        block, start, end = self._index[chunk_id]
+        return self._block(int(block))[start:end].decode('utf-8')
+
+    def _block(self, block: int) -> bytes:
+        with self._lock:
+            data = self._cache.get(block)
+            if data is not None:
+                self._cache.move_to_end(block)
+                return data
+        data = self._decompress(self._data[self._block_offsets[block]:self._block_offsets[block + 1]])
+        with self._lock:
+            self._cache[block] = data
+            if len(self._cache) > _CACHED_BLOCKS:
+                self._cache.popitem(last=False)
+        return data
+
+
+class FileChunks(Sequence):
+    """The chunk texts of one file, read from a ChunkTextStore when they are accessed.
+
+    Stands in for the list of chunk texts ('chunk_content') of an embeddings
+    dictionary, so looking up the few chunks a query returns decompresses
+    only their blocks.
+    """
+
+    def __init__(self, store: ChunkTextStore, first: int, count: int):
+        self.store = store
+        self.first = first
+        self.count = count
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.count))]
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError('chunk index out of range')
+        return self.store.get(self.first + index)
+
+    def __iter__(self) -> Iterator[str]:
+        for index in range(self.count):
+            yield self.store.get(self.first + index)
+
+    def __repr__(self) -> str:
+        return f"FileChunks({self.count} chunks from {self.store.directory})"
@@ -0,0 +1,150 @@
+import logging
+import re
+from typing import Any, Dict, List
+
+from .semantic_search import embed_texts
+from .text_processing import split_sentences
+
+# Set up a logger for this module.
+logger = logging.getLogger('compression')
+logger.info("Compression module initialized")
+
+# Longest overlap (in characters) looked for between consecutive chunks.
+MAX_CHUNK_OVERLAP = 1000
+
+# Marks the places where sentences were left out of a chunk.
+ELLIPSIS = " ... "
+
+
+def _strip_overlap(previous: str, text: str, max_overlap: int = MAX_CHUNK_OVERLAP) -> str:
+    """Removes the start of text that repeats the end of previous."""
+    for size in range(min(len(previous), len(text), max_overlap), 0, -1):
+        if previous.endswith(text[:size]):
+            return text[size:]
+    return text
+
+
+def merge_adjacent_chunks(context_chunks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Merges consecutive chunks of the same file, dropping their overlapping text.
+
+    Args:
+        context_chunks: Chunks as returned by `context.collect_context_chunks`.
+
+    Returns:
+        The merged chunks, most similar first. A merged chunk lists all of its
+        chunk indices and keeps the highest similarity of its parts.
+    """
+    merged = []
+    runs = {}  # (file_path, last chunk index) -> merged chunk
+    ordered = sorted(
+        context_chunks,
+        key=lambda chunk: (chunk['file_path'], chunk['chunk_indices'][:1] or [-1]))
+    for chunk in ordered:
+        indices = chunk['chunk_indices']
+        run = runs.pop((chunk['file_path'], indices[0] - 1), None) if len(indices) == 1 else None
+        if run is not None:
+            run['text'] += _strip_overlap(run['text'], chunk['text'])
+            run['chunk_indices'].append(indices[0])
+            run['similarity'] = max(run['similarity'], chunk['similarity'])
+        else:
+            run = dict(chunk, chunk_indices=list(indices))
+            merged.append(run)
+        if run['chunk_indices']:
+            runs[(run['file_path'], run['chunk_indices'][-1])] = run
+
+    merged.sort(key=lambda chunk: chunk['similarity'], reverse=True)
+    return merged
+
+
+def _normalize(sentence: str) -> str:
+    """Normalizes a sentence for exact duplicate detection."""
+    return re.sub(r"\W+", " ", sentence.lower()).strip()
+
+
+def compress_chunks(context_chunks: List[Dict[str, Any]], query: str,
+                    max_chars_per_chunk: int = 1500,
+                    redundancy_threshold: float = 0.92) -> List[Dict[str, Any]]:
+    """Compresses retrieved chunks by extractive sentence selection.
+
+    The stage runs locally on CPU and works in four steps:
+
+    1. Consecutive chunks of the same file are merged and their overlap removed.
+    2. All sentences are encoded together with the query in one batch.
+    3. Sentences that repeat (exactly, or with an embedding similarity above
+       `redundancy_threshold`) a sentence of a more relevant chunk are dropped.
+    4. Each chunk keeps its sentences most similar to the query, up to
+       `max_chars_per_chunk` characters per original chunk, in their original order.
+
+    Args:
+        context_chunks: Chunks as returned by `context.collect_context_chunks`.
+        query: The retrieval query.
+        max_chars_per_chunk: The character budget per original chunk.
+        redundancy_threshold: The cosine similarity above which two sentences count as duplicates.
+
+    Returns:
+        The compressed chunks, most similar first. Chunks left without sentences are dropped.
+    """
+    merged = merge_adjacent_chunks(context_chunks)
+    sentences = [split_sentences(chunk['text']) for chunk in merged]
+    flat = [sentence for chunk_sentences in sentences for sentence in chunk_sentences]
+    if not flat:
+        return merged
+
+    try:
+        embeddings = embed_texts([query] + flat)
+    except Exception as e:
+        logger.warning(f"Could not encode sentences for context compression: {e}")
+        return merged
+    relevance = embeddings[1:] @ embeddings[0]
+    similarity = embeddings[1:] @ embeddings[1:].T
+
+    original_chars = sum(len(chunk['text']) for chunk in context_chunks)
+    compressed = []
+    kept = []  # Positions (in flat) of the sentences kept so far
+    seen = set()
+    position = 0
+    for chunk, chunk_sentences in zip(merged, sentences):
+        positions = range(position, position + len(chunk_sentences))
+        position += len(chunk_sentences)
+
+        # Drop sentences already covered by more relevant chunks
+        candidates = []
+        for i in positions:
+            key = _normalize(flat[i])
+            if key in seen:
+                continue
+            if kept and similarity[i, kept].max() > redundancy_threshold:
+                continue
+            candidates.append(i)
+        if not candidates:
+            continue
+
+        # Keep the sentences most relevant to the query within the budget
+        budget = max_chars_per_chunk * max(1, len(chunk['chunk_indices']))
+        selected = []
+        used = 0
+        for i in sorted(candidates, key=lambda i: relevance[i], reverse=True):
+            if selected and used + len(flat[i]) > budget:
+                continue
+            selected.append(i)
+            used += len(flat[i]) + len(ELLIPSIS)
+        selected.sort()
+
+        for i in selected:
+            seen.add(_normalize(flat[i]))
+            kept.append(i)
+
+        pieces = []
+        for previous, i in zip([None] + selected[:-1], selected):
+            if previous is not None:
+                pieces.append(" " if i == previous + 1 else ELLIPSIS)
+            pieces.append(flat[i])
+        text = "".join(pieces)
+        if len(selected) == 1 and len(text) > budget:
+            text = text[:budget].rstrip() + ELLIPSIS.rstrip()
+        compressed.append(dict(chunk, text=text))
+
+    compressed_chars = sum(len(chunk['text']) for chunk in compressed)
+    logger.info(f"Compressed context from {original_chars} to {compressed_chars} characters "
+                f"({len(context_chunks)} chunks -> {len(compressed)})")
+    return compressed
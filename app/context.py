@@ -1,44 +1,151 @@
 import logging
-from typing import List, Tuple, Dict, Any
+from typing import List, Tuple, Dict, Any, Optional
 from pathlib import Path
 
+import numpy as np
+
+from .compression import compress_chunks
+from .metrics import span
 from .text_processing import chunk_text
 
 # Set up a logger for this module.
 logger = logging.getLogger('context')
 logger.info("Context module initialized")
 
+CONTEXT_CHUNK_FALLBACK_SIZE = 5000
+
+# format_context puts this between the formatted chunks.
+CONTEXT_SEPARATOR = "\n---\n"
 
-def prepare_context(embeddings_dict: Dict[str, Any], relevant_chunks: List[Tuple[str, int, float]]) -> str:
-    """Prepare context from relevant chunks.
+
+def collect_context_chunks(embeddings_dict: Dict[str, Any],
+                           relevant_chunks: List[Tuple[str, int, float]]) -> List[Dict[str, Any]]:
+    """Look up the text of the relevant chunks.
 
     Args:
         embeddings_dict: A dictionary where keys are file paths and values are dictionaries containing 'content' and 'chunk_embeddings' (and optionally 'chunk_content').
         relevant_chunks: A list of tuples, each containing (file_path, chunk_index, similarity_score), as returned by semantic_search.
 
     Returns:
-        A string containing the formatted context.
+        A list of dictionaries with 'file_path', 'chunk_indices', 'similarity' and 'text' for each chunk, in the input order.
     """
-    CONTEXT_CHUNK_FALLBACK_SIZE = 5000  # Define constant here
-    logger.debug("Preparing context from relevant chunks")
-    context_parts = []
+    chunks_by_file = {}
+    context_chunks = []
 
     for file_path, chunk_idx, similarity in relevant_chunks:
         data = embeddings_dict[file_path]
-        content = data['content']
-        chunks = data.get('chunk_content', chunk_text(content))
+        if file_path not in chunks_by_file:
+            chunks_by_file[file_path] = data['chunk_content'] if 'chunk_content' in data else chunk_text(data['content'])
+        chunks = chunks_by_file[file_path]
 
         if chunk_idx is not None and chunk_idx < len(chunks):
-            context_chunk = chunks[chunk_idx]
-            source = f"{Path(file_path).name} (chunk {chunk_idx + 1})"
+            text = chunks[chunk_idx]
+            chunk_indices = [chunk_idx]
         else:
             logger.warning(f"Invalid chunk index {chunk_idx} for {
                            file_path}")
-            context_chunk = content[:CONTEXT_CHUNK_FALLBACK_SIZE]
-            source = Path(file_path).name
+            # Files loaded from an embedding store have no 'content'
+            text = data['content'] if 'content' in data else " ".join(chunks)
+            text = text[:CONTEXT_CHUNK_FALLBACK_SIZE]
+            chunk_indices = []
+
+        context_chunks.append({
+            'file_path': file_path,
+            'chunk_indices': chunk_indices,
+            'similarity': similarity,
+            'text': text,
+        })
+
+    return context_chunks
+
+
+def format_context_chunk(chunk: Dict[str, Any]) -> str:
+    """Format one context chunk (as returned by collect_context_chunks) with its source and relevance."""
+    name = Path(chunk['file_path']).name
+    indices = chunk['chunk_indices']
+    if not indices:
+        source = name
+    elif len(indices) == 1:
+        source = f"{name} (chunk {indices[0] + 1})"
+    else:
+        source = f"{name} (chunks {indices[0] + 1}-{indices[-1] + 1})"
+
+    return f"Source: {source}\nRelevance: {chunk['similarity']:.2f}\n\n{chunk['text']}\n"
+
+
+def format_context(context_chunks: List[Dict[str, Any]]) -> str:
+    """Format context chunks (as returned by collect_context_chunks) for the prompt.
+
+    Args:
+        context_chunks: The chunks to format.
+
+    Returns:
+        A string containing the formatted context.
+    """
+    return CONTEXT_SEPARATOR.join(format_context_chunk(chunk) for chunk in context_chunks)
+
+
+def limit_context_chars(context_chunks: List[Dict[str, Any]], max_chars: int) -> List[Dict[str, Any]]:
+    """Keep the leading chunks whose texts fit in `max_chars` characters together.
 
-        context_parts.append(f"Source: {source}\nRelevance: {
-                             similarity:.2f}\n\n{context_chunk}\n")
+    If not even the first chunk fits, it is kept, cut to `max_chars` characters.
+    """
+    if not context_chunks:
+        return context_chunks
+    lengths = np.fromiter((len(chunk['text']) for chunk in context_chunks), dtype=np.int64, count=len(context_chunks))
+    count = int(np.searchsorted(np.cumsum(lengths), max_chars, side='right'))
+    if count:
+        return context_chunks[:count]
+    return [dict(context_chunks[0], text=context_chunks[0]['text'][:max_chars])]
+
+
+def prepare_context_chunks(embeddings_dict: Dict[str, Any], relevant_chunks: List[Tuple[str, int, float]],
+                           query: Optional[str] = None, compression: Optional[Dict[str, Any]] = None,
+                           max_chars: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Prepare the context chunks for the prompt, without formatting them.
+
+    Takes the same arguments as prepare_context. build_prompt takes the
+    returned list directly, so each chunk becomes one prompt item ranked by
+    its similarity.
+
+    Returns:
+        A list of dictionaries with 'file_path', 'chunk_indices', 'similarity' and 'text',
+        as returned by collect_context_chunks.
+    """
+    logger.debug("Preparing context from relevant chunks")
+    context_chunks = collect_context_chunks(embeddings_dict, relevant_chunks)
+
+    if compression and compression.get('enabled') and query:
+        with span('context_compression') as attributes:
+            attributes['input_chars'] = sum(len(chunk['text']) for chunk in context_chunks)
+            context_chunks = compress_chunks(
+                context_chunks, query,
+                max_chars_per_chunk=compression.get('max_chars_per_chunk', 1500),
+                redundancy_threshold=compression.get('redundancy_threshold', 0.92))
+            attributes['chars'] = sum(len(chunk['text']) for chunk in context_chunks)
+
+    if max_chars is not None:
+        context_chunks = limit_context_chars(context_chunks, max_chars)
+
+    logger.info(f"Prepared context with {len(context_chunks)} parts")
+    return context_chunks
 
-    logger.info(f"Prepared context with {len(context_parts)} parts")
-    return "\n---\n".join(context_parts)
+
+def prepare_context(embeddings_dict: Dict[str, Any], relevant_chunks: List[Tuple[str, int, float]],
+                    query: Optional[str] = None, compression: Optional[Dict[str, Any]] = None,
+                    max_chars: Optional[int] = None) -> str:
+    """Prepare context from relevant chunks.
+
+    Args:
+        embeddings_dict: A dictionary where keys are file paths and values are dictionaries containing 'content' and 'chunk_embeddings' (and optionally 'chunk_content').
+        relevant_chunks: A list of tuples, each containing (file_path, chunk_index, similarity_score), as returned by semantic_search.
+        query: The retrieval query, used to select sentences when compressing.
+        compression: Compression settings (the `context.compression` config section). The chunks are
+            compressed with `compression.compress_chunks` when this is given and 'enabled' is true.
+        max_chars: The most characters of chunk text in the context, counted after compression
+            (see limit_context_chars). Chunks are kept in the order given.
+
+    Returns:
+        A string containing the formatted context.
+    """
+    return format_context(prepare_context_chunks(embeddings_dict, relevant_chunks, query, compression, max_chars))
@@ -0,0 +1,134 @@
+import logging
+import re
+import zlib
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+# Set up a logger for this module.
+logger = logging.getLogger('dedup')
+logger.info("Dedup module initialized")
+
+_WORD_PATTERN = re.compile(r"\w+")
+
+# Multiplier of the polynomial hash that combines word hashes into shingle hashes.
+_SHINGLE_BASE = np.uint64(1000003)
+
+
+class MinHashDeduplicator:
+    """Finds near-duplicate texts in about linear time with MinHash and LSH banding.
+
+    Each text is reduced to its set of word shingles (runs of
+    `shingle_words` words). Its MinHash signature holds, for each of
+    `num_perm` hash functions, the smallest hash of any of its shingles.
+    Two signatures agree in a position with probability equal to the
+    Jaccard similarity of the shingle sets.
+
+    Signatures are cut into `bands` bands. Texts that agree in every
+    position of at least one band share a bucket and become candidates,
+    and only candidates are compared. A pair becomes a candidate with
+    probability 1 - (1 - J^rows)^bands; with the defaults (16 bands of 6
+    rows) that is 0.99 at J = 0.8 and 0.22 at J = 0.5.
+
+    add() returns the most similar earlier text whose estimated Jaccard
+    similarity reaches `threshold`, or None if the text is new. Only new
+    texts are kept, as canonical texts for the texts that follow.
+    """
+
+    def __init__(self, threshold: float = 0.8, num_perm: int = 96, bands: int = 16, shingle_words: int = 5,
+                 seed: int = 0):
+        if num_perm % bands:
+            raise ValueError(f"num_perm ({num_perm}) must be a multiple of bands ({bands})")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_words = shingle_words
+        # Multiply-shift hash functions: (a * x + b) >> 32, with odd a, over 64-bit words
+        rng = np.random.default_rng(seed)
+        self._multipliers = (rng.integers(0, 2 ** 63, num_perm, dtype=np.uint64) * np.uint64(2)
+                             + np.uint64(1))[:, None]
+        self._offsets = rng.integers(0, 2 ** 63, num_perm, dtype=np.uint64)[:, None]
+        # Signatures of the canonical texts, in a matrix that doubles in size when full
+        self._signatures = np.zeros((64, num_perm), dtype=np.uint32)
+        self._count = 0
+        self._buckets: List[Dict[bytes, List[int]]] = [{} for _ in range(bands)]
+
+    def __len__(self) -> int:
+        """The number of canonical texts."""
+        return self._count
+
+    def signature(self, text: str) -> Optional[np.ndarray]:
+        """Returns the MinHash signature of a text, or None if it has no words."""
+        words = _WORD_PATTERN.findall(text.lower())
+        if not words:
+            return None
+        word_hashes = np.fromiter((zlib.crc32(word.encode('utf-8')) for word in words), dtype=np.uint64,
+                                  count=len(words))
+        width = min(self.shingle_words, len(words))
+        shingles = np.zeros(len(words) - width + 1, dtype=np.uint64)
+        for k in range(width):
+            shingles = shingles * _SHINGLE_BASE + word_hashes[k:len(words) - width + 1 + k]
+        shingles = np.unique(shingles)
+        hashes = (self._multipliers * shingles[None, :] + self._offsets) >> np.uint64(32)
+        return hashes.min(axis=1).astype(np.uint32)
+
+    def find(self, signature: np.ndarray) -> Optional[int]:
+        """Returns the id of the most similar canonical text at or above the threshold, if any."""
+        candidates = set()
+        for band, buckets in enumerate(self._buckets):
+            candidates.update(buckets.get(self._band_key(signature, band), ()))
+        if not candidates:
+            return None
+        ids = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+        similarities = (self._signatures[ids] == signature).mean(axis=1)
+        best = int(np.argmax(similarities))
+        return int(ids[best]) if similarities[best] >= self.threshold else None
+
+    def add(self, text: str) -> Optional[int]:
+        """Checks a text against the canonical texts so far.
+
+        Returns:
+            The id of the canonical text it duplicates, or None if it is new (or has no
+            words). New texts get the next id: 0 for the first, then 1, and so on.
+        """
+        signature = self.signature(text)
+        if signature is None:
+            self._insert(None)
+            return None
+        duplicate = self.find(signature)
+        if duplicate is None:
+            self._insert(signature)
+        return duplicate
+
+    def _insert(self, signature: Optional[np.ndarray]) -> None:
+        if self._count == len(self._signatures):
+            grown = np.zeros((2 * len(self._signatures), self.num_perm), dtype=np.uint32)
+            grown[:self._count] = self._signatures[:self._count]
+            self._signatures = grown
+        if signature is not None:
+            self._signatures[self._count] = signature
+            for band, buckets in enumerate(self._buckets):
+                buckets.setdefault(self._band_key(signature, band), []).append(self._count)
+        self._count += 1
+
+    def _band_key(self, signature: np.ndarray, band: int) -> bytes:
+        return signature[band * self.rows:(band + 1) * self.rows].tobytes()
+
+
+def duplicate_references(embeddings_dict: Dict[str, Any]) -> Dict[Tuple[str, int], List[Tuple[str, int]]]:
+    """Maps each canonical chunk to the chunks that were collapsed into it.
+
+    Args:
+        embeddings_dict: Embeddings loaded from a store converted with deduplication.
+
+    Returns:
+        {(file_path, chunk_index): [(file_path, original_chunk_index), ...]} for every
+        canonical chunk with duplicates. The duplicates' indices are their positions in the
+        source file before the conversion.
+    """
+    references: Dict[Tuple[str, int], List[Tuple[str, int]]] = {}
+    for file_path, data in embeddings_dict.items():
+        for chunk_index, canonical_path, canonical_index in data.get('duplicates', ()):
+            references.setdefault((canonical_path, canonical_index), []).append((file_path, chunk_index))
+    return references
@@ -0,0 +1,418 @@
+import argparse
+import json
+import logging
+import os
+import re
+import shutil
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Sequence, TextIO, Tuple, Union
+
+import numpy as np
+from rich.console import Console
+
+from .chunk_store import CODECS, ChunkTextStore, ChunkTextWriter, FileChunks
+from .dedup import MinHashDeduplicator
+from .text_processing import chunk_text
+
+# Set up a logger for this module.
+logger = logging.getLogger('embedding_store')
+logger.info("Embedding store module initialized")
+console = Console()
+
+# Format version written to the manifest; stores of other versions are not loaded.
+STORE_VERSION = 2
+
+# Suffix of the store directory written next to an embeddings file.
+STORE_SUFFIX = '.store'
+
+_MANIFEST_FILE = 'store.json'
+_FILES_FILE = 'files.jsonl'
+_VECTORS_FILE = 'vectors.f32'
+
+# Characters read from the JSON file at a time.
+_READ_SIZE = 1 << 20
+
+_WHITESPACE = re.compile(r"\s*")
+
+
+def store_path(embeddings_file: Union[str, Path]) -> Path:
+    """Returns where the store of an embeddings file is written, e.g. data/embeddings.store."""
+    embeddings_file = Path(embeddings_file)
+    return embeddings_file.with_name(embeddings_file.stem + STORE_SUFFIX)
+
+
+def is_store(path: Union[str, Path]) -> bool:
+    """Whether a path is a complete embedding store (its manifest is written last)."""
+    return (Path(path) / _MANIFEST_FILE).is_file()
+
+
+def find_store(embeddings_file: Union[str, Path]) -> Optional[Path]:
+    """Returns the store to load for an embeddings file: the path itself if it is a store, or
+    its converted store if that is newer than the file. Returns None if there is neither."""
+    embeddings_file = Path(embeddings_file)
+    if is_store(embeddings_file):
+        return embeddings_file
+    store = store_path(embeddings_file)
+    if not is_store(store):
+        return None
+    if embeddings_file.exists() and embeddings_file.stat().st_mtime > (store / _MANIFEST_FILE).stat().st_mtime:
+        logger.warning(f"{store} is older than {embeddings_file} and is not used; convert the file again "
+                       f"with python -m app.embedding_store")
+        return None
+    return store
+
+
+class _JsonStream:
+    """Reads JSON values one at a time from a text stream, keeping only the unread part."""
+
+    def __init__(self, reader: TextIO, read_size: int = _READ_SIZE):
+        self.reader = reader
+        self.read_size = read_size
+        self.buffer = ""
+        self.position = 0
+        # Stream offset of buffer[0], for error messages
+        self.base = 0
+        self.exhausted = False
+        self.decoder = json.JSONDecoder()
+
+    def _read(self, size: int) -> None:
+        text = self.reader.read(size)
+        if not text:
+            self.exhausted = True
+            return
+        self.base += self.position
+        self.buffer = self.buffer[self.position:] + text
+        self.position = 0
+
+    def peek(self) -> str:
+        """Returns the next character that is not whitespace ('' at the end of the stream)."""
+        while True:
+            self.position = _WHITESPACE.match(self.buffer, self.position).end()
+            if self.position < len(self.buffer) or self.exhausted:
+                return self.buffer[self.position:self.position + 1]
+            self._read(self.read_size)
+
+    def expect(self, character: str) -> None:
+        found = self.peek()
+        if found != character:
+            raise ValueError(f"Expected '{character}' at character {self.base + self.position}, "
+                             f"found {found or 'the end of the file'!r}")
+        self.position += 1
+
+    def value(self) -> Any:
+        """Decodes the next value, reading until all of it is in the buffer."""
+        self.peek()
+        while True:
+            try:
+                value, self.position = self.decoder.raw_decode(self.buffer, self.position)
+                return value
+            except json.JSONDecodeError as e:
+                if self.exhausted:
+                    raise ValueError(f"Invalid JSON at character {self.base + e.pos}: {e.msg}") from None
+                # Read at least as much as is buffered, so a large value is re-parsed only a few times
+                self._read(max(self.read_size, len(self.buffer) - self.position))
+
+
+def iter_json_entries(reader: TextIO, read_size: int = _READ_SIZE) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """Reads the entries of an embeddings JSON file one at a time.
+
+    Two layouts are accepted:
+
+    - `{file_path: {'content', 'chunk_embeddings', 'chunk_content', 'metadata'}}`, the
+      layout the application loads. Each file is yielded as it is.
+    - `{"documents": [{'id', 'text', 'embedding', 'metadata'}]}`, described in
+      docs/embeddings_setup.md. Each document is yielded as a file with one chunk,
+      keyed by its 'id' (or its position).
+
+    Only one entry is decoded at a time, so memory use depends on the largest
+    entry rather than on the size of the file.
+
+    Yields:
+        (file_path, entry) pairs in the application's layout.
+
+    Raises:
+        ValueError: If the file is not valid JSON or has neither layout.
+    """
+    stream = _JsonStream(reader, read_size)
+    stream.expect('{')
+    if stream.peek() == '}':
+        return
+    while True:
+        key = stream.value()
+        if not isinstance(key, str):
+            raise ValueError(f"Expected a string key at character {stream.base + stream.position}")
+        stream.expect(':')
+        if key == 'documents' and stream.peek() == '[':
+            stream.expect('[')
+            number = 0
+            while stream.peek() != ']':
+                if number:
+                    stream.expect(',')
+                yield _document_entry(stream.value(), number)
+                number += 1
+            stream.expect(']')
+        else:
+            entry = stream.value()
+            if not isinstance(entry, dict):
+                raise ValueError(f"The entry of {key} is not an object")
+            yield key, entry
+        if stream.peek() != ',':
+            break
+        stream.expect(',')
+    stream.expect('}')
+
+
+def _document_entry(document: Any, number: int) -> Tuple[str, Dict[str, Any]]:
+    """Converts a {'id', 'text', 'embedding', 'metadata'} document into a one-chunk file entry."""
+    if not isinstance(document, dict):
+        raise ValueError(f"Document {number} is not an object")
+    text = document.get('text', "")
+    embedding = document.get('embedding')
+    return str(document.get('id', number)), {
+        'content': text,
+        'chunk_content': [text] if embedding is not None else [],
+        'chunk_embeddings': [embedding] if embedding is not None else [],
+        'metadata': document.get('metadata') or {},
+    }
+
+
+class EmbeddingStoreWriter:
+    """Writes an embedding store one file at a time.
+
+    A store is a directory with:
+
+    - `vectors.f32`: the chunk embeddings of all files, as float32 rows.
+    - The chunk texts, compressed in blocks by a chunk_store.ChunkTextWriter (`texts.z`
+      and its index files).
+    - `files.jsonl`: one line per file with its path, chunk count and metadata, and the
+      chunks collapsed into near-duplicates elsewhere, if any.
+    - `store.json`: the manifest (version, dimensions, counts), written by close().
+
+    Everything is appended as it arrives, so writing needs memory for one
+    file only. A store without a manifest is incomplete and is not loaded.
+    """
+
+    def __init__(self, directory: Union[str, Path], codec: Optional[str] = None):
+        self.directory = Path(directory)
+        if self.directory.exists():
+            shutil.rmtree(self.directory)
+        self.directory.mkdir(parents=True)
+        self.dimensions = 0
+        self.files = 0
+        self.chunks = 0
+        self.duplicates = 0
+        self._vectors = open(self.directory / _VECTORS_FILE, 'wb')
+        self._texts = ChunkTextWriter(self.directory, codec)
+        self._file_list = open(self.directory / _FILES_FILE, 'w', encoding='utf-8')
+
+    def __enter__(self) -> 'EmbeddingStoreWriter':
+        return self
+
+    def __exit__(self, exc_type, exc, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self._texts.abort()
+            self._close_files()
+
+    def add(self, file_path: str, chunk_embeddings: Any, chunk_content: Sequence[str],
+            metadata: Optional[Dict[str, Any]] = None,
+            duplicates: Optional[List[Tuple[int, str, int]]] = None) -> None:
+        """Appends a file's chunks.
+
+        `duplicates` lists the chunks of the file that were left out as near-duplicates, as
+        (original chunk index, canonical file path, canonical chunk index).
+
+        Raises:
+            ValueError: If the number of embeddings and texts differ, or the dimensions
+                differ from earlier files.
+        """
+        embeddings = np.asarray(chunk_embeddings, dtype=np.float32)
+        if len(embeddings) != len(chunk_content):
+            raise ValueError(f"{file_path} has {len(embeddings)} embeddings but {len(chunk_content)} chunks")
+        if len(embeddings):
+            embeddings = embeddings.reshape(len(embeddings), -1)
+            if not self.dimensions:
+                self.dimensions = embeddings.shape[1]
+            elif embeddings.shape[1] != self.dimensions:
+                raise ValueError(f"Embeddings of {file_path} have {embeddings.shape[1]} dimensions, "
+                                 f"the store has {self.dimensions}")
+            self._vectors.write(np.ascontiguousarray(embeddings).tobytes())
+
+        for text in chunk_content:
+            self._texts.add(text)
+
+        record = {'path': file_path, 'chunks': len(chunk_content), 'metadata': metadata or {}}
+        if duplicates:
+            record['duplicates'] = [list(duplicate) for duplicate in duplicates]
+            self.duplicates += len(duplicates)
+        self._file_list.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.files += 1
+        self.chunks += len(chunk_content)
+
+    def close(self) -> None:
+        """Finishes the store by writing its manifest."""
+        self._texts.close()
+        self._close_files()
+        manifest = {'version': STORE_VERSION, 'dimensions': self.dimensions, 'files': self.files,
+                    'chunks': self.chunks, 'duplicates': self.duplicates, 'codec': self._texts.codec}
+        with open(self.directory / _MANIFEST_FILE, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+
+    def _close_files(self) -> None:
+        for f in (self._vectors, self._file_list):
+            f.close()
+
+
+def _collapse_duplicates(deduplicator: MinHashDeduplicator, canonical: List[Tuple[str, int]], file_path: str,
+                         chunks: List[str], embeddings: List[Any]) -> Tuple[List[str], List[Any], List[Tuple[int, str, int]]]:
+    """Drops the chunks of a file that duplicate a canonical chunk.
+
+    `canonical` maps deduplicator ids to (file path, chunk index) in the store and is
+    extended with the chunks kept.
+
+    Returns:
+        The kept chunks, their embeddings, and (chunk index, canonical file path, canonical
+        chunk index) for each dropped chunk.
+    """
+    kept_chunks, kept_embeddings, duplicates = [], [], []
+    for i, (chunk, embedding) in enumerate(zip(chunks, embeddings)):
+        duplicate = deduplicator.add(chunk)
+        if duplicate is None:
+            canonical.append((file_path, len(kept_chunks)))
+            kept_chunks.append(chunk)
+            kept_embeddings.append(embedding)
+        else:
+            duplicates.append((i, *canonical[duplicate]))
+    return kept_chunks, kept_embeddings, duplicates
+
+
+def convert_embeddings_json(embeddings_file: Union[str, Path], target: Optional[Union[str, Path]] = None,
+                            chunk_size: int = 5000, chunk_overlap: int = 200,
+                            deduplicator: Optional[MinHashDeduplicator] = None, codec: Optional[str] = None) -> Path:
+    """Converts an embeddings JSON file into a store, one file at a time.
+
+    Files without 'chunk_content' get their chunks from chunk_text(content),
+    the same way context.py and lexical_index.py derive them.
+
+    With a `deduplicator`, a chunk that is a near-duplicate of a chunk
+    already written is left out, and its file records which chunk it
+    collapsed into (see dedup.duplicate_references). The remaining chunks of
+    a file are numbered from 0 again.
+
+    Args:
+        embeddings_file: The JSON file, in either layout read by iter_json_entries().
+        target: The store directory (default: store_path(embeddings_file)).
+        chunk_size: The chunk size the embeddings were made with (`embedding.chunk_size`).
+        chunk_overlap: Their chunk overlap (`embedding.chunk_overlap`).
+        deduplicator: Finds the near-duplicate chunks (`embedding.dedup`), or None to keep all.
+        codec: Compression of the chunk texts, 'zstd' or 'zlib' (default: zstd if the
+            zstandard package is installed).
+
+    Returns:
+        The store directory.
+    """
+    target = Path(target) if target else store_path(embeddings_file)
+    # Written under a temporary name, so an interrupted conversion leaves no store behind
+    partial = target.with_name(target.name + '.partial')
+    canonical: List[Tuple[str, int]] = []
+    with open(embeddings_file, 'r', encoding='utf-8') as f, EmbeddingStoreWriter(partial, codec) as writer:
+        for file_path, entry in iter_json_entries(f):
+            chunks = entry.get('chunk_content')
+            if chunks is None:
+                chunks = chunk_text(entry.get('content', ""), chunk_size, chunk_overlap)
+            embeddings = entry.get('chunk_embeddings') or []
+            if len(chunks) != len(embeddings):
+                logger.warning(f"{file_path} has {len(embeddings)} embeddings for {len(chunks)} chunks, "
+                               f"keeping the first {min(len(chunks), len(embeddings))}")
+                count = min(len(chunks), len(embeddings))
+                chunks, embeddings = chunks[:count], embeddings[:count]
+            duplicates = None
+            if deduplicator is not None:
+                chunks, embeddings, duplicates = _collapse_duplicates(deduplicator, canonical, file_path,
+                                                                      chunks, embeddings)
+            writer.add(file_path, embeddings, chunks, entry.get('metadata'), duplicates)
+    if target.exists():
+        shutil.rmtree(target)
+    os.replace(partial, target)
+    logger.info(f"Converted {embeddings_file} to {target}: {writer.files} files, {writer.chunks} chunks"
+                + (f", {writer.duplicates} near-duplicate chunks collapsed" if deduplicator is not None else ""))
+    return target
+
+
+def load_embedding_store(directory: Union[str, Path]) -> Dict[str, Any]:
+    """Loads a store as an embeddings dictionary.
+
+    The chunk embeddings are read-only views of the memory-mapped vector
+    file, so they take no memory until they are read. Each file has
+    'chunk_embeddings', 'chunk_content' and 'metadata'; 'content' is not
+    stored. 'chunk_content' is a chunk_store.FileChunks sequence that
+    decompresses a chunk's block when the chunk is read, so only the chunks
+    a query returns are decompressed. Files with chunks collapsed into near-duplicates also have
+    'duplicates', as written by EmbeddingStoreWriter.add().
+
+    Raises:
+        ValueError: If the directory is not a complete store of this version.
+    """
+    directory = Path(directory)
+    if not is_store(directory):
+        raise ValueError(f"{directory} is not a complete embedding store")
+    with open(directory / _MANIFEST_FILE, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    if manifest.get('version') != STORE_VERSION:
+        raise ValueError(f"{directory} has store version {manifest.get('version')}, expected {STORE_VERSION}; "
+                         f"convert the embeddings file again with python -m app.embedding_store")
+
+    dimensions, chunks = manifest['dimensions'], manifest['chunks']
+    vectors = (np.memmap(directory / _VECTORS_FILE, dtype=np.float32, mode='r', shape=(chunks, dimensions))
+               if chunks and dimensions else np.zeros((0, dimensions), dtype=np.float32))
+    texts = ChunkTextStore(directory)
+
+    embeddings_dict: Dict[str, Any] = {}
+    row = 0
+    with open(directory / _FILES_FILE, 'r', encoding='utf-8') as f:
+        for line in f:
+            record = json.loads(line)
+            count = record['chunks']
+            embeddings_dict[record['path']] = {
+                'chunk_embeddings': vectors[row:row + count],
+                'chunk_content': FileChunks(texts, row, count),
+                'metadata': record['metadata'],
+            }
+            if record.get('duplicates'):
+                embeddings_dict[record['path']]['duplicates'] = [tuple(duplicate) for duplicate in record['duplicates']]
+            row += count
+    logger.info(f"Loaded embedding store {directory}: {len(embeddings_dict)} files, {chunks} chunks")
+    return embeddings_dict
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """Converts an embeddings JSON file from the command line."""
+    from .setup_logging import setup_logging
+    from .utils import load_config
+
+    parser = argparse.ArgumentParser(description="Convert an embeddings JSON file into a memory-mapped store")
+    parser.add_argument('embeddings', type=Path, nargs='?', default=Path('data/embeddings.json'))
+    parser.add_argument('--output', type=Path, help="Store directory (default: next to the JSON file, "
+                                                     "e.g. data/embeddings.store)")
+    parser.add_argument('--config', default='config.yaml')
+    parser.add_argument('--dedup', type=float, metavar='THRESHOLD',
+                        help="Collapse near-duplicate chunks at this estimated Jaccard similarity "
+                             "(default: embedding.dedup)")
+    parser.add_argument('--codec', choices=CODECS,
+                        help="Compression of the chunk texts (default: zstd if zstandard is installed, else zlib)")
+    args = parser.parse_args(argv)
+
+    setup_logging()
+    embedding = load_config(args.config).get('embedding', {}) or {}
+    dedup = embedding.get('dedup', {}) or {}
+    threshold = args.dedup if args.dedup is not None else (dedup.get('threshold', 0.8) if dedup.get('enabled') else None)
+    deduplicator = (MinHashDeduplicator(threshold, num_perm=dedup.get('num_perm', 96), bands=dedup.get('bands', 16),
+                                        shingle_words=dedup.get('shingle_words', 5)) if threshold else None)
+    target = convert_embeddings_json(args.embeddings, args.output, embedding.get('chunk_size', 5000),
+                                     embedding.get('chunk_overlap', 200), deduplicator, args.codec)
+    console.print(f"[green]✓[/green] Embedding store written to {target}")
+
+
+if __name__ == '__main__':
+    main()
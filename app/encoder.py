@@ -0,0 +1,225 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# Set up a logger for this module.
+logger = logging.getLogger('encoder')
+logger.info("Encoder module initialized")
+
+# The sentence transformer used for queries, sentences and evaluation.
+ENCODER_MODEL = 'all-mpnet-base-v2'
+
+# Backends that get_encoder() can load the model with.
+BACKENDS = ('torch', 'onnx')
+
+_encoder: Optional[Any] = None
+
+# Whether _encoder was loaded by get_encoder() (rather than installed with set_encoder()).
+_loaded_model = False
+
+# How the shared encoder is loaded and wrapped (see configure_encoder).
+_encoder_options: Dict[str, Any] = {'backend': 'torch', 'onnx': {}, 'batching': False, 'max_batch': 32,
+                                    'max_wait_ms': 2}
+
+
+class BatchingEncoder:
+    """Combines concurrent encode calls into one batched call of the wrapped encoder.
+
+    A call that arrives while other callers are waiting joins their batch.
+    The batch is encoded as soon as every waiting caller has joined,
+    `max_batch` texts are collected, or the first call has waited
+    `max_wait` seconds. A caller that is alone is encoded without waiting,
+    so single sessions see no added latency.
+    """
+
+    def __init__(self, encoder: Any, max_batch: int = 32, max_wait: float = 0.002):
+        self.encoder = encoder
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.batches = 0
+        self.texts = 0
+        self._queue: "queue.Queue[Optional[Tuple[List[str], Future]]]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._waiting = 0
+        self._closed = False
+        self._thread: Optional[threading.Thread] = None
+
+    def encode(self, texts: Sequence[str], **kwargs) -> np.ndarray:
+        """Encodes texts like the wrapped encoder.
+
+        Calls with extra keyword arguments, and calls that fill a batch on
+        their own, go straight to the wrapped encoder, as do all calls
+        after close().
+        """
+        texts = list(texts)
+        if kwargs or not texts or len(texts) >= self.max_batch:
+            return self.encoder.encode(texts, **kwargs)
+        future: Future = Future()
+        with self._lock:
+            if self._closed:
+                return self.encoder.encode(texts)
+            self._waiting += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='batching-encoder', daemon=True)
+                self._thread.start()
+            # Queued under the lock, so every call is ahead of the stop that close() queues
+            self._queue.put((texts, future))
+        return future.result()
+
+    def close(self) -> None:
+        """Stops the batching thread once the queued calls are encoded.
+
+        Calls made afterwards go straight to the wrapped encoder.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            thread = self._thread
+            if thread is not None:
+                self._queue.put(None)
+        if thread is not None:
+            thread.join()
+
+    def _run(self) -> None:
+        while True:
+            request = self._queue.get()
+            if request is None:
+                return
+            batch = [request]
+            size = len(request[0])
+            deadline = time.perf_counter() + self.max_wait
+            while size < self.max_batch:
+                try:
+                    request = self._queue.get_nowait()
+                except queue.Empty:
+                    # Wait only for callers that have entered encode() but not queued yet
+                    with self._lock:
+                        others = self._waiting - len(batch)
+                    remaining = deadline - time.perf_counter()
+                    if others <= 0 or remaining <= 0:
+                        break
+                    try:
+                        request = self._queue.get(timeout=remaining)
+                    except queue.Empty:
+                        break
+                if request is None:
+                    self._queue.put(None)
+                    break
+                batch.append(request)
+                size += len(request[0])
+            self._encode(batch)
+
+    def _encode(self, batch: List[Tuple[List[str], Future]]) -> None:
+        texts = [text for request_texts, _ in batch for text in request_texts]
+        self.batches += 1
+        self.texts += len(texts)
+        try:
+            embeddings = np.asarray(self.encoder.encode(texts))
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+        else:
+            offset = 0
+            for request_texts, future in batch:
+                future.set_result(embeddings[offset:offset + len(request_texts)])
+                offset += len(request_texts)
+        finally:
+            with self._lock:
+                self._waiting -= len(batch)
+        logger.debug(f"Encoded {len(texts)} texts from {len(batch)} calls in one batch")
+
+
+def _wrap(encoder: Any) -> Any:
+    """Applies the configured batching to an encoder."""
+    if not _encoder_options['batching'] or isinstance(encoder, BatchingEncoder):
+        return encoder
+    return BatchingEncoder(encoder, _encoder_options['max_batch'], _encoder_options['max_wait_ms'] / 1000)
+
+
+def configure_encoder(encoder_config: Optional[Dict[str, Any]]) -> None:
+    """Sets how the shared encoder is loaded and batches calls, from the `encoder` config section.
+
+    Args:
+        encoder_config: 'backend' ('torch' or 'onnx', with the 'onnx' settings of
+            onnx_encoder.load_onnx_encoder); 'batching' turns on micro-batching of concurrent
+            calls (see BatchingEncoder), with 'max_batch' and 'max_wait_ms'. Missing keys take
+            their defaults.
+    """
+    global _encoder, _loaded_model
+    encoder_config = encoder_config or {}
+    backend = encoder_config.get('backend') or 'torch'
+    if backend not in BACKENDS:
+        logger.warning(f"Unknown encoder backend '{backend}', using torch")
+        backend = 'torch'
+    options = {
+        'backend': backend,
+        'onnx': dict(encoder_config.get('onnx') or {}),
+        'batching': bool(encoder_config.get('batching', False)),
+        'max_batch': int(encoder_config.get('max_batch') or 32),
+        'max_wait_ms': float(encoder_config.get('max_wait_ms', 2)),
+    }
+    if options == _encoder_options:
+        return
+    reload = _loaded_model and (options['backend'], options['onnx']) != (_encoder_options['backend'],
+                                                                           _encoder_options['onnx'])
+    _encoder_options.update(options)
+    previous = _encoder
+    if reload:
+        # Loaded again, with the new backend, on next use
+        _encoder, _loaded_model = None, False
+    elif previous is not None:
+        _encoder = _wrap(previous.encoder if isinstance(previous, BatchingEncoder) else previous)
+    _close_replaced(previous)
+
+
+def get_encoder() -> Any:
+    """Returns the shared sentence encoder, loading it on first use.
+
+    All modules encode text through this one instance, so the model is
+    loaded once per process. Anything with a sentence-transformers style
+    `encode(texts)` method can be installed instead with set_encoder().
+    """
+    global _encoder, _loaded_model
+    if _encoder is None:
+        _encoder = _wrap(_load_model())
+        _loaded_model = True
+    return _encoder
+
+
+def _load_model() -> Any:
+    if _encoder_options['backend'] == 'onnx':
+        try:
+            from .onnx_encoder import load_onnx_encoder
+            return load_onnx_encoder(ENCODER_MODEL, _encoder_options['onnx'])
+        except (ImportError, OSError, ValueError) as e:
+            logger.warning(f"ONNX encoder not available ({e}), using PyTorch")
+    from sentence_transformers import SentenceTransformer
+    logger.info(f"Loading sentence encoder {ENCODER_MODEL}")
+    return SentenceTransformer(ENCODER_MODEL)
+
+
+def set_encoder(encoder: Any) -> None:
+    """Replaces the shared sentence encoder (pass None to go back to the default model).
+
+    The configured batching is applied to the new encoder.
+    """
+    global _encoder, _loaded_model
+    previous = _encoder
+    _encoder = _wrap(encoder) if encoder is not None else None
+    _loaded_model = False
+    _close_replaced(previous)
+
+
+def _close_replaced(previous: Any) -> None:
+    """Stops the batching thread of a replaced shared encoder.
+
+    Anyone still holding the old wrapper keeps encoding, without batching.
+    """
+    if isinstance(previous, BatchingEncoder) and previous is not _encoder:
+        previous.close()
@@ -2,7 +2,6 @@ import logging
 from typing import Optional
 from pathlib import Path
 from datetime import datetime
-import markdown
 
 # Set up a logger for this module.
 logger = logging.getLogger('export')
@@ -23,6 +22,9 @@ def export_story(text: str, format: str = "txt", filename: Optional[str] = None)
 
     filepath = Path(__file__).parent / filename
 
+    if format in ("md", "html"):
+        import markdown
+
     try:
         with open(filepath, 'w') as f:
             if format == "txt":
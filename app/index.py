@@ -0,0 +1,766 @@
+import logging
+import os
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .metrics import record_cache, span
+
+# Set up a logger for this module.
+logger = logging.getLogger('index')
+logger.info("Index module initialized")
+
+# Metadata key derived from the file path, so queries can be limited to one
+# book or folder without extra metadata.
+DIRECTORY_KEY = 'directory'
+
+# Storage precisions of the scanned matrix. Quantized matrices are scanned
+# for candidates, which are then re-scored with the full-precision rows.
+PRECISIONS = ('float32', 'float16', 'int8')
+
+# Rows of a quantized matrix converted to float32 at a time while scanning,
+# small enough for the converted block to stay in the CPU cache.
+_SCAN_BLOCK_ROWS = 2048
+
+# Smallest row capacity allocated when an index grows.
+_MIN_CAPACITY = 64
+
+# Most rows a PCA projection is fitted on; a random sample of larger indexes is used.
+_PROJECTION_SAMPLE_ROWS = 20000
+
+# Number of embeddings dictionaries whose index is kept by get_index().
+_INDEX_CACHE_SIZE = 4
+_index_cache: "OrderedDict[int, Tuple[Dict[str, Any], EmbeddingIndex]]" = OrderedDict()
+
+# How get_index() builds new indexes (see configure_index).
+_index_options: Dict[str, Any] = {'precision': 'float32', 'rescore_factor': 4, 'directory': None,
+                                  'compact_fraction': 0.25, 'coarse_sections': 0, 'section_chunks': 0,
+                                  'projection_dimensions': 0}
+
+
+def _ranges_for_files(file_ids: np.ndarray, file_offsets: np.ndarray) -> List[Tuple[int, int]]:
+    """Converts sorted file ids into merged (start, end) row ranges."""
+    file_ids = np.asarray(file_ids, dtype=np.int64)
+    starts, ends = file_offsets[file_ids], file_offsets[file_ids + 1]
+    nonempty = starts < ends
+    starts, ends = starts[nonempty], ends[nonempty]
+    if not len(starts):
+        return []
+    # A range continues while the next file starts where the previous one ended
+    breaks = np.flatnonzero(starts[1:] != ends[:-1]) + 1
+    range_starts = starts[np.concatenate(([0], breaks))]
+    range_ends = ends[np.concatenate((breaks - 1, [len(ends) - 1]))]
+    return list(zip(range_starts.tolist(), range_ends.tolist()))
+
+
+def _remove_file(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _quantize_int8(block: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Quantizes rows symmetrically to int8, with one scale per row."""
+    scales = np.maximum(np.abs(block).max(axis=1), 1e-12) / 127.0
+    quantized = np.rint(block / scales[:, None]).astype(np.int8)
+    return quantized, scales.astype(np.float32)
+
+
+def _normalize_rows(block: Any) -> np.ndarray:
+    block = np.asarray(block, dtype=np.float32)
+    return block / np.maximum(np.linalg.norm(block, axis=1, keepdims=True), 1e-12)
+
+
+def _fit_projection(rows: np.ndarray, dimensions: int, seed: int = 0) -> Tuple[np.ndarray, np.ndarray, float]:
+    """Fits a PCA projection to `dimensions` dimensions on (a sample of) the rows.
+
+    Returns:
+        (components, offset, retained). Rows are projected as `row @ components.T - offset`,
+        their centered projection; queries as `query @ components.T`. The mean's share of
+        a row's score is the same for all rows, so the ranking is unchanged. `retained` is
+        the share of the variance the projection keeps.
+    """
+    if len(rows) > _PROJECTION_SAMPLE_ROWS:
+        sample_rows = np.sort(np.random.default_rng(seed).choice(len(rows), _PROJECTION_SAMPLE_ROWS, replace=False))
+        rows = rows[sample_rows]
+    sample = np.asarray(rows, dtype=np.float64)
+    mean = sample.mean(axis=0)
+    centered = sample - mean
+    eigenvalues, eigenvectors = np.linalg.eigh(centered.T @ centered)
+    order = np.argsort(eigenvalues)[::-1][:dimensions]
+    components = np.ascontiguousarray(eigenvectors[:, order].T, dtype=np.float32)
+    retained = float(eigenvalues[order].sum() / max(eigenvalues.sum(), 1e-12))
+    return components, (mean @ components.T).astype(np.float32), retained
+
+
+def _project(block: np.ndarray, projection: Tuple[np.ndarray, np.ndarray]) -> np.ndarray:
+    components, offset = projection
+    return block @ components.T - offset
+
+
+def _allocate(precision: str, capacity: int, dimensions: int, directory: Optional[str],
+              scanned_dimensions: Optional[int] = None) -> Tuple[np.ndarray, Optional[np.ndarray], np.ndarray]:
+    """Allocates the row buffers of an index: (vectors, scales, full precision).
+
+    The scanned `vectors` have `scanned_dimensions` columns if the rows are
+    projected. The full-precision rows of a quantized or projected index go
+    to a memory-mapped temporary file, removed once no array refers to it
+    any more.
+    """
+    scanned_dimensions = scanned_dimensions or dimensions
+    vectors = np.empty((capacity, scanned_dimensions), dtype=np.dtype(precision))
+    if precision == 'float32' and scanned_dimensions == dimensions:
+        return vectors, None, vectors
+    scales = np.empty(capacity, dtype=np.float32) if precision == 'int8' else None
+    handle, path = tempfile.mkstemp(prefix='embeddings-', suffix='.npy', dir=directory)
+    os.close(handle)
+    full_precision = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(capacity, dimensions))
+    # Views share the underlying mmap, not the memmap array
+    weakref.finalize(full_precision.base, _remove_file, path)
+    return vectors, scales, full_precision
+
+
+def _store_rows(vectors: np.ndarray, scales: Optional[np.ndarray], full_precision: np.ndarray,
+                start: int, block: np.ndarray, projection: Optional[Tuple[np.ndarray, np.ndarray]] = None) -> None:
+    """Writes normalized float32 rows into the buffers of an index, projecting and quantizing them if needed."""
+    if full_precision is not vectors:
+        full_precision[start:start + len(block)] = block
+    _store_scanned(vectors, scales, start, block if projection is None else _project(block, projection))
+
+
+def _store_scanned(vectors: np.ndarray, scales: Optional[np.ndarray], start: int, block: np.ndarray) -> None:
+    end = start + len(block)
+    if scales is not None:
+        vectors[start:end], scales[start:end] = _quantize_int8(block)
+    else:
+        vectors[start:end] = block
+
+
+class EmbeddingIndex:
+    """A contiguous matrix of all chunk embeddings, partitioned by file.
+
+    The rows of each file are stored together: file f owns rows
+    `file_offsets[f]:file_offsets[f + 1]`. Metadata filters are resolved
+    through precomputed partitions, mapping each (key, value) pair to the
+    files carrying it, so a filtered query only scans the row ranges of the
+    matching files.
+
+    The scanned matrix `vectors` is float32, or quantized to float16 or int8
+    (with one scale per row in `scales`) to use 2x or 4x less memory. A
+    quantized index finds `rescore_factor` times more candidates than asked
+    for, then re-scores them exactly with the float32 rows in
+    `full_precision`, a memory-mapped file that is read on demand.
+
+    With `projection_dimensions` set, `vectors` holds the rows projected
+    onto their first principal components (fitted when the index is
+    built), and is scanned with queries projected by one matrix product.
+    The candidates are re-scored with the full rows, as for quantization,
+    which the projection can be combined with.
+
+    Files can be added and removed at runtime (see add and remove). The
+    arrays are views of larger buffers: new rows are written in place after
+    the last row, and the buffers double in size when full, so appending is
+    amortized constant time per row. Removed files stay in the buffers
+    until a compaction, started in the background once `compact_fraction`
+    of the rows are removed, copies the remaining rows into new buffers.
+    Searches work on the arrays as they were when the search started, so
+    they are not blocked by additions or compactions.
+
+    With `coarse_sections` set, a search first ranks the centroids of the
+    sections (whole files, or runs of `section_chunks` consecutive chunks
+    of a file) and then scans only the chunks of the best
+    `coarse_sections` sections per query. This is approximate: a chunk
+    unlike the rest of its section can be missed.
+    """
+
+    def __init__(self, vectors: np.ndarray, file_paths: List[str], file_offsets: np.ndarray,
+                 file_metadata: List[Dict[str, Any]], full_precision: Optional[np.ndarray] = None,
+                 scales: Optional[np.ndarray] = None, rescore_factor: int = 4,
+                 compact_fraction: float = 0.25, directory: Optional[str] = None, coarse_sections: int = 0,
+                 section_chunks: int = 0, projection: Optional[Tuple[np.ndarray, np.ndarray]] = None,
+                 projection_dimensions: int = 0):
+        self.vectors = vectors
+        self.file_paths = file_paths
+        self.file_offsets = file_offsets
+        self.file_metadata = file_metadata
+        self.full_precision = full_precision if full_precision is not None else vectors
+        self.scales = scales
+        self.rescore_factor = rescore_factor
+        self.compact_fraction = compact_fraction
+        self.directory = directory
+        self.coarse_sections = coarse_sections
+        self.section_chunks = section_chunks
+        # (components, offset) of the PCA projection of the scanned rows (see _fit_projection)
+        self.projection = projection
+        self.projection_dimensions = projection_dimensions
+        # Row buffers; vectors, scales and full_precision are views of their first rows
+        self._buffers = (self.vectors, self.scales, self.full_precision)
+        self._file_ids = {file_path: file_id for file_id, file_path in enumerate(file_paths)}
+        self._removed = np.zeros(len(file_paths), dtype=bool)
+        self.removed_rows = 0
+        self._lock = threading.Lock()
+        self._compaction: Optional[threading.Thread] = None
+        self.partitions: Dict[Tuple[str, str], List[int]] = {}
+        for file_id in range(len(file_paths)):
+            self._partition(file_id)
+        self._mean_vector: Optional[np.ndarray] = None
+        # (section offsets, section file ids, section centroids), built on the first coarse search
+        self._sections: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]] = None
+
+    @classmethod
+    def from_embeddings_dict(cls, embeddings_dict: Dict[str, Any], precision: str = 'float32',
+                             rescore_factor: int = 4, directory: Optional[str] = None,
+                             compact_fraction: float = 0.25, coarse_sections: int = 0,
+                             section_chunks: int = 0, projection_dimensions: int = 0) -> 'EmbeddingIndex':
+        """Builds the index from an embeddings dictionary.
+
+        Args:
+            embeddings_dict: A dictionary where keys are file paths and values are dictionaries containing 'chunk_embeddings' and optionally 'metadata'.
+            precision: The storage precision of the scanned matrix ('float32', 'float16' or 'int8').
+            rescore_factor: Candidates re-scored per requested result (quantized precisions only).
+            directory: Where the full-precision rows of a quantized index are stored
+                (default: the system temporary directory). The file is removed with the index.
+            compact_fraction: The share of removed rows at which a background compaction starts
+                (see remove).
+            coarse_sections: The number of sections whose chunks are scanned per query, chosen by
+                their centroids, or 0 to scan all chunks.
+            section_chunks: The most chunks per section, or 0 for one section per file.
+            projection_dimensions: The dimensions of the scanned rows after a PCA projection
+                fitted to the rows, or 0 to scan the rows as they are. Ignored unless it is below
+                the embedding dimensions and the number of rows.
+
+        Returns:
+            The index, with L2-normalized rows.
+        """
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown index precision '{precision}', expected one of {', '.join(PRECISIONS)}")
+        file_paths = list(embeddings_dict)
+        file_offsets = np.zeros(len(file_paths) + 1, dtype=np.int64)
+        file_metadata = []
+        dimensions = 0
+        for i, file_path in enumerate(file_paths):
+            data = embeddings_dict[file_path]
+            chunk_embeddings = data['chunk_embeddings']
+            file_offsets[i + 1] = file_offsets[i] + len(chunk_embeddings)
+            if not dimensions and len(chunk_embeddings):
+                dimensions = len(chunk_embeddings[0])
+            file_metadata.append(data.get('metadata') or {})
+
+        num_rows = int(file_offsets[-1])
+        if not num_rows:
+            precision = 'float32'
+        project = 0 < projection_dimensions < min(dimensions, num_rows)
+        vectors, scales, full_precision = _allocate(precision, num_rows, dimensions, directory,
+                                                    projection_dimensions if project else None)
+
+        # Normalize and store one file at a time, so only one float32 copy of each block exists
+        for i, file_path in enumerate(file_paths):
+            start, end = int(file_offsets[i]), int(file_offsets[i + 1])
+            if start == end:
+                continue
+            block = _normalize_rows(embeddings_dict[file_path]['chunk_embeddings'])
+            if project:
+                # Projected once all rows are in and the projection is fitted
+                full_precision[start:end] = block
+            else:
+                _store_rows(vectors, scales, full_precision, start, block)
+
+        projection = None
+        if project:
+            components, offset, retained = _fit_projection(full_precision, projection_dimensions)
+            projection = (components, offset)
+            for start in range(0, num_rows, _SCAN_BLOCK_ROWS):
+                _store_scanned(vectors, scales, start, _project(full_precision[start:start + _SCAN_BLOCK_ROWS],
+                                                                projection))
+            logger.info(f"Projected the embedding index from {dimensions} to {projection_dimensions} dimensions, "
+                        f"keeping {retained:.1%} of the variance")
+
+        if full_precision is not vectors:
+            # Write the rows out, so the OS can drop them from memory and page them in on demand
+            full_precision.flush()
+
+        index = cls(vectors, file_paths, file_offsets, file_metadata, full_precision, scales, rescore_factor,
+                    compact_fraction, directory, coarse_sections, section_chunks, projection, projection_dimensions)
+        logger.info(f"Built {precision} embedding index with {num_rows} chunks from {len(file_paths)} files "
+                    f"({index.memory_bytes() / 2**20:.1f} MiB in memory)")
+        return index
+
+    @property
+    def num_files(self) -> int:
+        """The number of files in the index (not counting removed ones)."""
+        return len(self._file_ids)
+
+    def __contains__(self, file_path: str) -> bool:
+        return file_path in self._file_ids
+
+    @property
+    def precision(self) -> str:
+        return self.vectors.dtype.name
+
+    @property
+    def quantized(self) -> bool:
+        return self.vectors.dtype != np.float32
+
+    @property
+    def approximate(self) -> bool:
+        """Whether the scanned rows are quantized or projected, so candidates are re-scored."""
+        return self.quantized or self.projection is not None
+
+    @property
+    def _scanned_dimensions(self) -> Optional[int]:
+        return len(self.projection[0]) if self.projection is not None else None
+
+    def memory_bytes(self) -> int:
+        """Returns the size of the in-memory matrix (without the memory-mapped full-precision rows)."""
+        return self.vectors.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def __len__(self) -> int:
+        """The number of stored rows, including the rows of removed files not compacted yet."""
+        return len(self.vectors)
+
+    def _partition(self, file_id: int) -> None:
+        """Adds a file to the partitions, which map every (metadata key, value) pair to the ids
+        of the files that carry it, in increasing order."""
+        entries = dict(self.file_metadata[file_id])
+        entries.setdefault(DIRECTORY_KEY, Path(self.file_paths[file_id]).parent.as_posix())
+        for key, value in entries.items():
+            for item in (value if isinstance(value, (list, tuple, set)) else [value]):
+                if isinstance(item, (str, int, float, bool)):
+                    self.partitions.setdefault((key, str(item)), []).append(file_id)
+
+    def files_matching(self, filters: Optional[Dict[str, Any]]) -> Optional[np.ndarray]:
+        """Resolves metadata filters to the ids of the matching files.
+
+        Args:
+            filters: A mapping of metadata key to a value or a list of accepted values. A file
+                matches if, for every key, it carries at least one of the accepted values
+                (for list-valued metadata such as 'tags', any element counts).
+
+        Returns:
+            The sorted ids of the matching files, or None when there are no filters.
+        """
+        if not filters:
+            return None
+        matching = None
+        for key, accepted in filters.items():
+            values = accepted if isinstance(accepted, (list, tuple, set)) else [accepted]
+            file_ids = [np.array(self.partitions.get((key, str(value)), []), dtype=np.int64) for value in values]
+            file_ids = np.unique(np.concatenate(file_ids)) if file_ids else np.zeros(0, dtype=np.int64)
+            matching = file_ids if matching is None else np.intersect1d(matching, file_ids)
+        if len(self._file_ids) < len(self.file_paths):
+            matching = matching[~self._removed[matching]]
+        return matching
+
+    def row_ranges(self, filters: Optional[Dict[str, Any]] = None) -> List[Tuple[int, int]]:
+        """Returns the (start, end) row ranges that a query with these filters has to scan."""
+        file_ids = self.files_matching(filters)
+        if file_ids is None:
+            if len(self._file_ids) < len(self.file_paths):
+                return _ranges_for_files(np.flatnonzero(~self._removed), self.file_offsets)
+            return [(0, len(self.vectors))] if len(self.vectors) else []
+        return _ranges_for_files(file_ids, self.file_offsets)
+
+    def mean_vector(self) -> np.ndarray:
+        """Returns the mean of all (normalized) rows, computed once.
+
+        Its dot product with a unit query is the query's average cosine similarity to all chunks.
+        """
+        if self._mean_vector is None:
+            with self._lock:
+                full_precision, ranges = self.full_precision, self.row_ranges()
+            total = np.zeros(full_precision.shape[1], dtype=np.float64)
+            rows = 0
+            for range_start, range_end in ranges:
+                for start in range(range_start, range_end, _SCAN_BLOCK_ROWS):
+                    end = min(start + _SCAN_BLOCK_ROWS, range_end)
+                    total += full_precision[start:end].sum(axis=0, dtype=np.float64)
+                    rows += end - start
+            self._mean_vector = (total / max(rows, 1)).astype(np.float32)
+        return self._mean_vector
+
+    def _sections_from(self, first_file: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Splits the rows of the files from `first_file` on into sections and computes their centroids.
+
+        Returns:
+            (offsets, file_ids, centroids): section s owns rows `offsets[s]:offsets[s + 1]` of
+            file `file_ids[s]`, and `centroids[s]` is the normalized mean of those rows.
+        """
+        file_offsets = self.file_offsets[first_file:]
+        starts, file_ids = [], []
+        for i in range(len(file_offsets) - 1):
+            start, end = int(file_offsets[i]), int(file_offsets[i + 1])
+            section_starts = range(start, end, self.section_chunks or max(end - start, 1))
+            starts.extend(section_starts)
+            file_ids.extend([first_file + i] * len(section_starts))
+        offsets = np.array(starts + [int(file_offsets[-1])], dtype=np.int64)
+        if not starts:
+            return offsets, np.zeros(0, dtype=np.int64), np.zeros((0, self.full_precision.shape[1]), dtype=np.float32)
+        # Sections are contiguous, so one pass sums them all; the normalized sum is the normalized mean
+        rows = self.full_precision[offsets[0]:offsets[-1]]
+        centroids = _normalize_rows(np.add.reduceat(rows, offsets[:-1] - offsets[0], axis=0))
+        return offsets, np.array(file_ids, dtype=np.int64), centroids
+
+    def _coarse_ranges(self, sections: Tuple[np.ndarray, np.ndarray, np.ndarray], allowed: np.ndarray,
+                       queries: np.ndarray, min_rows: int) -> Optional[List[Tuple[int, int]]]:
+        """Picks the `coarse_sections` allowed sections closest to each query.
+
+        Returns:
+            The row ranges of the sections picked for any of the queries, or None if all
+            allowed sections would be scanned anyway or they hold fewer than `min_rows` rows.
+        """
+        offsets, _, centroids = sections
+        candidates = np.flatnonzero(allowed)
+        if len(candidates) <= self.coarse_sections:
+            return None
+        with span('coarse_select', sections=len(candidates), queries=len(queries)) as attributes:
+            scores = centroids[candidates] @ queries.T
+            best = np.argpartition(-scores, self.coarse_sections - 1, axis=0)[:self.coarse_sections]
+            chosen = np.unique(candidates[best])
+            attributes['selected'] = len(chosen)
+        if int((offsets[chosen + 1] - offsets[chosen]).sum()) < min_rows:
+            return None
+        return _ranges_for_files(chosen, offsets)
+
+    def locate(self, rows: np.ndarray, layout: Optional[Tuple[List[str], np.ndarray]] = None) -> List[Tuple[str, int]]:
+        """Maps row numbers to (file_path, chunk_index) pairs.
+
+        `layout` is the (file_paths, file_offsets) the rows refer to; by default the current ones.
+        """
+        file_paths, file_offsets = layout or (self.file_paths, self.file_offsets)
+        file_ids = np.searchsorted(file_offsets, rows, side='right') - 1
+        return [(file_paths[file_id], int(row - file_offsets[file_id]))
+                for file_id, row in zip(file_ids, rows)]
+
+    def add(self, file_path: str, chunk_embeddings: Any, metadata: Optional[Dict[str, Any]] = None) -> None:
+        """Adds a file's chunk embeddings, replacing the file if it is already in the index.
+
+        The rows are normalized (and projected and quantized, if the index
+        is) and written after the last row; the buffers double in size when
+        full. The projection is not refitted: new files are projected with
+        the components fitted when the index was built.
+
+        Raises:
+            ValueError: If the embeddings do not have the dimensions of the index.
+        """
+        block = np.asarray(chunk_embeddings, dtype=np.float32)
+        block = _normalize_rows(block) if len(block) else block.reshape(0, self._buffers[2].shape[1])
+        with self._lock:
+            if file_path in self._file_ids:
+                self._remove(file_path)
+            count, dimensions = len(self.vectors), self._buffers[2].shape[1]
+            if len(block) and dimensions and block.shape[1] != dimensions:
+                raise ValueError(f"Embeddings of {file_path} have {block.shape[1]} dimensions, "
+                                 f"the index has {dimensions}")
+            if count + len(block) > len(self._buffers[0]) or (len(block) and not dimensions):
+                self._grow(count + len(block), block.shape[1])
+            _store_rows(*self._buffers, count, block, self.projection)
+
+            self._file_ids[file_path] = len(self.file_paths)
+            self.file_paths.append(file_path)
+            self.file_metadata.append(metadata or {})
+            self.file_offsets = np.append(self.file_offsets, count + len(block))
+            self._removed = np.append(self._removed, False)
+            self._partition(len(self.file_paths) - 1)
+            self._publish(count + len(block))
+            if self._sections is not None and not len(self._sections[1]):
+                # Built before there were any rows (or dimensions); rebuilt on the next coarse search
+                self._sections = None
+            elif self._sections is not None:
+                offsets, file_ids, centroids = self._sections
+                new_offsets, new_file_ids, new_centroids = self._sections_from(len(self.file_paths) - 1)
+                self._sections = (np.concatenate((offsets[:-1], new_offsets)),
+                                  np.concatenate((file_ids, new_file_ids)),
+                                  np.concatenate((centroids, new_centroids)))
+        logger.debug(f"Added {len(block)} chunks of {file_path} to the index")
+        self._maybe_compact()
+
+    def remove(self, file_path: str) -> bool:
+        """Removes a file from the index.
+
+        Its rows are skipped by searches from now on and dropped from the
+        buffers by the next compaction, which starts in the background once
+        `compact_fraction` of the rows belong to removed files.
+
+        Returns:
+            Whether the file was in the index.
+        """
+        with self._lock:
+            if file_path not in self._file_ids:
+                return False
+            self._remove(file_path)
+            self._publish(len(self.vectors))
+        logger.debug(f"Removed {file_path} from the index")
+        self._maybe_compact()
+        return True
+
+    def compact(self) -> None:
+        """Copies the rows of the files that were not removed into new, smaller buffers.
+
+        The rows are copied without holding the lock, so searches and
+        additions continue meanwhile; files added or removed during the copy
+        are carried over when the new buffers are swapped in.
+        """
+        with self._lock:
+            if len(self._file_ids) == len(self.file_paths):
+                return
+            buffers, file_offsets = self._buffers, self.file_offsets
+            file_count = len(self.file_paths)
+            live = np.flatnonzero(~self._removed)
+
+        # Copy the live files in runs of consecutive rows
+        sizes = file_offsets[live + 1] - file_offsets[live]
+        rows = int(sizes.sum())
+        new_buffers = _allocate(buffers[0].dtype.name, max(rows + rows // 2, _MIN_CAPACITY),
+                                buffers[2].shape[1], self.directory, self._scanned_dimensions)
+        copied = 0
+        for start, end in _ranges_for_files(live, file_offsets):
+            self._copy_rows(buffers, new_buffers, start, end, copied)
+            copied += end - start
+        new_offsets = np.concatenate(([0], np.cumsum(sizes))).astype(np.int64)
+
+        with self._lock:
+            # Files added during the copy are appended; files removed during it stay removed
+            new_ids = list(live) + list(range(file_count, len(self.file_paths)))
+            added = range(file_count, len(self.file_paths))
+            if len(added):
+                start, end = int(self.file_offsets[file_count]), int(self.file_offsets[-1])
+                if copied + end - start > len(new_buffers[0]):
+                    new_buffers = self._grown(new_buffers, copied, copied + end - start)
+                self._copy_rows(self._buffers, new_buffers, start, end, copied)
+                new_offsets = np.concatenate((new_offsets, self.file_offsets[file_count + 1:] - start + copied))
+
+            self._buffers = new_buffers
+            self.file_paths = [self.file_paths[file_id] for file_id in new_ids]
+            self.file_metadata = [self.file_metadata[file_id] for file_id in new_ids]
+            self.file_offsets = new_offsets
+            self._removed = self._removed[new_ids]
+            self._file_ids = {file_path: file_id for file_id, file_path in enumerate(self.file_paths)
+                              if not self._removed[file_id]}
+            sizes = np.diff(new_offsets)
+            self.removed_rows = int(sizes[self._removed].sum())
+            self.partitions = {}
+            for file_id in range(len(self.file_paths)):
+                self._partition(file_id)
+            self._sections = None
+            self._publish(int(new_offsets[-1]))
+        logger.info(f"Compacted the embedding index to {new_offsets[-1]} rows of {self.num_files} files")
+
+    def _remove(self, file_path: str) -> None:
+        file_id = self._file_ids.pop(file_path)
+        self._removed[file_id] = True
+        self.removed_rows += int(self.file_offsets[file_id + 1] - self.file_offsets[file_id])
+
+    def _publish(self, count: int) -> None:
+        """Points the arrays at the first `count` rows of the buffers and refreshes what depends on them."""
+        vectors, scales, full_precision = self._buffers
+        self.vectors = vectors[:count]
+        self.scales = scales[:count] if scales is not None else None
+        self.full_precision = full_precision[:count] if full_precision is not vectors else self.vectors
+        self._mean_vector = None
+
+    def _grow(self, rows: int, dimensions: int) -> None:
+        self._buffers = self._grown(self._buffers, len(self.vectors), rows, dimensions)
+
+    def _grown(self, buffers: Tuple[np.ndarray, Optional[np.ndarray], np.ndarray], count: int, rows: int,
+               dimensions: Optional[int] = None) -> Tuple[np.ndarray, Optional[np.ndarray], np.ndarray]:
+        """Returns buffers with room for at least `rows` rows (at least twice the old capacity) holding the first `count` rows."""
+        dimensions = dimensions or buffers[2].shape[1]
+        capacity = max(rows, 2 * len(buffers[0]), _MIN_CAPACITY)
+        new_buffers = _allocate(buffers[0].dtype.name, capacity, dimensions, self.directory,
+                                self._scanned_dimensions)
+        # Buffers of an index built without rows have no width yet; there is nothing to copy
+        if count and buffers[2].shape[1]:
+            self._copy_rows(buffers, new_buffers, 0, count, 0)
+        logger.debug(f"Grew the embedding index buffers to {capacity} rows")
+        return new_buffers
+
+    @staticmethod
+    def _copy_rows(source: Tuple[np.ndarray, Optional[np.ndarray], np.ndarray],
+                   target: Tuple[np.ndarray, Optional[np.ndarray], np.ndarray],
+                   start: int, end: int, target_start: int) -> None:
+        target_end = target_start + end - start
+        target[0][target_start:target_end] = source[0][start:end]
+        if source[1] is not None:
+            target[1][target_start:target_end] = source[1][start:end]
+        if source[2] is not source[0]:
+            target[2][target_start:target_end] = source[2][start:end]
+
+    def _maybe_compact(self) -> None:
+        """Starts a background compaction if enough rows are removed and none is running."""
+        with self._lock:
+            if (self.removed_rows <= self.compact_fraction * max(len(self.vectors), 1)
+                    or (self._compaction is not None and self._compaction.is_alive())):
+                return
+            self._compaction = threading.Thread(target=self.compact, name='index-compaction', daemon=True)
+            self._compaction.start()
+
+    @staticmethod
+    def _scan(vectors: np.ndarray, scales: Optional[np.ndarray], start: int, end: int,
+              queries: np.ndarray) -> np.ndarray:
+        """Scores the rows start:end against unit queries (approximately, if quantized or projected).
+
+        Returns:
+            A (rows, queries) score matrix.
+        """
+        if vectors.dtype == np.float32:
+            return vectors[start:end] @ queries.T
+        scores = np.empty((end - start, len(queries)), dtype=np.float32)
+        buffer = np.empty((min(_SCAN_BLOCK_ROWS, end - start), vectors.shape[1]), dtype=np.float32)
+        for block_start in range(start, end, _SCAN_BLOCK_ROWS):
+            block_end = min(block_start + _SCAN_BLOCK_ROWS, end)
+            block = buffer[:block_end - block_start]
+            np.copyto(block, vectors[block_start:block_end])
+            scores[block_start - start:block_end - start] = block @ queries.T
+        if scales is not None:
+            scores *= scales[start:end, None]
+        return scores
+
+    def search(self, query_embedding: np.ndarray, top_n: int = 3,
+               filters: Optional[Dict[str, Any]] = None) -> List[Tuple[str, int, float]]:
+        """Finds the chunks most similar to a query embedding.
+
+        Args:
+            query_embedding: The query vector.
+            top_n: The number of chunks to return.
+            filters: Optional metadata filters (see files_matching).
+
+        Returns:
+            A list of tuples, each containing (file_path, chunk_index, similarity_score), best first.
+            The scores are exact, also for a quantized or projected index.
+        """
+        return self.search_batch([query_embedding], top_n, filters)[0]
+
+    def search_batch(self, query_embeddings: Sequence[np.ndarray], top_n: int = 3,
+                     filters: Optional[Dict[str, Any]] = None) -> List[List[Tuple[str, int, float]]]:
+        """Finds the chunks most similar to each of several query embeddings.
+
+        All queries are scored in one matrix product, so the matrix is read
+        once per batch rather than once per query.
+
+        Returns:
+            One result list per query, as returned by search().
+        """
+        queries = np.asarray(query_embeddings, dtype=np.float32).reshape(len(query_embeddings), -1)
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+
+        # The arrays as they are now; later additions and compactions replace rather than change them
+        with self._lock:
+            vectors, scales, full_precision = self.vectors, self.scales, self.full_precision
+            projection = self.projection
+            layout, ranges = (self.file_paths, self.file_offsets), self.row_ranges(filters)
+            sections = allowed = None
+            if self.coarse_sections > 0 and ranges:
+                if self._sections is None:
+                    self._sections = self._sections_from(0)
+                sections = self._sections
+                file_ids = self.files_matching(filters)
+                allowed = ~self._removed[sections[1]]
+                if file_ids is not None:
+                    allowed &= np.isin(sections[1], file_ids)
+        if not ranges or top_n <= 0 or not len(queries):
+            return [[] for _ in range(len(queries))]
+        approximate = vectors.dtype != np.float32 or projection is not None
+        num_candidates = top_n * max(self.rescore_factor, 1) if approximate else top_n
+        if sections is not None:
+            ranges = self._coarse_ranges(sections, allowed, queries, num_candidates) or ranges
+        scanned_queries = queries if projection is None else queries @ projection[0].T
+        with span('corpus_scan', precision=vectors.dtype.name, dimensions=vectors.shape[1],
+                  queries=len(queries)) as attributes:
+            scores = np.concatenate([self._scan(vectors, scales, start, end, scanned_queries)
+                                     for start, end in ranges])
+
+            if len(scores) > num_candidates:
+                best = np.argpartition(-scores, num_candidates - 1, axis=0)[:num_candidates]
+            else:
+                best = np.repeat(np.arange(len(scores))[:, None], len(queries), axis=1)
+            attributes['chunks'] = len(scores)
+
+        # Map positions in the concatenated scores back to matrix rows
+        starts = np.array([start for start, _ in ranges], dtype=np.int64)
+        positions = np.cumsum([0] + [end - start for start, end in ranges])
+        range_ids = np.searchsorted(positions, best, side='right') - 1
+        rows = starts[range_ids] + (best - positions[range_ids])
+        best_scores = np.take_along_axis(scores, best, axis=0)
+
+        if approximate:
+            with span('rescore', candidates=rows.size):
+                # Read the candidates' full-precision rows in file order
+                for column, query in enumerate(queries):
+                    order = np.argsort(rows[:, column])
+                    rows[:, column] = rows[order, column]
+                    best_scores[:, column] = np.asarray(full_precision[rows[:, column]],
+                                                        dtype=np.float32) @ query
+
+        results = []
+        for column in range(len(queries)):
+            ranking = np.argsort(-best_scores[:, column], kind='stable')[:top_n]
+            column_rows, column_scores = rows[ranking, column], best_scores[ranking, column]
+            results.append([(file_path, chunk_idx, float(score)) for (file_path, chunk_idx), score
+                            in zip(self.locate(column_rows, layout), column_scores)])
+
+        logger.debug(f"Scanned {len(scores)} of {len(vectors)} chunks for {len(queries)} queries")
+        return results
+
+
+def configure_index(index_config: Optional[Dict[str, Any]]) -> None:
+    """Sets how get_index() builds indexes, from the `retrieval.index` config section.
+
+    Args:
+        index_config: 'precision' ('float32', 'float16' or 'int8'), 'rescore_factor', 'directory',
+            'compact_fraction', 'coarse_sections', 'section_chunks' and 'projection_dimensions' (see
+            EmbeddingIndex.from_embeddings_dict). Missing keys take their defaults.
+    """
+    index_config = index_config or {}
+    precision = index_config.get('precision') or 'float32'
+    if precision not in PRECISIONS:
+        logger.warning(f"Unknown index precision '{precision}', using float32")
+        precision = 'float32'
+    _index_options.update(precision=precision,
+                          rescore_factor=int(index_config.get('rescore_factor') or 4),
+                          directory=index_config.get('directory'),
+                          compact_fraction=float(index_config.get('compact_fraction', 0.25)),
+                          coarse_sections=int(index_config.get('coarse_sections') or 0),
+                          section_chunks=int(index_config.get('section_chunks') or 0),
+                          projection_dimensions=int(index_config.get('projection_dimensions') or 0))
+
+
+def get_index(embeddings_dict: Dict[str, Any]) -> EmbeddingIndex:
+    """Returns the index of an embeddings dictionary, building it on first use.
+
+    Indexes of the most recently used dictionaries are kept, so the matrix
+    is built once per loaded embeddings file rather than once per query.
+    An index built with other options than the configured ones is rebuilt,
+    and so is an index whose file count no longer matches the dictionary.
+    To change the dictionary without a rebuild, update its index with
+    EmbeddingIndex.add and remove (see semantic_search.add_document).
+    """
+    key = id(embeddings_dict)
+    cached = _index_cache.get(key)
+    if (cached is not None and cached[0] is embeddings_dict and cached[1].num_files == len(embeddings_dict)
+            and (cached[1].precision == _index_options['precision'] or not len(cached[1]))
+            and cached[1].projection_dimensions == _index_options['projection_dimensions']):
+        _index_cache.move_to_end(key)
+        cached[1].rescore_factor = _index_options['rescore_factor']
+        cached[1].compact_fraction = _index_options['compact_fraction']
+        cached[1].coarse_sections = _index_options['coarse_sections']
+        if cached[1].section_chunks != _index_options['section_chunks']:
+            with cached[1]._lock:
+                cached[1].section_chunks = _index_options['section_chunks']
+                cached[1]._sections = None
+        record_cache('embedding_index', True)
+        return cached[1]
+
+    record_cache('embedding_index', False)
+    with span('index_build'):
+        index = EmbeddingIndex.from_embeddings_dict(embeddings_dict, **_index_options)
+    _index_cache[key] = (embeddings_dict, index)
+    _index_cache.move_to_end(key)
+    while len(_index_cache) > _INDEX_CACHE_SIZE:
+        _index_cache.popitem(last=False)
+    return index
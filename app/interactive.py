@@ -6,7 +6,6 @@ from pathlib import Path
 from rich.console import Console
 from rich.prompt import Prompt
 from rich.panel import Panel
-import google.generativeai as genai
 
 from .utils import (
     load_config,
@@ -14,6 +13,7 @@ from .utils import (
     resolve_data_path,
     StoryGenerator
 )
+from .memory import accepted_chapters
 from .plot import PlotGenerator
 
 # Set up a logger for this module.
@@ -28,9 +28,16 @@ def interactive_loop(
     session_history: list,
     current_settings: dict,
 ):
-    """Main loop for the interactive story generation."""
+    """Main loop for the interactive story generation.
+
+    Queries, generated chapters and settings are appended to a session
+    journal as they happen (see session.SessionJournal), so saving only
+    writes a snapshot.
+    """
     plot_outline = ""
     chapter_counter = 0
+    journal = story_gen.new_session()
+    memory = story_gen.new_memory()
 
     use_outline = Prompt.ask(
         "Generate a plot outline? (yes/no)", choices=["yes", "no"], default="no"
@@ -69,8 +76,10 @@ def interactive_loop(
             "Enter your story query (or type 'exit' to quit, 'new chapter' for next chapter based on outline)"
         )
         session_history.append({"type": "query", "content": query})
+        journal.append("query", content=query)
 
         if query.lower() == "exit":
+            journal.close()
             break
 
         if query.lower() == "new chapter":
@@ -166,6 +175,9 @@ def interactive_loop(
             character = current_settings.get("character", "")
             situation = current_settings.get("situation", "")
 
+        journal.update_state(settings=current_settings, plot_outline=plot_outline,
+                             chapter_counter=chapter_counter)
+
         previous_attempt = None
         refine = True
         generated_text = None
@@ -181,6 +193,7 @@ def interactive_loop(
                     situation=situation,
                     style_prompt=style_prompt,
                     plot_outline=plot_outline,
+                    memory=memory,
                 )
 
                 if result:
@@ -195,6 +208,7 @@ def interactive_loop(
                     session_history.append(
                         {"type": "generation", "content": generated_text}
                     )
+                    journal.append("generation", content=generated_text)
                     refine_choice = Prompt.ask(
                         "Do you want to refine the story? (yes/no)",
                         choices=["yes", "no"],
@@ -214,41 +228,58 @@ def interactive_loop(
                 logger.exception("Error during story generation")
                 refine = False
 
+        # The last draft is the accepted chapter
+        if generated_text and memory is not None:
+            try:
+                memory.add_chapter(generated_text)
+                journal.update_state(story_memory=memory.state())
+            except Exception as e:
+                console.print(f"[yellow]Could not add the chapter to the story memory: {e}[/yellow]")
+                logger.exception("Error updating story memory")
+
         action = Prompt.ask(
             "Do you want to [save] the session, [load] a session, [export] the story, or [exit]?",
             choices=["save", "load", "export", "exit"],
         )
         if action == "save":
-            session_data = {
-                "settings": current_settings,
-                "plot_outline": plot_outline,
-                "chapter_counter": chapter_counter,
-                "history": session_history,
-            }
             try:
-                story_gen.save_session(session_data)
+                journal.update_state(settings=current_settings, plot_outline=plot_outline,
+                                     chapter_counter=chapter_counter)
+                journal.snapshot()
+                console.print(f"Session saved to {journal.directory}")
             except Exception as e:
                 console.print(
                     f"[bold red]Error saving session: {e}[/bold red]"
                 )
                 logger.exception("Error saving session")
         elif action == "load":
-            load_filename = Prompt.ask("Enter the filename to load")
+            load_filename = Prompt.ask("Enter the session to load")
             try:
-                session_data = story_gen.load_session(load_filename)
-                if session_data:
-                    current_settings = session_data.get("settings", {})
-                    plot_outline = session_data.get("plot_outline", "")
-                    chapter_counter = session_data.get("chapter_counter", 0)
-                    session_history.extend(session_data.get("history", []))
-                    console.print(f"Session loaded from {load_filename}")
-                else:
-                    console.print(
-                        "[yellow]No session data found in the loaded file.[/yellow]"
-                    )
+                loaded = story_gen.resume_session(load_filename)
+                journal.close()
+                journal = loaded
+                current_settings = dict(journal.settings)
+                plot_outline = journal.plot_outline
+                chapter_counter = journal.chapter_counter
+                # Only the last chapters are read; journal.history reads older ones on access
+                recent = journal.recent_history()
+                session_history.extend(recent)
+                memory = story_gen.new_memory()
+                if memory is not None:
+                    chapters = accepted_chapters(recent)
+                    if journal.story_memory:
+                        # Older chapters are remembered through the restored summary
+                        memory.restore(journal.story_memory)
+                        first = max(memory.chapters - len(chapters), 0) + 1
+                        for number, chapter in enumerate(chapters, start=first):
+                            memory.index_chapter(chapter, number)
+                    else:
+                        for chapter in chapters:
+                            memory.add_chapter(chapter)
+                console.print(f"Session loaded from {journal.directory}")
             except FileNotFoundError:
                 console.print(
-                    f"[bold red]Error: Session file not found: {
+                    f"[bold red]Error: Session not found: {
                         load_filename}[/bold red]"
                 )
             except json.JSONDecodeError as e:
@@ -0,0 +1,217 @@
+import logging
+import math
+import re
+from collections import Counter
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+from .text_processing import chunk_text
+
+# Set up a logger for this module.
+logger = logging.getLogger('lexical_index')
+logger.info("Lexical index module initialized")
+
+_WORD_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    """Splits text into lowercase word tokens for lexical matching."""
+    return _WORD_PATTERN.findall(text.lower())
+
+
+def _encode_strings(strings: List[str]) -> np.ndarray:
+    """Packs a list of strings (without newlines) into a UTF-8 byte array."""
+    return np.frombuffer("\n".join(strings).encode('utf-8'), dtype=np.uint8)
+
+
+def _decode_strings(data: np.ndarray) -> List[str]:
+    """Unpacks a byte array written by _encode_strings."""
+    text = data.tobytes().decode('utf-8')
+    return text.split("\n") if text else []
+
+
+class BM25Index:
+    """An Okapi BM25 inverted index over chunk text.
+
+    Postings are stored in compressed sparse row form: the documents
+    (chunks) containing term t are `doc_ids[offsets[t]:offsets[t + 1]]`, with
+    the matching term frequencies in `term_freqs`. Chunks are identified by
+    (file_path, chunk_index), like the results of semantic_search.
+    """
+
+    def __init__(self, vocabulary: List[str], offsets: np.ndarray, doc_ids: np.ndarray,
+                 term_freqs: np.ndarray, doc_lengths: np.ndarray, file_paths: List[str],
+                 chunk_files: np.ndarray, chunk_indices: np.ndarray, k1: float = 1.5, b: float = 0.75):
+        self.vocabulary = vocabulary
+        self.term_ids = {term: i for i, term in enumerate(vocabulary)}
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.term_freqs = term_freqs
+        self.doc_lengths = doc_lengths
+        self.file_paths = file_paths
+        self.chunk_files = chunk_files
+        self.chunk_indices = chunk_indices
+        self.k1 = k1
+        self.b = b
+        self.average_length = float(doc_lengths.mean()) if len(doc_lengths) else 0.0
+
+    @classmethod
+    def build(cls, embeddings_dict: Dict[str, Any]) -> 'BM25Index':
+        """Builds the index from the chunk text of an embeddings dictionary.
+
+        Args:
+            embeddings_dict: A dictionary where keys are file paths and values are dictionaries containing 'content' and (optionally) 'chunk_content'.
+
+        Returns:
+            The BM25 index.
+        """
+        file_paths = []
+        chunk_files = []
+        chunk_indices = []
+        doc_lengths = []
+        postings: Dict[str, List[Tuple[int, int]]] = {}
+
+        for file_path, data in embeddings_dict.items():
+            file_id = len(file_paths)
+            file_paths.append(file_path)
+            chunks = data['chunk_content'] if 'chunk_content' in data else chunk_text(data['content'])
+            for chunk_idx, chunk in enumerate(chunks):
+                doc_id = len(doc_lengths)
+                tokens = tokenize(chunk)
+                chunk_files.append(file_id)
+                chunk_indices.append(chunk_idx)
+                doc_lengths.append(len(tokens))
+                for term, freq in Counter(tokens).items():
+                    postings.setdefault(term, []).append((doc_id, freq))
+
+        vocabulary = sorted(postings)
+        offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        for i, term in enumerate(vocabulary):
+            offsets[i + 1] = offsets[i] + len(postings[term])
+        doc_ids = np.empty(offsets[-1], dtype=np.int32)
+        term_freqs = np.empty(offsets[-1], dtype=np.uint16)
+        for i, term in enumerate(vocabulary):
+            entries = np.array(postings[term], dtype=np.int64).reshape(-1, 2)
+            doc_ids[offsets[i]:offsets[i + 1]] = entries[:, 0]
+            term_freqs[offsets[i]:offsets[i + 1]] = np.minimum(entries[:, 1], np.iinfo(np.uint16).max)
+
+        logger.info(f"Built BM25 index over {len(doc_lengths)} chunks with {len(vocabulary)} terms")
+        return cls(vocabulary, offsets, doc_ids, term_freqs, np.array(doc_lengths, dtype=np.int32),
+                   file_paths, np.array(chunk_files, dtype=np.int32), np.array(chunk_indices, dtype=np.int32))
+
+    def __len__(self) -> int:
+        return len(self.doc_lengths)
+
+    def scores(self, query: str) -> np.ndarray:
+        """Computes the BM25 score of every chunk for a query.
+
+        Args:
+            query: The query string.
+
+        Returns:
+            A float32 array with one score per chunk (0 for chunks sharing no term with the query).
+        """
+        scores = np.zeros(len(self.doc_lengths), dtype=np.float32)
+        if not len(scores):
+            return scores
+        num_docs = len(self.doc_lengths)
+        length_norm = self.k1 * (1 - self.b + self.b * self.doc_lengths / max(self.average_length, 1e-9))
+        for term in set(tokenize(query)):
+            term_id = self.term_ids.get(term)
+            if term_id is None:
+                continue
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            docs = self.doc_ids[start:end]
+            freqs = self.term_freqs[start:end].astype(np.float32)
+            doc_freq = end - start
+            idf = math.log(1 + (num_docs - doc_freq + 0.5) / (doc_freq + 0.5))
+            scores[docs] += idf * freqs * (self.k1 + 1) / (freqs + length_norm[docs])
+        return scores
+
+    def search(self, query: str, top_n: int = 3,
+               allowed_files: Optional[Set[str]] = None) -> List[Tuple[str, int, float]]:
+        """Finds the chunks with the highest BM25 scores for a query.
+
+        Args:
+            query: The query string.
+            top_n: The number of chunks to return.
+            allowed_files: If given, only chunks of these files are returned.
+
+        Returns:
+            A list of tuples, each containing (file_path, chunk_index, bm25_score), best first.
+            Chunks that share no term with the query are not returned.
+        """
+        scores = self.scores(query)
+        if allowed_files is not None:
+            allowed_ids = [i for i, file_path in enumerate(self.file_paths) if file_path in allowed_files]
+            scores[~np.isin(self.chunk_files, allowed_ids)] = 0
+        matching = np.flatnonzero(scores > 0)
+        if len(matching) > top_n:
+            matching = matching[np.argpartition(-scores[matching], top_n - 1)[:top_n]]
+        matching = matching[np.argsort(-scores[matching], kind='stable')]
+        return [(self.file_paths[self.chunk_files[doc]], int(self.chunk_indices[doc]), float(scores[doc]))
+                for doc in matching]
+
+    def save(self, path: Path) -> None:
+        """Saves the index to a compressed .npz file."""
+        np.savez_compressed(
+            path,
+            vocabulary=_encode_strings(self.vocabulary),
+            offsets=self.offsets,
+            doc_ids=self.doc_ids,
+            term_freqs=self.term_freqs,
+            doc_lengths=self.doc_lengths,
+            file_paths=_encode_strings(self.file_paths),
+            chunk_files=self.chunk_files,
+            chunk_indices=self.chunk_indices,
+            parameters=np.array([self.k1, self.b]),
+        )
+        logger.info(f"BM25 index saved to {path}")
+
+    @classmethod
+    def load(cls, path: Path) -> 'BM25Index':
+        """Loads an index saved with save()."""
+        with np.load(path) as data:
+            k1, b = data['parameters']
+            index = cls(_decode_strings(data['vocabulary']), data['offsets'], data['doc_ids'],
+                        data['term_freqs'], data['doc_lengths'], _decode_strings(data['file_paths']),
+                        data['chunk_files'], data['chunk_indices'], float(k1), float(b))
+        logger.info(f"BM25 index loaded from {path}")
+        return index
+
+
+def lexical_index_path(embeddings_file: Path) -> Path:
+    """Returns where the BM25 index for an embeddings file is stored."""
+    embeddings_file = Path(embeddings_file)
+    return embeddings_file.with_name(embeddings_file.stem + '.bm25.npz')
+
+
+def load_or_build_lexical_index(embeddings_file: Path, embeddings_dict: Dict[str, Any],
+                                index_path: Optional[Path] = None) -> BM25Index:
+    """Loads the BM25 index stored next to an embeddings file, building and saving it if it is missing or stale.
+
+    Args:
+        embeddings_file: The embeddings file the index belongs to.
+        embeddings_dict: The loaded embeddings, used when the index has to be (re)built.
+        index_path: Where the index is stored. Defaults to lexical_index_path(embeddings_file).
+
+    Returns:
+        The BM25 index.
+    """
+    index_path = Path(index_path) if index_path else lexical_index_path(embeddings_file)
+    embeddings_file = Path(embeddings_file)
+    if index_path.exists() and (not embeddings_file.exists()
+                                or index_path.stat().st_mtime >= embeddings_file.stat().st_mtime):
+        try:
+            return BM25Index.load(index_path)
+        except Exception as e:
+            logger.warning(f"Could not load BM25 index from {index_path}, rebuilding: {e}")
+
+    index = BM25Index.build(embeddings_dict)
+    try:
+        index.save(index_path)
+    except OSError as e:
+        logger.warning(f"Could not save BM25 index to {index_path}: {e}")
+    return index
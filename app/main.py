@@ -1,11 +1,27 @@
 # Narr_ai_tive/app/main.py
+import argparse
+
 from .tui import main_menu
 from .setup_logging import setup_logging  # Import the function directly from the module
+from .profiling import PROFILERS
+
+def parse_args(argv=None) -> argparse.Namespace:
+    """Parses the command line options of the application."""
+    parser = argparse.ArgumentParser(description="Narrative AI Story Generator")
+    parser.add_argument(
+        "--profile", nargs="?", const="", default=None, choices=("",) + PROFILERS, metavar="PROFILER",
+        help="Profile every generation run (cprofile, sampling or pyinstrument; "
+             "default: profiling.engine from config.yaml)")
+    parser.add_argument(
+        "--stub-model", action="store_true",
+        help="Use an offline stand-in for the generative model (no API calls)")
+    return parser.parse_args(argv)
 
 def main():
     """Main function to run the TUI application."""
+    args = parse_args()
     setup_logging()  # Now this will work as expected
-    main_menu()
+    main_menu(args.profile, args.stub_model)
 
 if __name__ == "__main__":
     main()
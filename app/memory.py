@@ -0,0 +1,229 @@
+import logging
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .semantic_search import embed_texts
+from .text_processing import sentence_windows, split_sentences
+from .tokens import estimate_tokens
+
+if TYPE_CHECKING:
+    import google.generativeai as genai
+
+# Set up a logger for this module.
+logger = logging.getLogger('memory')
+logger.info("Memory module initialized")
+
+# How the rolling summary is updated after each chapter.
+SUMMARIZERS = ('extractive', 'model')
+
+# Share of the summary budget the newest chapter may take in an extractive summary.
+_NEW_CHAPTER_SHARE = 0.4
+
+# Tokens of the "(Chapter N)" label the prompt puts before each passage.
+_PASSAGE_LABEL_TOKENS = 4
+
+_SUMMARY_PROMPT = """Summary of the story so far:
+{summary}
+
+New chapter:
+{chapter}
+
+Rewrite the summary so it also covers the new chapter. Keep what later chapters depend on: \
+characters, places, events, promises and open threads. Use at most {words} words and write \
+only the summary."""
+
+
+class StoryMemory:
+    """Remembers the chapters of a session within a fixed token budget.
+
+    Two things are kept for every accepted chapter:
+
+    - A rolling summary, updated after each chapter. The 'extractive'
+      summarizer keeps the sentences closest to the gist of their chapter
+      and, once the summary is over budget, drops the older sentences
+      furthest from the gist of the whole summary. The 'model' summarizer
+      asks the generative model to rewrite the summary (one extra call per
+      chapter) and falls back to the extractive summary if the call fails.
+    - A session-local vector index of passages (sentence windows) of the
+      chapter, searched for the passages most similar to the next query.
+
+    recall() returns the summary and as many of the best passages as fit in
+    `passage_tokens`, so the memory part of a prompt stays the same size
+    however long the story grows.
+    """
+
+    def __init__(self, summary_tokens: int = 400, passage_tokens: int = 600, passage_words: int = 120,
+                 summarizer: str = 'extractive', model: Optional['genai.GenerativeModel'] = None):
+        if summarizer not in SUMMARIZERS:
+            raise ValueError(f"Unknown summarizer '{summarizer}', expected one of {', '.join(SUMMARIZERS)}")
+        self.summary_tokens = summary_tokens
+        self.passage_tokens = passage_tokens
+        self.passage_words = passage_words
+        self.summarizer = summarizer
+        self.model = model
+        self.chapters = 0
+        self.summary = ""
+        # Extractive summary: (chapter, sentence) pairs in story order, with their embeddings
+        self._summary_sentences: List[Tuple[int, str]] = []
+        self._summary_embeddings: Optional[np.ndarray] = None
+        # Passage index: a growing matrix and the (chapter, text) of each row
+        self._vectors: Optional[np.ndarray] = None
+        self._passages: List[Tuple[int, str]] = []
+
+    def __len__(self) -> int:
+        return len(self._passages)
+
+    def add_chapter(self, text: str) -> None:
+        """Indexes an accepted chapter and updates the summary with it."""
+        if not text or not text.strip():
+            return
+        self.chapters += 1
+        self.index_chapter(text, self.chapters)
+        if self.summarizer == 'model' and self.model is not None:
+            try:
+                self._summarize_with_model(text)
+                return
+            except Exception as e:
+                logger.warning(f"Could not summarize chapter {self.chapters} with the model, "
+                               f"using an extractive summary: {e}")
+        self._summarize_extractive(text, self.chapters)
+
+    def index_chapter(self, text: str, chapter: int) -> None:
+        """Adds the passages of a chapter to the vector index, without touching the summary."""
+        windows = sentence_windows(text, self.passage_words)
+        if not windows:
+            return
+        embeddings = embed_texts(windows)
+        count = len(self._passages)
+        if self._vectors is None:
+            self._vectors = np.zeros((max(64, len(windows)), embeddings.shape[1]), dtype=np.float32)
+        elif count + len(windows) > len(self._vectors):
+            grown = np.zeros((max(2 * len(self._vectors), count + len(windows)), self._vectors.shape[1]),
+                             dtype=np.float32)
+            grown[:count] = self._vectors[:count]
+            self._vectors = grown
+        self._vectors[count:count + len(windows)] = embeddings
+        self._passages.extend((chapter, window) for window in windows)
+        logger.debug(f"Indexed {len(windows)} passages of chapter {chapter}")
+
+    def recall(self, query: str) -> Dict[str, Any]:
+        """Returns the summary and the past passages most similar to the query.
+
+        Passages are added by decreasing similarity while they fit in
+        `passage_tokens` and are returned in story order.
+
+        Returns:
+            A dictionary with 'summary' (str) and 'passages', a list of dictionaries
+            with 'chapter', 'text' and 'similarity'.
+        """
+        passages = []
+        if self._passages and query:
+            scores = self._vectors[:len(self._passages)] @ embed_texts([query])[0]
+            used = 0
+            for row in np.argsort(-scores, kind='stable'):
+                chapter, text = self._passages[row]
+                tokens = estimate_tokens(text) + _PASSAGE_LABEL_TOKENS
+                if used + tokens > self.passage_tokens:
+                    continue
+                passages.append((row, {'chapter': chapter, 'text': text, 'similarity': float(scores[row])}))
+                used += tokens
+                if self.passage_tokens - used < 16:
+                    break
+        return {'summary': self.summary, 'passages': [passage for _, passage in sorted(passages, key=lambda p: p[0])]}
+
+    def state(self) -> Dict[str, Any]:
+        """Returns the summary state as JSON-serializable data (the passage index is not included)."""
+        return {'chapters': self.chapters, 'summary': self.summary,
+                'summary_sentences': [list(entry) for entry in self._summary_sentences]}
+
+    def restore(self, state: Optional[Dict[str, Any]]) -> None:
+        """Restores the summary from state(); the passages have to be indexed again with index_chapter()."""
+        if not state:
+            return
+        self.chapters = int(state.get('chapters', 0))
+        self.summary = state.get('summary', "")
+        self._summary_sentences = [(int(chapter), sentence) for chapter, sentence in state.get('summary_sentences', [])]
+        self._summary_embeddings = (embed_texts([sentence for _, sentence in self._summary_sentences])
+                                    if self._summary_sentences else None)
+
+    def _summarize_extractive(self, text: str, chapter: int) -> None:
+        sentences = split_sentences(text)
+        if not sentences:
+            return
+        embeddings = embed_texts(sentences)
+
+        # The sentences closest to the gist of the chapter, kept in their order
+        gist = embeddings.mean(axis=0)
+        budget = max(int(self.summary_tokens * _NEW_CHAPTER_SHARE), 1)
+        chosen, used = [], 0
+        for i in np.argsort(-(embeddings @ gist), kind='stable'):
+            tokens = estimate_tokens(sentences[i])
+            if used + tokens <= budget:
+                chosen.append(i)
+                used += tokens
+        chosen.sort()
+        self._summary_sentences.extend((chapter, sentences[i]) for i in chosen)
+        new_embeddings = embeddings[chosen]
+        self._summary_embeddings = (new_embeddings if self._summary_embeddings is None
+                                    else np.vstack([self._summary_embeddings, new_embeddings]))
+
+        # Over budget: drop the older sentences furthest from the gist of the whole summary
+        self.summary = self._format_summary()
+        if estimate_tokens(self.summary) > self.summary_tokens:
+            centrality = self._summary_embeddings @ self._summary_embeddings.mean(axis=0)
+            older = [int(i) for i in np.argsort(centrality, kind='stable')
+                     if self._summary_sentences[i][0] != chapter]
+            dropped = set()
+            for i in older:
+                dropped.add(i)
+                if estimate_tokens(self._format_summary(dropped)) <= self.summary_tokens:
+                    break
+            keep = [i for i in range(len(self._summary_sentences)) if i not in dropped]
+            self._summary_sentences = [self._summary_sentences[i] for i in keep]
+            self._summary_embeddings = self._summary_embeddings[keep]
+            self.summary = self._format_summary()
+
+    def _format_summary(self, dropped: Optional[set] = None) -> str:
+        """Joins the summary sentences into one line per chapter, leaving out the `dropped` ones."""
+        lines = []
+        for i, (chapter, sentence) in enumerate(self._summary_sentences):
+            if dropped and i in dropped:
+                continue
+            if lines and lines[-1][0] == chapter:
+                lines[-1][1].append(sentence)
+            else:
+                lines.append((chapter, [sentence]))
+        return "\n".join(f"Chapter {chapter}: {' '.join(parts)}" for chapter, parts in lines)
+
+    def _summarize_with_model(self, text: str) -> None:
+        # About four words for every three tokens
+        words = max(self.summary_tokens * 3 // 4, 20)
+        prompt = _SUMMARY_PROMPT.format(summary=self.summary or "(none yet)", chapter=text, words=words)
+        response = self.model.generate_content(prompt)
+        summary = (response.text or "").strip()
+        if not summary:
+            raise ValueError("empty response")
+        # Cut an overlong summary at a sentence boundary
+        kept, used = [], 0
+        for sentence in split_sentences(summary):
+            used += estimate_tokens(sentence)
+            if used > self.summary_tokens:
+                break
+            kept.append(sentence)
+        self.summary = " ".join(kept)
+        self._summary_sentences = []
+        self._summary_embeddings = None
+
+
+def accepted_chapters(history: List[Dict[str, Any]]) -> List[str]:
+    """Returns the generated chapters of a session history that were kept.
+
+    Every draft is recorded; a chapter was kept if it is the last generation
+    before the next query (or the end of the history).
+    """
+    chapters = []
+    for i, entry in enumerate(history):
+        if entry.get('type') == 'generation' and (i + 1 == len(history) or history[i + 1].get('type') != 'generation'):
+            chapters.append(entry.get('content', ""))
+    return chapters
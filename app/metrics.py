@@ -0,0 +1,224 @@
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+# Set up a logger for this module.
+logger = logging.getLogger('metrics')
+logger.info("Metrics module initialized")
+
+# Prefix of all exported Prometheus metric names.
+METRIC_PREFIX = 'narrative'
+
+# Default export locations, by format.
+DEFAULT_EXPORT_PATHS = {
+    'prometheus': Path('metrics') / 'story.prom',
+    'jsonl': Path('metrics') / 'story.jsonl',
+}
+
+_current_span: ContextVar[Optional[str]] = ContextVar('current_span', default=None)
+
+
+class MetricsRecorder:
+    """Collects timing spans and cache lookups of pipeline stages.
+
+    A span is one timed execution of a stage, with optional numeric
+    attributes such as token or character counts. Recording is cheap (a
+    clock read and a list append), so it is always on; exporting is
+    configured separately.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.spans: List[Dict[str, Any]] = []
+        self.cache_lookups: Dict[str, Dict[str, int]] = {}
+
+    def reset(self) -> None:
+        with self._lock:
+            self.spans = []
+            self.cache_lookups = {}
+
+    def record_span(self, name: str, start: float, duration: float, attributes: Dict[str, Any],
+                    parent: Optional[str] = None) -> None:
+        with self._lock:
+            self.spans.append({
+                'name': name,
+                'parent': parent,
+                'start': start,
+                'duration_s': duration,
+                'attributes': attributes,
+            })
+
+    def record_cache(self, cache: str, hit: bool) -> None:
+        """Counts a lookup in a cache as a hit or a miss."""
+        with self._lock:
+            lookups = self.cache_lookups.setdefault(cache, {'hits': 0, 'misses': 0})
+            lookups['hits' if hit else 'misses'] += 1
+
+    def stage_summary(self) -> Dict[str, Dict[str, Any]]:
+        """Aggregates the spans per stage, in order of first start (so parents precede their children).
+
+        Returns:
+            A dictionary mapping each stage to its 'calls', 'total_s', 'mean_s', 'max_s' and
+            the sums of its numeric attributes.
+        """
+        summary: Dict[str, Dict[str, Any]] = {}
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span_record: span_record['start'])
+        for span_record in spans:
+            stage = summary.setdefault(span_record['name'], {
+                'calls': 0, 'total_s': 0.0, 'max_s': 0.0, 'parent': span_record['parent'], 'attributes': {}})
+            stage['calls'] += 1
+            stage['total_s'] += span_record['duration_s']
+            stage['max_s'] = max(stage['max_s'], span_record['duration_s'])
+            for key, value in span_record['attributes'].items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    stage['attributes'][key] = stage['attributes'].get(key, 0) + value
+        for stage in summary.values():
+            stage['mean_s'] = stage['total_s'] / stage['calls']
+        return summary
+
+    def cache_hit_rates(self) -> Dict[str, Dict[str, Any]]:
+        """Returns the hits, misses and hit rate of every cache."""
+        with self._lock:
+            lookups = {cache: dict(counts) for cache, counts in self.cache_lookups.items()}
+        for counts in lookups.values():
+            total = counts['hits'] + counts['misses']
+            counts['hit_rate'] = counts['hits'] / total if total else 0.0
+        return lookups
+
+    def to_prometheus(self) -> str:
+        """Renders the aggregated metrics in the Prometheus text exposition format."""
+        summary = self.stage_summary()
+        lines = [
+            f"# HELP {METRIC_PREFIX}_stage_duration_seconds Time spent in each pipeline stage.",
+            f"# TYPE {METRIC_PREFIX}_stage_duration_seconds summary",
+        ]
+        for name, stage in summary.items():
+            lines.append(f'{METRIC_PREFIX}_stage_duration_seconds_sum{{stage="{name}"}} {stage["total_s"]:.6f}')
+            lines.append(f'{METRIC_PREFIX}_stage_duration_seconds_count{{stage="{name}"}} {stage["calls"]}')
+
+        attribute_names = sorted({key for stage in summary.values() for key in stage['attributes']})
+        for attribute in attribute_names:
+            metric = f"{METRIC_PREFIX}_stage_{attribute}_total"
+            lines.append(f"# HELP {metric} Sum of '{attribute}' over the spans of each stage.")
+            lines.append(f"# TYPE {metric} counter")
+            for name, stage in summary.items():
+                if attribute in stage['attributes']:
+                    lines.append(f'{metric}{{stage="{name}"}} {stage["attributes"][attribute]}')
+
+        caches = self.cache_hit_rates()
+        if caches:
+            lines.append(f"# HELP {METRIC_PREFIX}_cache_requests_total Cache lookups by result.")
+            lines.append(f"# TYPE {METRIC_PREFIX}_cache_requests_total counter")
+            for cache, counts in caches.items():
+                lines.append(f'{METRIC_PREFIX}_cache_requests_total{{cache="{cache}",result="hit"}} {counts["hits"]}')
+                lines.append(f'{METRIC_PREFIX}_cache_requests_total{{cache="{cache}",result="miss"}} {counts["misses"]}')
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: Path) -> None:
+        """Writes the metrics to a file for the node_exporter textfile collector.
+
+        The file is replaced atomically, so the collector never reads a partial file.
+        """
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temporary = path.with_name(path.name + '.tmp')
+        temporary.write_text(self.to_prometheus(), encoding='utf-8')
+        temporary.replace(path)
+
+    def write_jsonl(self, path: Path) -> None:
+        """Appends one JSON line per span, then one per cache, to a file."""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            spans = list(self.spans)
+        with open(path, 'a', encoding='utf-8') as f:
+            for span_record in spans:
+                f.write(json.dumps(dict(span_record, type='span')) + "\n")
+            for cache, counts in self.cache_hit_rates().items():
+                f.write(json.dumps(dict(counts, type='cache', cache=cache, time=time.time())) + "\n")
+
+
+_recorder = MetricsRecorder()
+
+
+def get_recorder() -> MetricsRecorder:
+    """Returns the process-wide metrics recorder."""
+    return _recorder
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Dict[str, Any]]:
+    """Times the enclosed block as one execution of a pipeline stage.
+
+    The yielded dictionary holds the span attributes; counts that are only
+    known at the end of the block can be added to it:
+
+        with span('context_assembly') as attributes:
+            context = prepare_context(...)
+            attributes['chars'] = len(context)
+
+    Spans opened inside the block record this one as their parent.
+    """
+    parent = _current_span.get()
+    token = _current_span.set(name)
+    start = time.time()
+    started = time.perf_counter()
+    try:
+        yield attributes
+    finally:
+        duration = time.perf_counter() - started
+        _current_span.reset(token)
+        _recorder.record_span(name, start, duration, attributes, parent)
+        logger.debug(f"{name} took {duration * 1000:.1f} ms")
+
+
+def timed(name: str) -> Callable:
+    """Decorator that records every call of a function as a span."""
+    def decorator(function: Callable) -> Callable:
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_cache(cache: str, hit: bool) -> None:
+    """Counts a lookup in a cache as a hit or a miss."""
+    _recorder.record_cache(cache, hit)
+
+
+def export_metrics(metrics_config: Optional[Dict[str, Any]]) -> Optional[Path]:
+    """Exports the recorded metrics as configured in the `metrics` config section.
+
+    Args:
+        metrics_config: The `metrics` config section. 'export' selects the format ('prometheus'
+            or 'jsonl', nothing is exported if unset) and 'path' the file.
+
+    Returns:
+        The file written, if any.
+    """
+    metrics_config = metrics_config or {}
+    export_format = metrics_config.get('export')
+    if not export_format:
+        return None
+    if export_format not in DEFAULT_EXPORT_PATHS:
+        logger.warning(f"Unknown metrics export format '{export_format}', expected prometheus or jsonl")
+        return None
+
+    path = Path(metrics_config.get('path') or DEFAULT_EXPORT_PATHS[export_format])
+    try:
+        if export_format == 'prometheus':
+            _recorder.write_prometheus(path)
+        else:
+            _recorder.write_jsonl(path)
+    except OSError as e:
+        logger.warning(f"Could not export metrics to {path}: {e}")
+        return None
+    logger.info(f"Metrics exported to {path}")
+    return path
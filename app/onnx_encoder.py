@@ -0,0 +1,191 @@
+import json
+import logging
+from pathlib import Path
+from typing import Any, Dict, Optional, Sequence
+
+import numpy as np
+
+# Set up a logger for this module.
+logger = logging.getLogger('onnx_encoder')
+logger.info("ONNX encoder module initialized")
+
+# Where exported models are stored, one subdirectory per model and precision.
+DEFAULT_ONNX_DIRECTORY = Path('models') / 'onnx'
+
+# Sentences the export is checked on.
+VERIFICATION_TEXTS = [
+    "The old lighthouse keeper climbed the stairs one last time.",
+    "Rain hammered the tin roof while the council argued about the border.",
+    "She hid the letter inside the spine of a book nobody would open.",
+    "Dragons",
+    "A quiet market town, a missing apprentice and a map that changes every night.",
+    "He laughed, but his hand never left the hilt of the sword.",
+]
+
+_MODEL_FILE = 'model.onnx'
+_QUANTIZED_MODEL_FILE = 'model.int8.onnx'
+_METADATA_FILE = 'encoder.json'
+
+
+def export_directory(model_name: str, directory: Optional[Path] = None) -> Path:
+    """Returns the directory an encoder model is exported to."""
+    return Path(directory or DEFAULT_ONNX_DIRECTORY) / model_name.replace('/', '__')
+
+
+def min_cosine_similarity(reference: np.ndarray, candidate: np.ndarray) -> float:
+    """Returns the lowest cosine similarity between corresponding rows of two embedding matrices."""
+    reference = np.asarray(reference, dtype=np.float64)
+    candidate = np.asarray(candidate, dtype=np.float64)
+    norms = np.linalg.norm(reference, axis=1) * np.linalg.norm(candidate, axis=1)
+    return float(np.min(np.sum(reference * candidate, axis=1) / np.maximum(norms, 1e-12)))
+
+
+def export_encoder(model_name: str, directory: Optional[Path] = None, quantize: bool = False,
+                   min_cosine: float = 0.99, opset: int = 14) -> Path:
+    """Exports a sentence-transformers model to ONNX.
+
+    The graph takes token ids and an attention mask and returns the pooled
+    (and, if the model does so, normalized) sentence embeddings. The
+    tokenizer is saved next to it, so running the model needs neither torch
+    nor sentence-transformers. With `quantize`, the weights are also
+    quantized to int8 (onnxruntime's dynamic quantization).
+
+    The exported model is checked against the PyTorch model on a few
+    sentences; if the lowest cosine similarity of the embeddings is below
+    `min_cosine`, a ValueError is raised.
+
+    Returns:
+        The export directory.
+    """
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    output = export_directory(model_name, directory)
+    output.mkdir(parents=True, exist_ok=True)
+    model = SentenceTransformer(model_name, device='cpu')
+    module_names = [type(module).__name__ for module in model]
+    pooling = next((module for module in model if type(module).__name__ == 'Pooling'), None)
+    if pooling is None or pooling.get_pooling_mode_str() != 'mean':
+        raise ValueError(f"Only mean-pooled models can be exported, {model_name} has {module_names}")
+    normalize = 'Normalize' in module_names
+
+    class SentenceEmbedding(torch.nn.Module):
+        def __init__(self, transformer: torch.nn.Module):
+            super().__init__()
+            self.transformer = transformer
+
+        def forward(self, input_ids, attention_mask):
+            tokens = self.transformer(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+            mask = attention_mask.unsqueeze(-1).to(tokens.dtype)
+            pooled = (tokens * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+            return torch.nn.functional.normalize(pooled, p=2, dim=1) if normalize else pooled
+
+    wrapper = SentenceEmbedding(model[0].auto_model).eval()
+    sample = model.tokenizer(VERIFICATION_TEXTS[:2], padding=True, return_tensors='pt')
+    logger.info(f"Exporting {model_name} to {output / _MODEL_FILE}")
+    with torch.no_grad():
+        torch.onnx.export(
+            wrapper, (sample['input_ids'], sample['attention_mask']), str(output / _MODEL_FILE),
+            input_names=['input_ids', 'attention_mask'], output_names=['sentence_embedding'],
+            dynamic_axes={'input_ids': {0: 'batch', 1: 'sequence'},
+                          'attention_mask': {0: 'batch', 1: 'sequence'},
+                          'sentence_embedding': {0: 'batch'}},
+            opset_version=opset, do_constant_folding=True)
+    model.tokenizer.save_pretrained(str(output))
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        logger.info(f"Quantizing {model_name} to {output / _QUANTIZED_MODEL_FILE}")
+        quantize_dynamic(str(output / _MODEL_FILE), str(output / _QUANTIZED_MODEL_FILE),
+                         weight_type=QuantType.QInt8)
+
+    metadata = {
+        'model': model_name,
+        'max_seq_length': model.max_seq_length,
+        'normalize': normalize,
+        'dimensions': model.get_sentence_embedding_dimension(),
+    }
+    with open(output / _METADATA_FILE, 'w', encoding='utf-8') as f:
+        json.dump(metadata, f, indent=2)
+
+    reference = model.encode(VERIFICATION_TEXTS)
+    for quantized in ([False, True] if quantize else [False]):
+        similarity = min_cosine_similarity(reference, OnnxEncoder(output, quantized=quantized).encode(VERIFICATION_TEXTS))
+        metadata['min_cosine_int8' if quantized else 'min_cosine'] = similarity
+        logger.info(f"ONNX{' int8' if quantized else ''} export of {model_name}: min cosine similarity "
+                    f"to PyTorch {similarity:.5f}")
+        if similarity < min_cosine:
+            # Remove the export, so it is not loaded next time
+            for name in (_MODEL_FILE, _QUANTIZED_MODEL_FILE, _METADATA_FILE):
+                (output / name).unlink(missing_ok=True)
+            raise ValueError(f"ONNX{' int8' if quantized else ''} embeddings of {model_name} deviate from "
+                             f"PyTorch (min cosine {similarity:.4f} < {min_cosine})")
+    with open(output / _METADATA_FILE, 'w', encoding='utf-8') as f:
+        json.dump(metadata, f, indent=2)
+    return output
+
+
+class OnnxEncoder:
+    """Runs an exported sentence encoder with ONNX Runtime.
+
+    Has the sentence-transformers style `encode(texts)` method, so it can be
+    installed as the shared encoder. Texts are sorted by length before
+    batching, so each batch pads to similar lengths.
+    """
+
+    def __init__(self, directory: Path, quantized: bool = False, threads: Optional[int] = None,
+                 batch_size: int = 32):
+        import onnxruntime
+        from transformers import AutoTokenizer
+
+        directory = Path(directory)
+        with open(directory / _METADATA_FILE, 'r', encoding='utf-8') as f:
+            self.metadata: Dict[str, Any] = json.load(f)
+        self.max_seq_length = self.metadata['max_seq_length']
+        self.batch_size = batch_size
+        self.tokenizer = AutoTokenizer.from_pretrained(str(directory))
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        options.inter_op_num_threads = 1
+        if threads:
+            options.intra_op_num_threads = threads
+        model_path = directory / (_QUANTIZED_MODEL_FILE if quantized else _MODEL_FILE)
+        self.session = onnxruntime.InferenceSession(str(model_path), options,
+                                                    providers=['CPUExecutionProvider'])
+        logger.info(f"Loaded ONNX encoder {model_path} ({threads or 'default'} threads)")
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.metadata['dimensions']
+
+    def encode(self, texts: Sequence[str], batch_size: Optional[int] = None, **kwargs) -> np.ndarray:
+        texts = list(texts)
+        batch_size = batch_size or self.batch_size
+        embeddings = np.zeros((len(texts), self.metadata['dimensions']), dtype=np.float32)
+        order = np.argsort([len(text) for text in texts], kind='stable')
+        for start in range(0, len(texts), batch_size):
+            rows = order[start:start + batch_size]
+            tokens = self.tokenizer([texts[row] for row in rows], padding=True, truncation=True,
+                                    max_length=self.max_seq_length, return_tensors='np')
+            embeddings[rows] = self.session.run(['sentence_embedding'], {
+                'input_ids': tokens['input_ids'].astype(np.int64),
+                'attention_mask': tokens['attention_mask'].astype(np.int64),
+            })[0]
+        return embeddings
+
+
+def load_onnx_encoder(model_name: str, onnx_config: Optional[Dict[str, Any]] = None) -> OnnxEncoder:
+    """Loads the ONNX version of an encoder, exporting it first if needed.
+
+    Args:
+        model_name: The sentence-transformers model.
+        onnx_config: The `encoder.onnx` config section: 'directory', 'quantize', 'threads' and 'min_cosine'.
+    """
+    onnx_config = onnx_config or {}
+    quantize = bool(onnx_config.get('quantize', False))
+    directory = export_directory(model_name, onnx_config.get('directory'))
+    model_file = directory / (_QUANTIZED_MODEL_FILE if quantize else _MODEL_FILE)
+    if not model_file.exists() or not (directory / _METADATA_FILE).exists():
+        export_encoder(model_name, onnx_config.get('directory'), quantize, onnx_config.get('min_cosine', 0.99))
+    return OnnxEncoder(directory, quantized=quantize, threads=onnx_config.get('threads'))
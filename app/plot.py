@@ -1,7 +1,4 @@
 import logging
-import google.generativeai as genai
-from google.api_core.exceptions import GoogleAPIError
-import requests
 from rich.console import Console
 
 console = Console()
@@ -32,6 +29,10 @@ class PlotGenerator:
         Raises:
             PlotGenerationError: If an error occurs during plot generation.
         """
+        # Imported here rather than at startup; both come with the model client
+        from google.api_core.exceptions import GoogleAPIError
+        import requests
+
         try:
             full_prompt = f"Generate a detailed plot outline for a story based on the following prompt (in approximately less than {
                 max_length} words):\n\n{prompt}"
@@ -0,0 +1,184 @@
+import cProfile
+import io
+import logging
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# Set up a logger for this module.
+logger = logging.getLogger('profiling')
+logger.info("Profiling module initialized")
+
+PROFILERS = ('cprofile', 'sampling', 'pyinstrument')
+
+# Where profiles are written when a run has no output file.
+DEFAULT_PROFILE_DIRECTORY = Path('profiles')
+
+
+def profile_output_base(output_file: Optional[Path], directory: Optional[Path] = None) -> Path:
+    """Returns the path (without extension) that the profile files of a run are written to.
+
+    Profiles go next to the output file (`story.txt` -> `story.profile.*`), or into
+    `directory` under a timestamp when there is no output file.
+    """
+    if output_file:
+        output_file = Path(output_file)
+        return output_file.with_name(output_file.stem + '.profile')
+    directory = Path(directory) if directory else DEFAULT_PROFILE_DIRECTORY
+    return directory / datetime.now().strftime('%Y%m%d-%H%M%S')
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """A low-overhead statistical profiler for one thread.
+
+    A background thread records the call stack of the profiled thread every
+    `interval` seconds. The samples are written as folded stacks
+    (`outer;inner;innermost count`), the input format of flamegraph.pl,
+    inferno and speedscope.
+    """
+
+    def __init__(self, interval: float = 0.005, thread_id: Optional[int] = None):
+        self.interval = interval
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.stacks: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _sample(self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+            if stack:
+                self.stacks[tuple(reversed(stack))] += 1
+
+    def start(self) -> None:
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, name='sampling-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def folded(self) -> List[str]:
+        """Returns the samples as folded stack lines, most frequent first."""
+        return [f"{';'.join(stack)} {count}" for stack, count in self.stacks.most_common()]
+
+    def hotspots(self, top_n: int = 30) -> List[Tuple[str, int, int]]:
+        """Returns the functions with the most samples as (function, self samples, total samples)."""
+        own: Counter = Counter()
+        total: Counter = Counter()
+        for stack, count in self.stacks.items():
+            own[stack[-1]] += count
+            for label in set(stack):
+                total[label] += count
+        return [(label, own[label], total[label]) for label, _ in own.most_common(top_n)]
+
+
+def _sampling_report(profiler: SamplingProfiler, top_n: int) -> str:
+    samples = sum(profiler.stacks.values())
+    lines = [f"{samples} samples every {profiler.interval * 1000:.1f} ms", "",
+             f"{'self %':>7} {'total %':>8}  function"]
+    for label, own, total in profiler.hotspots(top_n):
+        lines.append(f"{own / max(samples, 1):>7.1%} {total / max(samples, 1):>8.1%}  {label}")
+    return "\n".join(lines) + "\n"
+
+
+def _cprofile_report(profiler: cProfile.Profile, top_n: int) -> str:
+    stream = io.StringIO()
+    stats = pstats.Stats(profiler, stream=stream)
+    stats.strip_dirs()
+    stream.write(f"Top {top_n} functions by own time\n")
+    stats.sort_stats('tottime').print_stats(top_n)
+    stream.write(f"\nTop {top_n} functions by cumulative time\n")
+    stats.sort_stats('cumulative').print_stats(top_n)
+    return stream.getvalue()
+
+
+@contextmanager
+def profile_run(output_base: Path, engine: str = 'cprofile', top_n: int = 30,
+                interval: float = 0.005) -> Iterator[Dict[str, Path]]:
+    """Profiles the enclosed block and writes the results next to `output_base`.
+
+    Engines and the files they write:
+
+    - 'cprofile' (deterministic): `<base>.prof`, a pstats file for snakeviz, tuna or flameprof.
+    - 'sampling' (statistical, built in): `<base>.folded`, folded stacks for flamegraph.pl or speedscope.
+    - 'pyinstrument' (statistical, needs pyinstrument): `<base>.speedscope.json` for speedscope.
+
+    Every engine also writes a top-N hotspot summary to `<base>.hotspots.txt`.
+
+    Args:
+        output_base: The path of the profile files, without extension.
+        engine: The profiler to use.
+        top_n: The number of functions in the hotspot summary.
+        interval: The sampling interval in seconds (sampling and pyinstrument).
+
+    Yields:
+        A dictionary that, once the block has finished, maps each kind of output
+        ('profile', 'hotspots') to the file written.
+    """
+    if engine not in PROFILERS:
+        raise ValueError(f"Unknown profiler '{engine}', expected one of {', '.join(PROFILERS)}")
+    if engine == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+            from pyinstrument.renderers import SpeedscopeRenderer
+        except ImportError:
+            logger.warning("pyinstrument is not installed, using cProfile instead")
+            engine = 'cprofile'
+
+    output_base = Path(output_base)
+    output_base.parent.mkdir(parents=True, exist_ok=True)
+    outputs: Dict[str, Path] = {}
+    started = time.perf_counter()
+
+    if engine == 'cprofile':
+        profiler = cProfile.Profile()
+        profiler.enable()
+    elif engine == 'sampling':
+        profiler = SamplingProfiler(interval)
+        profiler.start()
+    else:
+        profiler = Profiler(interval=interval)
+        profiler.start()
+
+    try:
+        yield outputs
+    finally:
+        elapsed = time.perf_counter() - started
+        if engine == 'cprofile':
+            profiler.disable()
+            outputs['profile'] = output_base.with_name(output_base.name + '.prof')
+            profiler.dump_stats(str(outputs['profile']))
+            report = _cprofile_report(profiler, top_n)
+        elif engine == 'sampling':
+            profiler.stop()
+            outputs['profile'] = output_base.with_name(output_base.name + '.folded')
+            outputs['profile'].write_text("\n".join(profiler.folded()) + "\n", encoding='utf-8')
+            report = _sampling_report(profiler, top_n)
+        else:
+            profiler.stop()
+            outputs['profile'] = output_base.with_name(output_base.name + '.speedscope.json')
+            outputs['profile'].write_text(profiler.output(SpeedscopeRenderer()), encoding='utf-8')
+            report = profiler.output_text(unicode=True, color=False)
+
+        outputs['hotspots'] = output_base.with_name(output_base.name + '.hotspots.txt')
+        outputs['hotspots'].write_text(f"Profiled with {engine} for {elapsed:.2f} s\n\n{report}",
+                                       encoding='utf-8')
+        logger.info(f"Profile written to {outputs['profile']}, hotspots to {outputs['hotspots']}")
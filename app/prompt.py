@@ -1,91 +1,116 @@
 import logging
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional, Tuple, Union
+
+from .context import CONTEXT_SEPARATOR, format_context_chunk
+from .tokens import estimate_tokens
+from .world_index import WorldIndex, get_world_index
 
 # Set up a logger for this module.
 logger = logging.getLogger('prompt')
 logger.info("Prompt module initialized")
 
+# Relevance of a context passed as one formatted string, which is kept or dropped as a whole.
+_DEFAULT_CONTEXT_RELEVANCE = 0.5
 
-def create_prompt(style: str, character: str, situation: str, context: str,
-                  character_profiles: Dict[str, Any], world_details: Dict[str, Any],
-                  previous_attempt: str = None, feedback: Dict[str, Any] = None, style_prompt: str = None) -> str:
-    """
-    Create a detailed prompt with guidance and constraints, incorporating world details.
+# Relevance of sections the caller asked for explicitly (a location named in
+# the situation, the guidelines of the selected style).
+_EXPLICIT_RELEVANCE = 1.0
+
+
+def _new_section(name: str, header: Optional[str] = None, required: bool = False,
+                 separator: str = "\n") -> Dict[str, Any]:
+    """Creates an empty prompt section."""
+    return {'name': name, 'header': header, 'required': required,
+            'separator': separator, 'items': []}
+
+
+def _add_item(section: Dict[str, Any], text: str, relevance: float = 0.0) -> None:
+    """Appends an item (one or more prompt lines) to a section."""
+    section['items'].append({'text': text, 'relevance': relevance})
 
-    Note: The prompt can become quite verbose. Consider strategies for condensing
-    information or selectively including details based on relevance or token limits.
-    """
-    logger.debug("Creating prompt")
-    prompt = []
+
+def _collect_sections(style: str, character: str, situation: str,
+                      context: Union[str, List[Dict[str, Any]], None],
+                      world_index: WorldIndex, previous_attempt: Optional[str],
+                      feedback: Optional[Dict[str, Any]], style_prompt: Optional[str],
+                      story_memory: Optional[Dict[str, Any]] = None,
+                      plot_outline: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Collects all candidate prompt sections in the order they appear in the prompt."""
+    sections = []
+
+    # Plot outline (required, so it counts against the token budget but is never dropped)
+    outline_section = _new_section('plot_outline', required=True)
+    if plot_outline:
+        _add_item(outline_section, f"Plot Outline:\n{plot_outline}\n")
+    sections.append(outline_section)
 
     # Style
+    style_section = _new_section('style', required=True)
     if style_prompt:
-        prompt.append(f"Write a chapter in the style described by: \"{
-                      style_prompt}\"")
+        _add_item(style_section, f"Write a chapter in the style described by: \"{
+                  style_prompt}\"")
     else:
-        prompt.append(f"Write a chapter in the style of {style}.")
+        _add_item(style_section, f"Write a chapter in the style of {style}.")
+    sections.append(style_section)
 
     # Character
+    character_section = _new_section('character', required=True)
     if character:
-        if character in character_profiles:
-            profile = character_profiles[character]
-            prompt.append(f"Focus on the character of {character}:")
-            prompt.append(f"- Personality: {profile['personality']}")
-            prompt.append(f"- Backstory: {profile['backstory']}")
-            prompt.append(f"- Goal: {profile['goal']}")
+        if character in world_index.character_fragments:
+            _add_item(character_section, world_index.character_fragments[character])
         else:
-            prompt.append(f"Focus on the character of {
-                          character}, ensuring their actions and thoughts align with their established personality.")
+            _add_item(character_section, f"Focus on the character of {
+                      character}, ensuring their actions and thoughts align with their established personality.")
+    sections.append(character_section)
 
     # Situation
+    situation_section = _new_section('situation', required=True)
     if situation:
-        prompt.append(f"The situation involves: {situation}")
+        _add_item(situation_section, f"The situation involves: {situation}")
+    sections.append(situation_section)
+
+    # Other characters named in the situation
+    present_section = _new_section(
+        'characters_present', header="\nOther characters in this scene:")
+    for name in world_index.find_characters(situation):
+        if name != character:
+            _add_item(present_section, world_index.character_summaries[name],
+                      relevance=_EXPLICIT_RELEVANCE)
+    sections.append(present_section)
 
     # World Details - Themes
-    if world_details and 'themes' in world_details:
-        relevant_themes = world_details['themes']
-        prompt.append("\nIncorporate the following themes:")
-        for theme, details in relevant_themes.items():
-            prompt.append(f"- {theme}: {', '.join(details['subthemes'])}")
+    themes_section = _new_section(
+        'themes', header="\nIncorporate the following themes:")
+    for line in world_index.theme_lines:
+        _add_item(themes_section, line)
+    sections.append(themes_section)
 
     # World Details - Motifs
-    if world_details and 'motifs' in world_details:
-        relevant_motifs = world_details['motifs']
-        prompt.append("\nUse the following motifs:")
-        for motif, meaning in relevant_motifs.items():
-            prompt.append(f"- {motif}: {meaning}")
-
-    # World Details - Location (if situation provides a location)
-    if situation and world_details:
-        for location_name, location_details in world_details['locations'].items():
-            if location_name.lower() in situation.lower():
-                prompt.append(f"\nSetting details for {location_name}:")
-                prompt.append(
-                    f"- Description: {location_details['description']}")
-                prompt.append(
-                    f"- Significance: {location_details['significance']}")
-                if 'places' in location_details:
-                    prompt.append("- Notable places within this location:")
-                    for place_name, place_description in location_details['places'].items():
-                        prompt.append(
-                            f"  - {place_name}: {place_description}")
-                if 'rooms' in location_details:
-                    prompt.append("- Rooms within this location:")
-                    for room_name, room_description in location_details['rooms'].items():
-                        prompt.append(
-                            f"  - {room_name}: {room_description}")
-                break  # Stop after finding the first relevant location
+    motifs_section = _new_section(
+        'motifs', header="\nUse the following motifs:")
+    for line in world_index.motif_lines:
+        _add_item(motifs_section, line)
+    sections.append(motifs_section)
+
+    # World Details - Location (the first location named in the situation)
+    location_section = _new_section('location')
+    location_name = world_index.find_location(situation)
+    if location_name:
+        _add_item(location_section, world_index.location_fragments[location_name],
+                  relevance=_EXPLICIT_RELEVANCE)
+    sections.append(location_section)
 
     # World Details - Styles (if not using style_prompt)
-    if not style_prompt and world_details and 'styles' in world_details:
-        style_details = world_details['styles'].get(style)
-        if style_details:
-            prompt.append(f"\nStyle guidelines for {style}:")
-            prompt.append(f"{style_details}")
+    style_guide_section = _new_section('style_guidelines')
+    if not style_prompt and style in world_index.style_fragments:
+        _add_item(style_guide_section, world_index.style_fragments[style],
+                  relevance=_EXPLICIT_RELEVANCE)
+    sections.append(style_guide_section)
 
     # Previous Attempt and Feedback
+    feedback_section = _new_section('feedback', required=True)
     if previous_attempt and feedback:
-        prompt.extend([
+        _add_item(feedback_section, "\n".join([
             "\nBased on the previous attempt, please improve:",
             f"- Overall narrative quality (previous quality score: {
                 feedback.get('quality_score', 0):.2f})",
@@ -96,17 +121,186 @@ def create_prompt(style: str, character: str, situation: str, context: str,
             f"- Semantic similarity to reference chunks (previous score: {
                 feedback.get('semantic_similarity', 0):.2f})",
             "While maintaining the strong elements of the original."
-        ])
+        ]))
+    sections.append(feedback_section)
+
+    # Story memory: the rolling summary and passages of earlier chapters (see memory.StoryMemory)
+    story_memory = story_memory or {}
+    summary_section = _new_section('story_so_far', header="\nThe story so far:")
+    if story_memory.get('summary'):
+        _add_item(summary_section, story_memory['summary'], relevance=_EXPLICIT_RELEVANCE)
+    sections.append(summary_section)
+
+    passages_section = _new_section(
+        'earlier_passages', header="\nRelevant passages from earlier chapters:",
+        separator=CONTEXT_SEPARATOR)
+    for passage in story_memory.get('passages', []):
+        _add_item(passages_section, f"(Chapter {passage['chapter']}) {passage['text']}",
+                  relevance=passage['similarity'])
+    sections.append(passages_section)
+
+    # Context (if available), one item per retrieved chunk
+    context_section = _new_section(
+        'context', header="\nUse this context from existing materials:",
+        separator=CONTEXT_SEPARATOR)
+    if isinstance(context, str):
+        # Formatted text is not split again: chunk texts may contain the separator themselves
+        if context:
+            _add_item(context_section, context, relevance=_DEFAULT_CONTEXT_RELEVANCE)
+    else:
+        for chunk in context or []:
+            _add_item(context_section, format_context_chunk(chunk), relevance=chunk['similarity'])
+    sections.append(context_section)
+
+    closing_section = _new_section('closing', required=True)
+    _add_item(closing_section,
+              "\nGenerate a cohesive chapter that advances the story while maintaining consistency.")
+    sections.append(closing_section)
+
+    return sections
+
 
-    # Context (if available)
-    if context:
-        prompt.extend([
-            "\nUse this context from existing materials:",
-            context
-        ])
+def _score_world_items(sections: List[Dict[str, Any]], world_index: WorldIndex, query: str) -> None:
+    """Sets the relevance of theme and motif items to their embedding similarity with the query."""
+    items = [item for section in sections if section['name'] in ('themes', 'motifs')
+             for item in section['items']]
+    if not items or not query:
+        return
+    try:
+        scores = world_index.score_world_items(query)
+    except Exception as e:
+        logger.warning(f"Could not rank themes and motifs by relevance: {e}")
+        return
+    for item, score in zip(items, scores):
+        item['relevance'] = float(score)
 
-    prompt.append(
-        "\nGenerate a cohesive chapter that advances the story while maintaining consistency.")
 
-    logger.info("Prompt created")
-    return "\n".join(prompt)
+def _fill_budget(sections: List[Dict[str, Any]], token_budget: Optional[int]) -> None:
+    """Marks the items to include, greedily filling the token budget by relevance.
+
+    Required sections are always included. The remaining items are added in
+    order of decreasing relevance while they fit; a section header is charged
+    together with the first item of its section.
+    """
+    used = 0
+    for section in sections:
+        section['header_tokens'] = estimate_tokens(section['header'] or "")
+        for item in section['items']:
+            item['tokens'] = estimate_tokens(item['text'])
+            item['included'] = token_budget is None or section['required']
+            if section['required']:
+                used += item['tokens']
+        if section['required'] and section['items']:
+            used += section['header_tokens']
+
+    if token_budget is None:
+        return
+    if used > token_budget:
+        logger.warning(f"Required prompt sections use {used} tokens, exceeding the budget of {
+                       token_budget}")
+
+    candidates = [(section, item) for section in sections if not section['required']
+                  for item in section['items']]
+    candidates.sort(key=lambda candidate: candidate[1]['relevance'], reverse=True)
+    charged_headers = set()
+    for section, item in candidates:
+        cost = item['tokens']
+        if section['name'] not in charged_headers:
+            cost += section['header_tokens']
+        if used + cost <= token_budget:
+            item['included'] = True
+            used += cost
+            charged_headers.add(section['name'])
+
+
+def build_prompt(style: str, character: str, situation: str, context: Union[str, List[Dict[str, Any]]],
+                 character_profiles: Dict[str, Any], world_details: Dict[str, Any],
+                 previous_attempt: str = None, feedback: Dict[str, Any] = None, style_prompt: str = None,
+                 token_budget: Optional[int] = None, query: Optional[str] = None,
+                 world_index: Optional[WorldIndex] = None,
+                 story_memory: Optional[Dict[str, Any]] = None,
+                 plot_outline: Optional[str] = None) -> Tuple[str, List[Dict[str, Any]]]:
+    """Create a prompt within an optional token budget and report its section sizes.
+
+    Without a budget every section is included. With a budget, the required
+    sections (plot outline, style, character, situation, feedback and closing instructions)
+    are always kept, and themes, motifs, location and style details, the story
+    memory and the retrieved context parts are added greedily by relevance to
+    the query until the budget is used up. Themes and motifs are ranked by embedding
+    similarity, context parts by their retrieval score.
+
+    Args:
+        style, character, situation, character_profiles, world_details,
+        previous_attempt, feedback, style_prompt: See `create_prompt`.
+        context: The retrieved chunks, as returned by context.prepare_context_chunks. Each
+            chunk is one context part, ranked by its similarity. A context already formatted
+            as a string (context.prepare_context) is one part with relevance 0.5.
+        token_budget: The maximum number of (estimated) tokens in the prompt, or None for no limit.
+        query: The text used to rank optional sections. Defaults to the situation or style.
+        world_index: The compiled world details and character profiles. Defaults to the
+            cached index of `world_details` and `character_profiles` (see get_world_index).
+        story_memory: The summary and earlier passages of the session, as returned by
+            StoryMemory.recall. The summary is ranked like an explicitly requested section,
+            the passages by their similarity to the query.
+        plot_outline: The story's plot outline, put at the start of the prompt.
+
+    Returns:
+        A tuple of (prompt, section_report), where section_report lists, per section,
+        the included and dropped item counts and estimated token counts.
+    """
+    logger.debug("Creating prompt")
+    if world_index is None:
+        world_index = get_world_index(world_details, character_profiles)
+    sections = _collect_sections(style, character, situation, context, world_index,
+                                 previous_attempt, feedback, style_prompt, story_memory, plot_outline)
+    if token_budget is not None:
+        _score_world_items(sections, world_index, query or situation or style_prompt or style)
+    _fill_budget(sections, token_budget)
+
+    prompt = []
+    report = []
+    for section in sections:
+        included = [item for item in section['items'] if item['included']]
+        dropped = [item for item in section['items'] if not item['included']]
+        tokens = sum(item['tokens'] for item in included)
+        if included:
+            if section['header']:
+                prompt.append(section['header'])
+                tokens += section['header_tokens']
+            prompt.append(section['separator'].join(item['text'] for item in included))
+        report.append({
+            'section': section['name'],
+            'tokens': tokens,
+            'items': len(included),
+            'dropped_items': len(dropped),
+            'dropped_tokens': sum(item['tokens'] for item in dropped),
+        })
+
+    total_tokens = sum(entry['tokens'] for entry in report)
+    logger.info(f"Prompt created with ~{total_tokens} tokens" +
+                (f" (budget {token_budget})" if token_budget is not None else ""))
+    logger.info("Prompt sections: " + ", ".join(
+        f"{entry['section']}={entry['tokens']}" +
+        (f" (-{entry['dropped_tokens']})" if entry['dropped_items'] else "")
+        for entry in report if entry['items'] or entry['dropped_items']))
+    return "\n".join(prompt), report
+
+
+def create_prompt(style: str, character: str, situation: str, context: Union[str, List[Dict[str, Any]]],
+                  character_profiles: Dict[str, Any], world_details: Dict[str, Any],
+                  previous_attempt: str = None, feedback: Dict[str, Any] = None, style_prompt: str = None,
+                  token_budget: Optional[int] = None, query: Optional[str] = None,
+                  world_index: Optional[WorldIndex] = None,
+                  story_memory: Optional[Dict[str, Any]] = None,
+                  plot_outline: Optional[str] = None) -> str:
+    """
+    Create a detailed prompt with guidance and constraints, incorporating world details.
+
+    Pass `token_budget` to keep the prompt within an approximate token limit; the
+    least relevant themes, motifs and context parts are left out first. See
+    `build_prompt` for the per-section token report.
+    """
+    prompt, _ = build_prompt(style, character, situation, context, character_profiles,
+                             world_details, previous_attempt, feedback, style_prompt,
+                             token_budget, query, world_index, story_memory, plot_outline)
+    return prompt
@@ -0,0 +1,95 @@
+import logging
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# Set up a logger for this module.
+logger = logging.getLogger('rerank')
+logger.info("Rerank module initialized")
+
+
+def gather_chunk_embeddings(embeddings_dict: Dict[str, Any],
+                            chunks: List[Tuple[str, int, float]]) -> np.ndarray:
+    """Collects the embeddings of the given chunks into a matrix.
+
+    Args:
+        embeddings_dict: A dictionary where keys are file paths and values are dictionaries containing 'chunk_embeddings'.
+        chunks: A list of (file_path, chunk_index, score) tuples.
+
+    Returns:
+        A float32 array with one row per chunk.
+    """
+    return np.array([embeddings_dict[file_path]['chunk_embeddings'][chunk_idx]
+                     for file_path, chunk_idx, _ in chunks], dtype=np.float32)
+
+
+def score_cutoff(scores: Sequence[float], min_score: Optional[float] = None, max_gap: Optional[float] = None,
+                 min_count: int = 1) -> int:
+    """Decides how many of the best-scoring candidates are worth keeping.
+
+    Args:
+        scores: The candidates' scores, in decreasing order.
+        min_score: Candidates scoring below this are dropped.
+        max_gap: The list is cut before the first score that drops by more than this
+            fraction of the score before it (e.g. 0.2 cuts 0.60 -> 0.45).
+        min_count: Candidates kept regardless of the cutoffs (if there are that many).
+
+    Returns:
+        The number of leading candidates to keep.
+    """
+    scores = np.asarray(scores, dtype=np.float32)
+    count = len(scores)
+    if min_score is not None:
+        # Scores are decreasing, so their negations are sorted
+        count = int(np.searchsorted(-scores, -min_score, side='right'))
+    if max_gap is not None and count > 1:
+        previous = scores[:count - 1]
+        drops = (previous - scores[1:count]) / np.maximum(np.abs(previous), 1e-12)
+        large = np.flatnonzero(drops > max_gap)
+        if len(large):
+            count = int(large[0]) + 1
+    return max(count, min(min_count, len(scores)))
+
+
+def mmr_rerank(candidates: List[Tuple[str, int, float]], candidate_embeddings: np.ndarray,
+               top_n: int, lambda_: float = 0.7) -> List[Tuple[str, int, float]]:
+    """Selects a relevant but diverse subset of candidates with maximal marginal relevance.
+
+    Chunks are picked one at a time, each maximizing
+
+        lambda_ * relevance - (1 - lambda_) * max similarity to the chunks already picked
+
+    where relevance is the candidate's retrieval score and similarity is the
+    cosine similarity of the chunk embeddings. Each step is a vectorized
+    update over the candidate similarity submatrix.
+
+    Args:
+        candidates: A list of (file_path, chunk_index, score) tuples.
+        candidate_embeddings: The embeddings of the candidates, one row per candidate.
+        top_n: The number of chunks to select.
+        lambda_: The trade-off between relevance (1.0) and diversity (0.0).
+
+    Returns:
+        The selected candidates, in selection order.
+    """
+    if len(candidates) <= 1 or top_n <= 0:
+        return candidates[:top_n]
+
+    norms = np.linalg.norm(candidate_embeddings, axis=1, keepdims=True)
+    embeddings = candidate_embeddings / np.maximum(norms, 1e-12)
+    similarity = embeddings @ embeddings.T
+    relevance = np.array([score for _, _, score in candidates], dtype=np.float32)
+
+    redundancy = np.zeros(len(candidates), dtype=np.float32)
+    available = np.ones(len(candidates), dtype=bool)
+    selected = []
+    for step in range(min(top_n, len(candidates))):
+        mmr = lambda_ * relevance - (1 - lambda_) * redundancy
+        mmr[~available] = -np.inf
+        best = int(np.argmax(mmr))
+        selected.append(best)
+        available[best] = False
+        redundancy = similarity[best] if step == 0 else np.maximum(redundancy, similarity[best])
+
+    logger.debug(f"MMR selected {len(selected)} of {len(candidates)} candidates (lambda={lambda_})")
+    return [candidates[i] for i in selected]
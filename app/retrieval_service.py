@@ -0,0 +1,498 @@
+import argparse
+import http.client
+import json
+import logging
+import queue
+import socket
+import socketserver
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .context import collect_context_chunks
+from .encoder import configure_encoder, get_encoder
+from .index import EmbeddingIndex, configure_index, get_index
+from .lexical_index import BM25Index
+from .metrics import span
+from .rerank import gather_chunk_embeddings
+from .semantic_search import reciprocal_rank_fusion
+
+# Set up a logger for this module.
+logger = logging.getLogger('retrieval_service')
+logger.info("Retrieval service module initialized")
+
+# Address the service listens on when neither the command line nor the config sets one.
+DEFAULT_ADDRESS = 'unix:/tmp/narrative-retrieval.sock'
+
+# Connections the listening socket queues before the service accepts them. Workers
+# connect all at once when a run starts; socketserver's default of 5 drops most of them.
+REQUEST_QUEUE_SIZE = 128
+
+
+def parse_address(address: str) -> Tuple[str, Any]:
+    """Parses a service address.
+
+    Args:
+        address: 'unix:<path>' for a Unix socket, or '[http://]host:port' for TCP.
+
+    Returns:
+        ('unix', path) or ('tcp', (host, port)).
+    """
+    if address.startswith('unix:'):
+        return 'unix', address[len('unix:'):]
+    host, _, port = address.replace('http://', '', 1).rstrip('/').rpartition(':')
+    if not host or not port.isdigit():
+        raise ValueError(f"Invalid retrieval service address '{address}', expected unix:<path> or host:port")
+    return 'tcp', (host, int(port))
+
+
+class _SearchRequest:
+    def __init__(self, queries: List[str], top_n: int, filters: Optional[Dict[str, Any]]):
+        self.queries = queries
+        self.top_n = top_n
+        self.filters = filters
+        self.future: Future = Future()
+
+
+class SearchBatcher:
+    """Combines concurrent search requests into batches.
+
+    The first request of a batch waits up to `max_wait` seconds for others,
+    until `max_batch` queries are collected. All queries of the batch are
+    encoded in one call, and the queries with the same filters are scored
+    in one matrix product (EmbeddingIndex.search_batch).
+    """
+
+    def __init__(self, index: EmbeddingIndex, encoder: Any, max_batch: int = 32, max_wait: float = 0.002):
+        self.index = index
+        self.encoder = encoder
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.batches = 0
+        self.queries = 0
+        self._queue: "queue.Queue[Optional[_SearchRequest]]" = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='search-batcher', daemon=True)
+        self._thread.start()
+
+    def search(self, queries: List[str], top_n: int = 3,
+               filters: Optional[Dict[str, Any]] = None) -> List[List[Tuple[str, int, float]]]:
+        """Searches for several queries, batched with the concurrent requests of other callers."""
+        if not queries:
+            return []
+        request = _SearchRequest(queries, top_n, filters)
+        self._queue.put(request)
+        return request.future.result()
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self) -> None:
+        while True:
+            request = self._queue.get()
+            if request is None:
+                return
+            batch = [request]
+            size = len(request.queries)
+            deadline = time.perf_counter() + self.max_wait
+            while size < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if request is None:
+                    self._queue.put(None)
+                    break
+                batch.append(request)
+                size += len(request.queries)
+            self._process(batch)
+
+    def _process(self, batch: List[_SearchRequest]) -> None:
+        texts = [query for request in batch for query in request.queries]
+        self.batches += 1
+        self.queries += len(texts)
+        try:
+            with span('encode_query', queries=len(texts)):
+                embeddings = np.asarray(self.encoder.encode(texts), dtype=np.float32)
+
+            # Requests with the same filters share one scan of the matrix
+            groups: Dict[str, List[int]] = {}
+            for i, request in enumerate(batch):
+                groups.setdefault(json.dumps(request.filters, sort_keys=True), []).append(i)
+            offsets = np.cumsum([0] + [len(request.queries) for request in batch])
+            results: List[Optional[List[List[Tuple[str, int, float]]]]] = [None] * len(batch)
+            for members in groups.values():
+                rows = np.concatenate([np.arange(offsets[i], offsets[i + 1]) for i in members])
+                found = self.index.search_batch(embeddings[rows], max(batch[i].top_n for i in members),
+                                                batch[members[0]].filters)
+                position = 0
+                for i in members:
+                    count = len(batch[i].queries)
+                    results[i] = [ranking[:batch[i].top_n] for ranking in found[position:position + count]]
+                    position += count
+        except Exception as e:
+            logger.error(f"Search batch of {len(texts)} queries failed: {e}")
+            for request in batch:
+                request.future.set_exception(e)
+            return
+        for request, result in zip(batch, results):
+            request.future.set_result(result)
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def address_string(self) -> str:
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format: str, *args: Any) -> None:
+        logger.debug(f"{self.address_string()} {format % args}")
+
+    def _send(self, status: int, payload: Dict[str, Any]) -> None:
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        if self.path == '/health':
+            self._send(200, self.server.service.health())
+        elif self.path == '/files':
+            self._send(200, {'files': self.server.service.files()})
+        elif self.path == '/mean_vector':
+            self._send(200, {'mean_vector': self.server.service.index.mean_vector().tolist()})
+        else:
+            self._send(404, {'error': f"Unknown path {self.path}"})
+
+    def do_POST(self) -> None:
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length) or b'{}')
+            if self.path == '/search':
+                queries = request['queries']
+                if not isinstance(queries, list) or not all(isinstance(query, str) for query in queries):
+                    raise ValueError("'queries' must be a list of strings")
+                results = self.server.service.search(queries, int(request.get('top_n', 3)), request.get('filters'))
+                self._send(200, {'results': results})
+            elif self.path == '/hybrid_search':
+                queries = request['queries']
+                if not isinstance(queries, list) or not all(isinstance(query, str) for query in queries):
+                    raise ValueError("'queries' must be a list of strings")
+                results = self.server.service.hybrid_search(
+                    queries, int(request.get('top_n', 3)), int(request.get('candidates', 50)),
+                    int(request.get('rrf_k', 60)), request.get('filters'))
+                self._send(200, {'results': results})
+            elif self.path == '/encode':
+                embeddings = self.server.service.encode(request['texts'])
+                self._send(200, {'embeddings': embeddings.tolist()})
+            elif self.path == '/chunks':
+                texts = self.server.service.chunk_texts(request['chunks'])
+                self._send(200, {'texts': texts})
+            elif self.path == '/chunk_embeddings':
+                embeddings = self.server.service.chunk_embeddings(request['chunks'])
+                self._send(200, {'embeddings': embeddings.tolist()})
+            else:
+                self._send(404, {'error': f"Unknown path {self.path}"})
+        except (KeyError, ValueError, TypeError) as e:
+            self._send(400, {'error': f"Invalid request: {e}"})
+        except Exception as e:
+            logger.error(f"Request to {self.path} failed: {e}")
+            self._send(500, {'error': str(e)})
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = REQUEST_QUEUE_SIZE
+
+
+class _TCPHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = REQUEST_QUEUE_SIZE
+
+
+class RetrievalService:
+    """Serves semantic search over one shared index and encoder.
+
+    Besides dense and hybrid search, the service returns the chunk texts,
+    chunk embeddings and mean vector that workers need for the prompt, MMR
+    and evaluation. A worker that uses a RetrievalClient (see
+    RetrievalClient.embeddings) loads no embeddings, chunk texts, index or
+    sentence encoder; it holds only the file list.
+    """
+
+    def __init__(self, embeddings_dict: Dict[str, Any], encoder: Optional[Any] = None,
+                 max_batch: int = 32, max_wait: float = 0.002, lexical_index: Optional[BM25Index] = None):
+        # Keep the encoder loaded now, rather than whatever get_encoder() returns later
+        self.encoder = encoder if encoder is not None else get_encoder()
+        self.embeddings_dict = embeddings_dict
+        self.index = get_index(embeddings_dict)
+        self.batcher = SearchBatcher(self.index, self.encoder, max_batch, max_wait)
+        # Built on the first hybrid search if not given
+        self.lexical_index = lexical_index
+        self._lexical_lock = threading.Lock()
+        self._server: Optional[socketserver.BaseServer] = None
+
+    def search(self, queries: List[str], top_n: int = 3,
+               filters: Optional[Dict[str, Any]] = None) -> List[List[Tuple[str, int, float]]]:
+        return self.batcher.search(queries, top_n, filters)
+
+    def hybrid_search(self, queries: List[str], top_n: int = 3, candidates: int = 50, rrf_k: int = 60,
+                      filters: Optional[Dict[str, Any]] = None) -> List[List[Tuple[str, int, float]]]:
+        """Fuses dense and BM25 rankings like semantic_search.hybrid_search, with batched dense search."""
+        with self._lexical_lock:
+            if self.lexical_index is None:
+                self.lexical_index = BM25Index.build(self.embeddings_dict)
+        dense = self.search(queries, candidates, filters)
+        allowed_files = None
+        if filters:
+            allowed_files = {self.index.file_paths[file_id] for file_id in self.index.files_matching(filters)}
+        results = []
+        for query, ranking in zip(queries, dense):
+            with span('lexical_search'):
+                lexical = self.lexical_index.search(query, candidates, allowed_files)
+            results.append(reciprocal_rank_fusion([ranking, lexical], rrf_k)[:top_n])
+        return results
+
+    def files(self) -> Dict[str, Dict[str, Any]]:
+        """Returns the number of chunks and the metadata of each file."""
+        return {file_path: {'chunks': len(data['chunk_embeddings']), 'metadata': data.get('metadata', {})}
+                for file_path, data in self.embeddings_dict.items()}
+
+    def chunk_texts(self, chunks: List[Tuple[str, int]]) -> List[str]:
+        """Returns the texts of (file_path, chunk_index) pairs."""
+        context_chunks = collect_context_chunks(self.embeddings_dict, [(file_path, int(chunk_idx), 0.0)
+                                                                       for file_path, chunk_idx in chunks])
+        return [chunk['text'] for chunk in context_chunks]
+
+    def chunk_embeddings(self, chunks: List[Tuple[str, int]]) -> np.ndarray:
+        """Returns the embeddings of (file_path, chunk_index) pairs, one row per chunk."""
+        return gather_chunk_embeddings(self.embeddings_dict, [(file_path, int(chunk_idx), 0.0)
+                                                              for file_path, chunk_idx in chunks])
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        with span('encode_texts', texts=len(texts)):
+            return np.asarray(self.encoder.encode(list(texts)), dtype=np.float32)
+
+    def health(self) -> Dict[str, Any]:
+        return {
+            'status': 'ok',
+            'chunks': len(self.index),
+            'files': self.index.num_files,
+            'precision': self.index.precision,
+            'batches': self.batcher.batches,
+            'queries': self.batcher.queries,
+        }
+
+    def serve(self, address: str) -> None:
+        """Serves requests on `address` (see parse_address) until shutdown() is called."""
+        kind, target = parse_address(address)
+        if kind == 'unix':
+            Path(target).unlink(missing_ok=True)
+            self._server = _UnixHTTPServer(target, _RequestHandler)
+        else:
+            self._server = _TCPHTTPServer(target, _RequestHandler)
+        self._server.service = self
+        logger.info(f"Retrieval service listening on {address} ({len(self.index)} chunks)")
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            if kind == 'unix':
+                Path(target).unlink(missing_ok=True)
+
+    def shutdown(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+        self.batcher.close()
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path: str, timeout: float):
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self) -> None:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # A non-blocking connect fails at once with EAGAIN while the listen queue is full;
+        # a blocking one waits for the service to accept it
+        self.sock.connect(self.path)
+        self.sock.settimeout(self.timeout)
+
+
+class RemoteChunks(Sequence):
+    """The chunk texts of one file, read from a RetrievalService when they are accessed.
+
+    Stands in for the list of chunk texts ('chunk_content') of an embeddings
+    dictionary, like chunk_store.FileChunks, so a worker holds no chunk text.
+    """
+
+    def __init__(self, client: 'RetrievalClient', file_path: str, count: int):
+        self.client = client
+        self.file_path = file_path
+        self.count = count
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.client.chunk_texts([(self.file_path, i) for i in range(*index.indices(self.count))])
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError('chunk index out of range')
+        return self.client.chunk_texts([(self.file_path, index)])[0]
+
+    def __iter__(self) -> Iterator[str]:
+        for index in range(self.count):
+            yield self[index]
+
+    def __repr__(self) -> str:
+        return f"RemoteChunks({self.count} chunks of {self.file_path} from {self.client.address})"
+
+
+class RetrievalClient:
+    """Searches and encodes through a running RetrievalService.
+
+    The client has an `encode(texts)` method, so it can also be installed as
+    the shared encoder (encoder.set_encoder) to keep the sentence model out
+    of the worker process.
+    """
+
+    def __init__(self, address: str, timeout: float = 30.0):
+        self.address = address
+        self.timeout = timeout
+        self._kind, self._target = parse_address(address)
+        self._local = threading.local()
+
+    def _connection(self) -> http.client.HTTPConnection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            if self._kind == 'unix':
+                connection = _UnixHTTPConnection(self._target, self.timeout)
+            else:
+                connection = http.client.HTTPConnection(*self._target, timeout=self.timeout)
+            self._local.connection = connection
+        return connection
+
+    def _request(self, method: str, path: str, payload: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        body = json.dumps(payload).encode('utf-8') if payload is not None else None
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        for attempt in range(2):
+            connection = self._connection()
+            try:
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+                data = json.loads(response.read() or b'{}')
+                break
+            except (OSError, http.client.HTTPException) as e:
+                # The kept-alive connection may have been closed by the service; retry once on a new one
+                connection.close()
+                self._local.connection = None
+                if attempt:
+                    raise ConnectionError(f"Retrieval service at {self.address} is not reachable: {e}") from e
+        if response.status != 200:
+            raise ConnectionError(f"Retrieval service error {response.status}: {data.get('error')}")
+        return data
+
+    def health(self) -> Dict[str, Any]:
+        return self._request('GET', '/health')
+
+    def search(self, query: str, top_n: int = 3,
+               filters: Optional[Dict[str, Any]] = None) -> List[Tuple[str, int, float]]:
+        """Finds the chunks most similar to a query, like semantic_search."""
+        return self.search_many([query], top_n, filters)[0]
+
+    def search_many(self, queries: Sequence[str], top_n: int = 3,
+                    filters: Optional[Dict[str, Any]] = None) -> List[List[Tuple[str, int, float]]]:
+        response = self._request('POST', '/search', {'queries': list(queries), 'top_n': top_n, 'filters': filters})
+        return [[(file_path, chunk_idx, score) for file_path, chunk_idx, score in ranking]
+                for ranking in response['results']]
+
+    def hybrid_search(self, query: str, top_n: int = 3, candidates: int = 50, rrf_k: int = 60,
+                      filters: Optional[Dict[str, Any]] = None) -> List[Tuple[str, int, float]]:
+        """Fuses dense and BM25 rankings on the service, like semantic_search.hybrid_search."""
+        response = self._request('POST', '/hybrid_search', {'queries': [query], 'top_n': top_n,
+                                                            'candidates': candidates, 'rrf_k': rrf_k,
+                                                            'filters': filters})
+        return [(file_path, chunk_idx, score) for file_path, chunk_idx, score in response['results'][0]]
+
+    def encode(self, texts: Sequence[str]) -> np.ndarray:
+        response = self._request('POST', '/encode', {'texts': list(texts)})
+        return np.asarray(response['embeddings'], dtype=np.float32)
+
+    def mean_vector(self) -> np.ndarray:
+        """Returns the mean of the service's normalized chunk embeddings (see EmbeddingIndex.mean_vector)."""
+        return np.asarray(self._request('GET', '/mean_vector')['mean_vector'], dtype=np.float32)
+
+    def chunk_texts(self, chunks: Sequence[Tuple[str, int]]) -> List[str]:
+        """Returns the texts of (file_path, chunk_index) pairs."""
+        if not chunks:
+            return []
+        return self._request('POST', '/chunks', {'chunks': [list(chunk) for chunk in chunks]})['texts']
+
+    def chunk_embeddings(self, chunks: Sequence[Tuple[str, int]]) -> np.ndarray:
+        """Returns the embeddings of (file_path, chunk_index) pairs, one row per chunk."""
+        response = self._request('POST', '/chunk_embeddings', {'chunks': [list(chunk) for chunk in chunks]})
+        return np.asarray(response['embeddings'], dtype=np.float32)
+
+    def embeddings(self) -> Dict[str, Dict[str, Any]]:
+        """Returns an embeddings dictionary whose chunk texts are read from the service.
+
+        Each file has 'chunk_content' (a RemoteChunks) and 'metadata', but no
+        embeddings, so it can be passed to prepare_context and the ROUGE
+        scoring. Searches, MMR and the semantic similarity have to go through
+        the client (StoryGenerator does this when a service is configured).
+        """
+        return {file_path: {'chunk_content': RemoteChunks(self, file_path, info['chunks']),
+                            'metadata': info['metadata']}
+                for file_path, info in self._request('GET', '/files')['files'].items()}
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """Runs the retrieval service from the command line."""
+    from .lexical_index import load_or_build_lexical_index
+    from .setup_logging import setup_logging
+    from .utils import load_config, load_embeddings
+
+    parser = argparse.ArgumentParser(description="Serve semantic search over one shared embedding index")
+    parser.add_argument('--embeddings', type=Path, default=Path('data/embeddings.json'))
+    parser.add_argument('--config', default='config.yaml')
+    parser.add_argument('--address', help=f"unix:<path> or host:port (default: retrieval.service.address, "
+                                          f"or {DEFAULT_ADDRESS})")
+    args = parser.parse_args(argv)
+
+    setup_logging()
+    config = load_config(args.config)
+    retrieval = config.get('retrieval', {}) or {}
+    service_config = retrieval.get('service', {}) or {}
+    configure_index(retrieval.get('index'))
+    configure_encoder(config.get('encoder'))
+
+    embeddings_dict = load_embeddings(args.embeddings)
+    # Load the stored BM25 index now rather than building it on the first hybrid search
+    lexical_index = (load_or_build_lexical_index(args.embeddings, embeddings_dict)
+                     if retrieval.get('mode') == 'hybrid' else None)
+    service = RetrievalService(embeddings_dict,
+                               max_batch=service_config.get('max_batch', 32),
+                               max_wait=service_config.get('max_wait_ms', 2) / 1000,
+                               lexical_index=lexical_index)
+    try:
+        service.serve(args.address or service_config.get('address') or DEFAULT_ADDRESS)
+    except KeyboardInterrupt:
+        logger.info("Retrieval service stopped")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,30 +1,41 @@
+import io
 import logging
-from typing import List, Tuple, Dict, Any
+from typing import TYPE_CHECKING, Iterable, Iterator, List, Tuple, Dict, Any, Optional
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
-import google.generativeai as genai
-from sentence_transformers import SentenceTransformer
+
+from .encoder import get_encoder
+from .index import get_index
+from .metrics import span
+from .text_processing import iter_chunks, sentence_windows
+
+if TYPE_CHECKING:
+    import google.generativeai as genai
 
 # Set up a logger for this module.
 logger = logging.getLogger('semantic_search')
 logger.info("Semantic search module initialized")
 
-# Initialize the sentence transformer model
-model = SentenceTransformer('all-mpnet-base-v2')
 
 def semantic_search(
-    genai_model: genai.GenerativeModel,
+    genai_model: 'genai.GenerativeModel',
     query: str,
     embeddings_dict: Dict[str, Any],
-    top_n: int = 3
+    top_n: int = 3,
+    filters: Optional[Dict[str, Any]] = None
 ) -> List[Tuple[str, int, float]]:
     """Perform semantic search on embeddings.
 
+    The embeddings are searched through their EmbeddingIndex, a single matrix
+    built once per embeddings dictionary. With `filters`, only the rows of the
+    files whose metadata matches are scanned.
+
     Args:
         model: The generative model to use for generating embeddings.
         query: The query string.
-        embeddings_dict: A dictionary where keys are file paths and values are dictionaries containing 'content' and 'chunk_embeddings'.
+        embeddings_dict: A dictionary where keys are file paths and values are dictionaries containing 'content' and 'chunk_embeddings' (and optionally 'metadata').
         top_n: The number of most relevant chunks to return.
+        filters: Optional metadata filters, e.g. {'type': 'manuscript', 'tags': ['pov-elara']}.
+            See EmbeddingIndex.files_matching.
 
     Returns:
         A list of tuples, each containing (file_path, chunk_index, similarity_score).
@@ -33,7 +44,8 @@ def semantic_search(
 
     try:
         # Generate query embedding using sentence transformers
-        query_embedding = model.encode([query])[0]
+        with span('encode_query'):
+            query_embedding = get_encoder().encode([query])[0]
     except Exception as e:
         logger.error(f"Error generating embedding for query '{query}': {e}")
         return []
@@ -42,14 +54,218 @@ def semantic_search(
         logger.error("Could not generate embedding for query")
         return []
 
-    similarities = []
-    for file_path, data in embeddings_dict.items():
-        # Always use chunk_embeddings
-        for i, chunk_embedding in enumerate(data['chunk_embeddings']):
-            similarity = cosine_similarity(
-                [query_embedding], [chunk_embedding])[0][0]
-            similarities.append((file_path, i, similarity))
-
-    similarities.sort(key=lambda x: x[2], reverse=True)
-    logger.info(f"Found {len(similarities)} similar chunks, returning top {top_n}")
-    return similarities[:top_n]
+    index = get_index(embeddings_dict)
+    similarities = index.search(query_embedding, top_n, filters)
+    logger.info(f"Searched {len(index)} chunks, returning top {len(similarities)}")
+    return similarities
+
+
+def reciprocal_rank_fusion(rankings: List[List[Tuple[str, int, float]]], k: int = 60) -> List[Tuple[str, int, float]]:
+    """Fuse several rankings of chunks with reciprocal rank fusion.
+
+    Each chunk scores sum(1 / (k + rank)) over the rankings it appears in
+    (ranks start at 1). The fused scores are divided by the best possible
+    score, len(rankings) / (k + 1), so they lie in [0, 1].
+
+    Args:
+        rankings: Lists of (file_path, chunk_index, score) tuples, each sorted best first.
+        k: The RRF damping constant; larger values flatten the contribution of top ranks.
+
+    Returns:
+        A list of (file_path, chunk_index, fused_score) tuples, sorted by fused score.
+    """
+    fused: Dict[Tuple[str, int], float] = {}
+    for ranking in rankings:
+        for rank, (file_path, chunk_idx, _) in enumerate(ranking, start=1):
+            fused[(file_path, chunk_idx)] = fused.get((file_path, chunk_idx), 0.0) + 1.0 / (k + rank)
+    best_possible = max(len(rankings), 1) / (k + 1)
+    results = [(file_path, chunk_idx, score / best_possible) for (file_path, chunk_idx), score in fused.items()]
+    results.sort(key=lambda x: x[2], reverse=True)
+    return results
+
+
+def hybrid_search(
+    genai_model: 'genai.GenerativeModel',
+    query: str,
+    embeddings_dict: Dict[str, Any],
+    lexical_index: Any,
+    top_n: int = 3,
+    candidates: int = 50,
+    rrf_k: int = 60,
+    filters: Optional[Dict[str, Any]] = None
+) -> List[Tuple[str, int, float]]:
+    """Perform hybrid lexical + semantic search.
+
+    The `candidates` best chunks by embedding similarity and by BM25 score are
+    fused with reciprocal rank fusion, so chunks that mention exact names of
+    characters, places or artifacts are found even when their embeddings are
+    not the closest.
+
+    Args:
+        genai_model: The generative model (passed through to semantic_search).
+        query: The query string.
+        embeddings_dict: A dictionary where keys are file paths and values are dictionaries containing 'content' and 'chunk_embeddings'.
+        lexical_index: A BM25Index built over the same embeddings.
+        top_n: The number of most relevant chunks to return.
+        candidates: The number of candidates taken from each retriever before fusion.
+        rrf_k: The reciprocal rank fusion constant.
+        filters: Optional metadata filters, applied to both retrievers.
+
+    Returns:
+        A list of tuples, each containing (file_path, chunk_index, fused_score), where
+        fused_score is the normalized RRF score in [0, 1].
+    """
+    dense = semantic_search(genai_model, query, embeddings_dict, candidates, filters)
+    allowed_files = None
+    if filters:
+        index = get_index(embeddings_dict)
+        allowed_files = {index.file_paths[file_id] for file_id in index.files_matching(filters)}
+    with span('lexical_search'):
+        lexical = lexical_index.search(query, candidates, allowed_files)
+    fused = reciprocal_rank_fusion([dense, lexical], rrf_k)
+    logger.info(f"Hybrid search fused {len(dense)} dense and {len(lexical)} lexical candidates, returning top {top_n}")
+    return fused[:top_n]
+
+
+def embed_texts(texts: List[str]) -> np.ndarray:
+    """Encode texts into L2-normalized embedding vectors.
+
+    Args:
+        texts: The texts to encode.
+
+    Returns:
+        A float32 array of shape (len(texts), dimensions) whose rows have unit length,
+        so dot products between rows are cosine similarities.
+    """
+    embeddings = np.asarray(get_encoder().encode(list(texts)), dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / np.maximum(norms, 1e-12)
+
+
+def embed_chunks(chunks: Iterable[Tuple[int, int, str]],
+                 batch_size: int = 64) -> Iterator[Tuple[List[Tuple[int, int, str]], np.ndarray]]:
+    """Encode a stream of chunks (e.g. from text_processing.iter_file_chunks) batch by batch.
+
+    Only one batch is held at a time, so a file can be chunked and encoded
+    without being read into memory whole.
+
+    Yields:
+        (chunks, embeddings) pairs: up to `batch_size` (start, end, text) chunks and
+        their normalized embeddings, as returned by embed_texts().
+    """
+    batch: List[Tuple[int, int, str]] = []
+    for chunk in chunks:
+        batch.append(chunk)
+        if len(batch) >= batch_size:
+            yield batch, embed_texts([text for _, _, text in batch])
+            batch = []
+    if batch:
+        yield batch, embed_texts([text for _, _, text in batch])
+
+
+def score_texts(query: str, texts: List[str]) -> List[float]:
+    """Score short texts by their semantic similarity to a query.
+
+    Args:
+        query: The query string.
+        texts: The texts to score.
+
+    Returns:
+        A list of cosine similarity scores, one per text, in the input order.
+    """
+    if not texts:
+        return []
+    embeddings = embed_texts([query] + list(texts))
+    return [float(similarity) for similarity in embeddings[1:] @ embeddings[0]]
+
+
+def encode_long_text(text: str, window_words: int = 200, pooling: str = 'mean',
+                     max_segments: int = 32) -> np.ndarray:
+    """Encode a text of any length into one L2-normalized embedding.
+
+    The encoder truncates its input at its maximum sequence length (384
+    tokens for all-mpnet-base-v2), so encoding a whole chapter at once only
+    measures its beginning. The text is split into windows of whole
+    sentences (see text_processing.sentence_windows), the windows are
+    encoded in one batch and their embeddings are pooled.
+
+    Args:
+        text: The text to encode.
+        window_words: The maximum number of words per window; about 200 words fit in 384 tokens.
+        pooling: 'mean' (weighted by the words in each window) or 'max' (per dimension).
+        max_segments: The most windows encoded. Longer texts are represented by evenly
+            spaced windows, so the cost is bounded.
+
+    Returns:
+        A float32 vector with unit length.
+    """
+    if pooling not in ('mean', 'max'):
+        raise ValueError(f"Unknown pooling '{pooling}', expected mean or max")
+    windows = sentence_windows(text, window_words) or [text]
+    if len(windows) > max_segments:
+        windows = [windows[i] for i in np.linspace(0, len(windows) - 1, max_segments).round().astype(int)]
+
+    embeddings = embed_texts(windows)
+    if pooling == 'max':
+        pooled = embeddings.max(axis=0)
+    else:
+        weights = np.array([len(window.split()) for window in windows], dtype=np.float32)
+        pooled = weights @ embeddings / max(float(weights.sum()), 1.0)
+    return pooled / max(float(np.linalg.norm(pooled)), 1e-12)
+
+
+def add_document(embeddings_dict: Dict[str, Any], file_path: str, text: str,
+                 metadata: Optional[Dict[str, Any]] = None, chunk_size: int = 5000,
+                 chunk_overlap: int = 200) -> int:
+    """Chunk, encode and add a document to an embeddings dictionary and its search index.
+
+    The document becomes searchable at once: its rows are appended to the
+    dictionary's EmbeddingIndex in place instead of rebuilding it. A
+    document with the same path is replaced. The text is chunked at
+    paragraph and sentence boundaries (text_processing.iter_chunks) and
+    encoded a batch of chunks at a time (embed_chunks).
+
+    Args:
+        embeddings_dict: The embeddings dictionary to add the document to.
+        file_path: The key of the document, e.g. 'generated/chapter_12.md'.
+        text: The document text.
+        metadata: Optional metadata for filtered search (see EmbeddingIndex.files_matching).
+        chunk_size: The chunk size in characters (the `embedding.chunk_size` setting).
+        chunk_overlap: The overlap between chunks in characters (`embedding.chunk_overlap`).
+
+    Returns:
+        The number of chunks added.
+    """
+    chunks: List[str] = []
+    batches = []
+    with span('encode_document') as attributes:
+        for batch, batch_embeddings in embed_chunks(iter_chunks(io.StringIO(text), chunk_size, chunk_overlap)):
+            chunks.extend(chunk for _, _, chunk in batch)
+            batches.append(batch_embeddings)
+        attributes['chunks'] = len(chunks)
+    embeddings = np.concatenate(batches) if batches else np.zeros((0, 0), dtype=np.float32)
+    # Look up the index before changing the dictionary, so it is not rebuilt
+    index = get_index(embeddings_dict)
+    embeddings_dict[file_path] = {
+        'content': text,
+        'chunk_content': chunks,
+        'chunk_embeddings': embeddings,
+        'metadata': dict(metadata or {}),
+    }
+    index.add(file_path, embeddings, metadata)
+    logger.info(f"Added {file_path} ({len(chunks)} chunks) to the index")
+    return len(chunks)
+
+
+def remove_document(embeddings_dict: Dict[str, Any], file_path: str) -> bool:
+    """Remove a document from an embeddings dictionary and its search index.
+
+    Returns:
+        Whether the document was in the dictionary.
+    """
+    if file_path not in embeddings_dict:
+        return False
+    get_index(embeddings_dict).remove(file_path)
+    del embeddings_dict[file_path]
+    logger.info(f"Removed {file_path} from the index")
+    return True
@@ -1,56 +1,452 @@
-import logging
-from typing import Dict, Any
-from pathlib import Path
 import json
+import logging
+import os
+import threading
+import time
+from collections.abc import Sequence
 from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
 
 # Set up a logger for this module.
 logger = logging.getLogger('session')
 logger.info("Session module initialized")
 
+# Where sessions are written unless `session.directory` says otherwise.
+DEFAULT_SESSION_DIRECTORY = Path('sessions')
+
+# When appended records are forced to disk (see SessionJournal).
+FSYNC_POLICIES = ('always', 'interval', 'never')
+
+_JOURNAL_FILE = 'journal.jsonl'
+_SNAPSHOT_FILE = 'snapshot.json'
+_SNAPSHOT_VERSION = 1
+
+# Record types that hold session state rather than history entries.
+_STATE_RECORD = 'state'
+_STATE_FIELDS = ('settings', 'plot_outline', 'chapter_counter', 'story_memory')
+
+# How sessions are stored (see configure_sessions).
+_session_options: Dict[str, Any] = {'directory': DEFAULT_SESSION_DIRECTORY, 'fsync': 'interval',
+                                    'fsync_interval': 1.0, 'resume_chapters': 3, 'snapshot_every': 50}
+
 
-def save_session(session_data: Dict[str, Any], filename: str = None):
-    """Saves the current session data to a JSON file.
+def _copy_state(value: Any) -> Any:
+    """Returns a copy of a state value as it is stored in the journal (JSON types only)."""
+    return json.loads(json.dumps(value, ensure_ascii=False))
+
+
+def configure_sessions(session_config: Optional[Dict[str, Any]]) -> None:
+    """Sets where and how sessions are written, from the `session` config section.
 
     Args:
-        session_data: A dictionary containing the session data.
-        filename: The name of the file to save the session to. If None, a timestamped filename is generated.
+        session_config: 'directory' for the session journals; 'fsync' ('always', 'interval'
+            or 'never') with 'fsync_interval' in seconds; 'snapshot_every' records between
+            compacted snapshots; 'resume_chapters' read in when a session is resumed.
+            Missing keys take their defaults.
+    """
+    session_config = session_config or {}
+    fsync = session_config.get('fsync') or 'interval'
+    if fsync not in FSYNC_POLICIES:
+        logger.warning(f"Unknown session fsync policy '{fsync}', using interval")
+        fsync = 'interval'
+    _session_options.update({
+        'directory': Path(session_config.get('directory') or DEFAULT_SESSION_DIRECTORY),
+        'fsync': fsync,
+        'fsync_interval': float(session_config.get('fsync_interval', 1.0)),
+        'resume_chapters': int(session_config.get('resume_chapters', 3)),
+        'snapshot_every': max(int(session_config.get('snapshot_every') or 50), 1),
+    })
+
+
+def session_path(name: Union[str, Path]) -> Path:
+    """Returns the directory of a session, given its name or path."""
+    path = Path(name)
+    if path.suffix == '.json':
+        path = path.with_suffix('')
+    if path.is_dir():
+        return path
+    return _session_options['directory'] / path.name
+
+
+class SessionHistory(Sequence):
+    """The query and generation records of a session, read from its journal on access.
+
+    Only the byte offsets of the records are kept in memory, along with
+    the records that were read in when the session was resumed. Other
+    records are read from the journal when they are indexed or iterated,
+    so a long session can be resumed without reading every chapter.
+    """
+
+    def __init__(self, journal_path: Path, entries: List[Tuple[int, str]],
+                 cache: Optional[Dict[int, Dict[str, Any]]] = None):
+        self.journal_path = journal_path
+        self._entries = entries
+        self._cache = cache if cache is not None else {}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self._read(self._entries[index]))
+        return next(self._read([self._entries[index]]))
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        return self._read(list(self._entries))
+
+    def _read(self, entries: List[Tuple[int, str]]) -> Iterator[Dict[str, Any]]:
+        f = None
+        try:
+            for offset, _ in entries:
+                record = self._cache.get(offset)
+                if record is None:
+                    if f is None:
+                        f = open(self.journal_path, 'rb')
+                    f.seek(offset)
+                    record = _history_entry(json.loads(f.readline()))
+                yield record
+        finally:
+            if f is not None:
+                f.close()
+
+
+def _history_entry(record: Dict[str, Any]) -> Dict[str, Any]:
+    """Returns a journal record in the shape of a session history entry."""
+    return {key: value for key, value in record.items() if key != 'seq'}
+
+
+class SessionJournal:
+    """An append-only session file, with compacted snapshots for fast resuming.
+
+    Every query, generation and change of the session state (settings,
+    plot outline, chapter counter, story memory summary) is appended to `journal.jsonl` as one
+    JSON line when it happens, so saving never rewrites earlier chapters.
+    Every `snapshot_every` records, and on snapshot() and close(), the
+    state is compacted into `snapshot.json`: the current state, the byte
+    offsets of all history records and the journal length it covers.
+    Resuming reads the snapshot, replays only the records appended after
+    it, and reads in the last chapters; older history is read from the
+    journal on access (see SessionHistory).
+
+    Records are flushed to the operating system as they are written.
+    The `fsync` policy decides when they are also forced to disk:
+    'always' after every record, 'interval' at most every
+    `fsync_interval` seconds, and 'never' leaves it to the operating
+    system. A record cut short by a crash is dropped when the session is
+    resumed; an unreadable record followed by others is skipped.
+    """
+
+    def __init__(self, directory: Path, fsync: str = 'interval', fsync_interval: float = 1.0,
+                 snapshot_every: int = 50):
+        self.directory = Path(directory)
+        self.name = self.directory.name
+        self.journal_path = self.directory / _JOURNAL_FILE
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.snapshot_every = snapshot_every
+        self.settings: Dict[str, Any] = {}
+        self.plot_outline = ""
+        self.chapter_counter = 0
+        self.story_memory: Optional[Dict[str, Any]] = None
+        self._entries: List[Tuple[int, str]] = []
+        self._cache: Dict[int, Dict[str, Any]] = {}
+        self._seq = 0
+        self._unsnapshotted = 0
+        self._last_fsync = time.monotonic()
+        self._lock = threading.Lock()
+        self._file = None
+
+    @classmethod
+    def create(cls, name: Optional[str] = None) -> 'SessionJournal':
+        """Starts a new session in the configured directory (named by timestamp by default)."""
+        if name is None:
+            base = name = f"story_session_{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+            suffix = 1
+            while (session_path(name) / _JOURNAL_FILE).exists():
+                suffix += 1
+                name = f"{base}-{suffix}"
+        directory = session_path(name)
+        if (directory / _JOURNAL_FILE).exists():
+            raise FileExistsError(f"Session already exists: {directory}")
+        directory.mkdir(parents=True, exist_ok=True)
+        journal = cls(directory, _session_options['fsync'], _session_options['fsync_interval'],
+                      _session_options['snapshot_every'])
+        journal._open(0)
+        logger.info(f"Started session {journal.name} in {directory}")
+        return journal
+
+    @classmethod
+    def resume(cls, name: Union[str, Path], recent_chapters: Optional[int] = None) -> 'SessionJournal':
+        """Opens an existing session; new records are appended to it.
+
+        Args:
+            name: The session name or directory.
+            recent_chapters: Chapters (generation records, with the records after the
+                first of them) read in right away; defaults to `session.resume_chapters`.
+
+        Raises:
+            FileNotFoundError: If the session has no journal.
+        """
+        directory = session_path(name)
+        journal = cls(directory, _session_options['fsync'], _session_options['fsync_interval'],
+                      _session_options['snapshot_every'])
+        if not journal.journal_path.exists():
+            raise FileNotFoundError(f"Session not found: {directory}")
+        started = time.perf_counter()
+        end = journal._load()
+        journal._preload(_session_options['resume_chapters'] if recent_chapters is None else recent_chapters)
+        journal._open(end)
+        logger.info(f"Resumed session {journal.name}: {len(journal._entries)} history records, "
+                    f"{len(journal._cache)} read in, in {time.perf_counter() - started:.3f} s")
+        return journal
+
+    @property
+    def history(self) -> SessionHistory:
+        """All history records of the session, oldest first."""
+        return SessionHistory(self.journal_path, self._entries, self._cache)
+
+    def recent_history(self) -> List[Dict[str, Any]]:
+        """The history records that were read in when the session was resumed."""
+        start = next((i for i, (offset, _) in enumerate(self._entries) if offset in self._cache),
+                     len(self._entries))
+        return self.history[start:]
+
+    def append(self, record_type: str, **fields: Any) -> None:
+        """Appends a history record, such as append('generation', content=text)."""
+        self._write(record_type, fields)
+
+    def update_state(self, **state: Any) -> None:
+        """Records changes of 'settings', 'plot_outline', 'chapter_counter' or 'story_memory'; unchanged values are skipped.
+
+        The values are copied, so a dict the caller changes in place later is
+        still compared against the state as it was recorded.
+        """
+        state = {field: _copy_state(value) for field, value in state.items() if field in _STATE_FIELDS}
+        changed = {field: value for field, value in state.items() if value != getattr(self, field)}
+        if changed:
+            self._write(_STATE_RECORD, changed)
+
+    def snapshot(self) -> None:
+        """Forces the journal to disk and writes a compacted snapshot of the session."""
+        with self._lock:
+            if self._file is None:
+                raise ValueError(f"Session {self.name} is closed")
+            self._snapshot()
+
+    def close(self) -> None:
+        """Writes a final snapshot if records were added since the last one, and closes the journal."""
+        with self._lock:
+            if self._file is None:
+                return
+            if self._unsnapshotted:
+                self._snapshot()
+            self._file.close()
+            self._file = None
+
+    def _open(self, end: int) -> None:
+        self._file = open(self.journal_path, 'ab')
+        if self._file.tell() > end:
+            logger.warning(f"Dropping {self._file.tell() - end} bytes of incomplete records from {self.journal_path}")
+            self._file.truncate(end)
+            self._file.seek(end)
+
+    def _write(self, record_type: str, fields: Dict[str, Any]) -> None:
+        with self._lock:
+            if self._file is None:
+                raise ValueError(f"Session {self.name} is closed")
+            self._seq += 1
+            record = {'seq': self._seq, 'time': datetime.now().isoformat(timespec='seconds'),
+                      'type': record_type, **fields}
+            offset = self._file.tell()
+            self._file.write(json.dumps(record, ensure_ascii=False).encode('utf-8') + b'\n')
+            self._file.flush()
+            if self.fsync == 'always' or (self.fsync == 'interval'
+                                          and time.monotonic() - self._last_fsync >= self.fsync_interval):
+                os.fsync(self._file.fileno())
+                self._last_fsync = time.monotonic()
+            self._apply(record, offset)
+            self._unsnapshotted += 1
+            if self._unsnapshotted >= self.snapshot_every:
+                self._snapshot()
+
+    def _apply(self, record: Dict[str, Any], offset: int) -> None:
+        self._seq = max(self._seq, record.get('seq', 0))
+        if record.get('type') == _STATE_RECORD:
+            for field in _STATE_FIELDS:
+                if field in record:
+                    setattr(self, field, _copy_state(record[field]))
+        else:
+            self._entries.append((offset, record.get('type')))
+
+    def _snapshot(self) -> None:
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._last_fsync = time.monotonic()
+        snapshot = {
+            'version': _SNAPSHOT_VERSION,
+            'seq': self._seq,
+            'journal_bytes': self._file.tell(),
+            **{field: getattr(self, field) for field in _STATE_FIELDS},
+            'history': self._entries,
+        }
+        temporary = self.directory / (_SNAPSHOT_FILE + '.tmp')
+        with open(temporary, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.directory / _SNAPSHOT_FILE)
+        self._unsnapshotted = 0
+        logger.debug(f"Snapshot of session {self.name} at record {self._seq}")
+
+    def _load(self) -> int:
+        """Reads the snapshot and replays the journal after it; returns the end of the last complete record."""
+        start = 0
+        snapshot_path = self.directory / _SNAPSHOT_FILE
+        if snapshot_path.exists():
+            try:
+                with open(snapshot_path, 'r', encoding='utf-8') as f:
+                    snapshot = json.load(f)
+                if snapshot.get('version') != _SNAPSHOT_VERSION:
+                    raise ValueError(f"unsupported version {snapshot.get('version')}")
+                for field in _STATE_FIELDS:
+                    if field in snapshot:
+                        setattr(self, field, snapshot[field])
+                self._entries = [(offset, record_type) for offset, record_type in snapshot['history']]
+                self._seq = snapshot['seq']
+                start = snapshot['journal_bytes']
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                logger.warning(f"Ignoring snapshot of session {self.name} ({e}), replaying the whole journal")
+                self.settings, self.plot_outline, self.chapter_counter, self.story_memory = {}, "", 0, None
+                self._entries, self._seq, start = [], 0, 0
+
+        # Unreadable lines followed by readable records are skipped; trailing ones are a torn
+        # final record that _open() cuts off
+        end = offset = start
+        skipped: List[int] = []
+        with open(self.journal_path, 'rb') as f:
+            f.seek(start)
+            for line in f:
+                record = None
+                if line.endswith(b'\n'):
+                    try:
+                        record = json.loads(line)
+                    except (json.JSONDecodeError, UnicodeDecodeError):
+                        pass
+                if isinstance(record, dict):
+                    if skipped:
+                        logger.warning(f"Skipping unreadable records of session {self.name} at bytes "
+                                       f"{', '.join(str(position) for position in skipped)}")
+                        skipped = []
+                    self._apply(record, offset)
+                    self._unsnapshotted += 1
+                    end = offset + len(line)
+                else:
+                    skipped.append(offset)
+                offset += len(line)
+        return end
+
+    def _preload(self, chapters: int) -> None:
+        generations = [i for i, (_, record_type) in enumerate(self._entries) if record_type == 'generation']
+        if chapters <= 0 or not generations:
+            return
+        start = generations[-min(chapters, len(generations))]
+        if start > 0 and self._entries[start - 1][1] == 'query':
+            start -= 1
+        for (offset, _), record in zip(self._entries[start:], self.history[start:]):
+            self._cache[offset] = record
+
+
+def new_session(name: Optional[str] = None) -> SessionJournal:
+    """Starts a new journaled session (see SessionJournal.create)."""
+    return SessionJournal.create(name)
+
+
+def resume_session(name: str, recent_chapters: Optional[int] = None) -> SessionJournal:
+    """Resumes a journaled session, converting a session saved as one JSON file first.
+
+    Raises:
+        FileNotFoundError: If there is no such session.
     """
-    if filename is None:
-        timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
-        filename = f"story_session_{timestamp}.json"
+    legacy_file = _legacy_session_file(name)
+    if legacy_file is not None and not (session_path(name) / _JOURNAL_FILE).exists():
+        session_data = _load_legacy_session(legacy_file)
+        save_session(session_data, legacy_file.stem)
+        logger.info(f"Converted session file {legacy_file} to a journal in {session_path(legacy_file.stem)}")
+        name = legacy_file.stem
+    return SessionJournal.resume(name, recent_chapters)
+
+
+def _legacy_session_file(filename: str) -> Optional[Path]:
+    """Finds a session saved as one JSON file, in the session directory or, as earlier versions did, app/."""
+    if not str(filename).endswith('.json'):
+        return None
+    for candidate in (Path(filename), _session_options['directory'] / filename, Path(__file__).parent / filename):
+        if candidate.is_file():
+            return candidate
+    return None
+
+
+def _load_legacy_session(filepath: Path) -> Dict[str, Any]:
+    with open(filepath, 'r') as f:
+        return json.load(f)
+
+
+def save_session(session_data: Dict[str, Any], filename: str = None) -> Optional[Path]:
+    """Saves session data as a new session journal.
 
-    filepath = Path(__file__).parent / filename
+    Interactive sessions are journaled as they go (see SessionJournal); this
+    writes a whole session at once.
+
+    Args:
+        session_data: A dictionary containing the session data: 'settings', 'plot_outline',
+            'chapter_counter' and the 'history' records.
+        filename: The name of the session. If None, a timestamped name is generated.
+
+    Returns:
+        The session directory, or None if the session could not be saved.
+    """
     try:
-        with open(filepath, 'w') as f:
-            json.dump(session_data, f, indent=4)
-        logger.info(f"Session saved to {filename}")
+        journal = SessionJournal.create(Path(filename).stem if filename else None)
+        journal.update_state(**{field: session_data[field] for field in _STATE_FIELDS if field in session_data})
+        for entry in session_data.get('history', []):
+            entry = dict(entry)
+            journal.append(entry.pop('type', 'query'), **entry)
+        journal.close()
+        logger.info(f"Session saved to {journal.directory}")
+        return journal.directory
     except Exception as e:
         logger.error(f"Error saving session to {filename}: {e}")
+        return None
 
 
 def load_session(filename: str) -> Dict[str, Any]:
-    """Loads session data from a JSON file.
+    """Loads session data from a session journal or a session JSON file.
 
     Args:
-        filename: The name of the file to load the session from.
+        filename: The name of the session, or of a JSON file saved by earlier versions.
 
     Returns:
-        A dictionary containing the session data, or an empty dictionary if the file is not found or there is an error.
+        A dictionary containing the session data, or an empty dictionary if the session is
+        not found or there is an error. The 'history' of a journal is a SessionHistory,
+        which reads older records on access.
     """
-    filepath = Path(__file__).parent / filename
-    if not filepath.exists():
-        logger.error(f"Session file not found: {filename}")
-        return {}
-
+    legacy_file = _legacy_session_file(filename)
     try:
-        with open(filepath, 'r') as f:
-            session_data = json.load(f)
+        if legacy_file is not None and not (session_path(filename) / _JOURNAL_FILE).exists():
+            session_data = _load_legacy_session(legacy_file)
+        else:
+            journal = SessionJournal.resume(filename)
+            journal.close()
+            session_data = {field: getattr(journal, field) for field in _STATE_FIELDS}
+            session_data['history'] = journal.history
         logger.info(f"Session loaded from {filename}")
         return session_data
+    except FileNotFoundError:
+        logger.error(f"Session not found: {filename}")
+        return {}
     except json.JSONDecodeError as e:
-        logger.error(f"Error decoding JSON from session file '{
-                     filename}': {e}")
+        logger.error(f"Error decoding JSON from session file '{filename}': {e}")
         return {}
     except Exception as e:
         logger.error(f"Error loading session from {filename}: {e}")
@@ -2,8 +2,6 @@ import logging
 from typing import List, Tuple, Dict, Any, Optional
 from pathlib import Path
 
-import google.generativeai as genai
-
 # Import from within the app package
 from .utils import load_config, StoryGenerator
 
@@ -0,0 +1,73 @@
+import logging
+import re
+import time
+import zlib
+from typing import List
+
+import numpy as np
+
+# Set up a logger for this module.
+logger = logging.getLogger('stubs')
+logger.info("Stubs module initialized")
+
+_WORD_PATTERN = re.compile(r"[A-Za-z']+")
+
+
+class StubResponse:
+    """The part of a generative model response the application reads."""
+
+    def __init__(self, text: str):
+        self.text = text
+
+
+class StubGenerativeModel:
+    """An offline stand-in for genai.GenerativeModel.
+
+    The generated text is deterministic for a given prompt: sentences of
+    words drawn from the prompt itself, so evaluation metrics such as ROUGE
+    see realistic overlap with the retrieved context.
+    """
+
+    def __init__(self, response_words: int = 600, latency: float = 0.0):
+        """
+        Args:
+            response_words: The number of words in every response.
+            latency: Seconds to sleep per call, to simulate the API round trip.
+        """
+        self.response_words = response_words
+        self.latency = latency
+        self.calls = 0
+
+    def generate_content(self, prompt: str) -> StubResponse:
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        words = _WORD_PATTERN.findall(prompt) or ["silence"]
+        rng = np.random.default_rng(zlib.crc32(prompt.encode('utf-8')))
+        picks = rng.integers(0, len(words), self.response_words)
+        sentences = []
+        for start in range(0, self.response_words, 12):
+            sentence = " ".join(words[i] for i in picks[start:start + 12])
+            sentences.append(sentence[:1].upper() + sentence[1:] + ".")
+        return StubResponse(" ".join(sentences))
+
+
+class HashingEncoder:
+    """An offline stand-in for the sentence transformer.
+
+    Texts are encoded as L2-normalized signed bags of hashed words, so texts
+    sharing words have a positive cosine similarity. Install it with
+    `encoder.set_encoder(HashingEncoder())`.
+    """
+
+    def __init__(self, dimensions: int = 768):
+        self.dimensions = dimensions
+
+    def encode(self, texts: List[str], **kwargs) -> np.ndarray:
+        embeddings = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in _WORD_PATTERN.findall(text.lower()):
+                code = zlib.crc32(word.encode('utf-8'))
+                embeddings[row, code % self.dimensions] += 1.0 if code & 0x80000000 else -1.0
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings / np.maximum(norms, 1e-12)
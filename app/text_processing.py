@@ -1,5 +1,10 @@
 import logging
-from typing import List
+import re
+from bisect import bisect_right
+from pathlib import Path
+from typing import Iterator, List, TextIO, Tuple, Union
+
+from .tokens import token_spans
 
 # Set up a logger for this module.
 logger = logging.getLogger('text_processing')
@@ -28,3 +33,191 @@ def chunk_text(text: str, chunk_size: int = 5000, overlap: int = 200) -> List[st
         start += chunk_size - overlap
     logger.info(f"Text chunked into {len(chunks)} chunks")
     return chunks
+
+
+# Whitespace after terminal punctuation (optionally followed by a closing
+# quote or bracket), or a blank line between paragraphs.
+_SENTENCE_BOUNDARY = re.compile(
+    r"(?<=[.!?])\s+|(?<=[.!?][\"'\u201d\u2019)\]])\s+|\n\s*\n")
+
+
+def split_sentences(text: str) -> List[str]:
+    """Splits text into sentences at terminal punctuation and paragraph breaks.
+
+    Args:
+        text: The text to split.
+
+    Returns:
+        A list of non-empty, stripped sentences in their original order.
+    """
+    return [sentence.strip() for sentence in _SENTENCE_BOUNDARY.split(text)
+            if sentence and sentence.strip()]
+
+
+# What iter_chunks() can measure chunk sizes in.
+CHUNK_UNITS = ('chars', 'tokens')
+
+# Characters read from a stream at a time by iter_chunks().
+_READ_SIZE = 1 << 20
+
+# Characters before the unchunked text that iter_chunks() keeps buffered, for
+# the look-behind of _SENTENCE_BOUNDARY (terminal punctuation and a quote).
+_LOOKBEHIND = 2
+
+_PARAGRAPH_BREAK = re.compile(r"\r?\n[ \t]*\r?\n")
+_WORD_BREAK = re.compile(r"\s+")
+
+
+def _chunk_end(text: str, min_end: int, max_end: int) -> int:
+    """Returns the last paragraph break, else sentence end, else space between min_end and max_end."""
+    for pattern in (_PARAGRAPH_BREAK, _SENTENCE_BOUNDARY, _WORD_BREAK):
+        last = None
+        for last in pattern.finditer(text, min_end, min(max_end + 1, len(text))):
+            pass
+        if last is not None:
+            return last.start()
+    return max_end
+
+
+def _next_start(text: str, start: int, begin: int, end: int) -> int:
+    """Returns where the chunk after text[start:end] starts: at `begin`, moved forward to the
+    next sentence (or word) before `end`."""
+    if begin >= end:
+        return end
+    begin = max(begin, start + 1)
+    for pattern in (_SENTENCE_BOUNDARY, _WORD_BREAK):
+        match = pattern.search(text, begin, end)
+        if match is not None and match.end() < end:
+            return match.end()
+    return begin
+
+
+def iter_chunks(reader: TextIO, chunk_size: int = 5000, overlap: int = 200, unit: str = 'chars',
+                tolerance: float = 0.2, read_size: int = _READ_SIZE) -> Iterator[Tuple[int, int, str]]:
+    """Splits a text stream into overlapping chunks that end at paragraph or sentence boundaries.
+
+    The stream is read `read_size` characters at a time and only the text
+    not yet chunked is kept, so memory use does not grow with the length of
+    the text.
+
+    A chunk is at most `chunk_size` long, in characters or estimated tokens
+    (`unit`). It ends at the last paragraph break in its final `tolerance`
+    share, or else the last sentence end, or else the last space there; only
+    text without any spaces is cut mid-word. The next chunk starts `overlap`
+    before the end of the previous one, moved forward to the next sentence
+    or word.
+
+    Args:
+        reader: The text stream, e.g. an open file or io.StringIO.
+        chunk_size: The largest chunk size.
+        overlap: How much of the end of a chunk the next chunk repeats (in the same unit).
+        unit: 'chars' or 'tokens' (see tokens.estimate_tokens).
+        tolerance: The share of `chunk_size` a chunk may be shortened by to end at a boundary.
+        read_size: The characters read from the stream at a time.
+
+    Yields:
+        (start, end, text) tuples: the character offsets of the chunk in the stream and its
+        text, stripped of surrounding whitespace.
+
+    Raises:
+        ValueError: If `unit` is unknown, or `overlap` is not smaller than the shortest chunk.
+    """
+    if unit not in CHUNK_UNITS:
+        raise ValueError(f"Unknown chunk unit '{unit}', expected one of {', '.join(CHUNK_UNITS)}")
+    min_size = max(int(chunk_size * (1 - min(max(tolerance, 0.0), 1.0))), 1)
+    if overlap < 0 or overlap >= min_size:
+        raise ValueError(f"The overlap ({overlap}) must be smaller than the shortest chunk ({min_size} {unit})")
+
+    # buffer[position:] is the text not chunked yet; buffer starts at offset `base` of the stream
+    buffer, base, position, exhausted = "", 0, 0, False
+    while True:
+        if unit == 'chars':
+            max_end = min(position + chunk_size, len(buffer))
+            # _chunk_end also looks at the character after max_end, so it must be read already;
+            # otherwise the boundary would depend on where a read happened to stop
+            complete = position + chunk_size < len(buffer)
+        else:
+            # Every word or punctuation mark counts at least one token
+            ends, counts = token_spans(buffer, position, chunk_size + 1)
+            fitting = bisect_right(counts, chunk_size)
+            max_end = ends[fitting - 1] if fitting else position
+            complete = fitting < len(ends)
+        if not complete and not exhausted:
+            text = reader.read(read_size)
+            if text:
+                keep = max(position - _LOOKBEHIND, 0)
+                buffer, base, position = buffer[keep:] + text, base + keep, position - keep
+            else:
+                exhausted = True
+            continue
+
+        if not complete:
+            end = len(buffer)
+        else:
+            if max_end <= position:
+                # A single token longer than a chunk
+                max_end = min(position + chunk_size, len(buffer))
+            if unit == 'chars':
+                min_end = position + min_size
+            else:
+                shortest = bisect_right(counts, min_size)
+                min_end = ends[shortest - 1] if shortest else position
+            end = _chunk_end(buffer, min(min_end, max_end), max_end)
+            if end <= position:
+                end = max_end
+
+        chunk = buffer[position:end]
+        stripped = chunk.strip()
+        if stripped:
+            start = base + position + len(chunk) - len(chunk.lstrip())
+            yield start, start + len(stripped), stripped
+        if not complete:
+            return
+        if unit == 'chars':
+            begin = end - overlap
+        else:
+            inside = bisect_right(ends, end)
+            kept = bisect_right(counts, counts[inside - 1] - overlap) if inside else 0
+            begin = ends[kept - 1] if kept else position
+        position = _next_start(buffer, position, begin if overlap else end, end)
+
+
+def iter_file_chunks(path: Union[str, Path], chunk_size: int = 5000, overlap: int = 200, unit: str = 'chars',
+                     tolerance: float = 0.2, encoding: str = 'utf-8') -> Iterator[Tuple[int, int, str]]:
+    """Chunks a text file with iter_chunks() without reading it into memory whole.
+
+    Offsets are character offsets into the file, with line endings kept as they are.
+    """
+    with open(path, 'r', encoding=encoding, errors='replace', newline='') as f:
+        count = 0
+        for chunk in iter_chunks(f, chunk_size, overlap, unit, tolerance):
+            count += 1
+            yield chunk
+    logger.info(f"Chunked {path} into {count} chunks")
+
+
+def sentence_windows(text: str, window_words: int = 200) -> List[str]:
+    """Groups consecutive sentences into windows of at most `window_words` words.
+
+    Sentences longer than a window are split between words.
+
+    Args:
+        text: The text to split.
+        window_words: The maximum number of words per window.
+
+    Returns:
+        The windows, in their original order.
+    """
+    windows = []
+    current: List[str] = []
+    for sentence in split_sentences(text):
+        words = sentence.split()
+        for start in range(0, len(words), window_words):
+            piece = words[start:start + window_words]
+            if current and len(current) + len(piece) > window_words:
+                windows.append(" ".join(current))
+                current = []
+            current.extend(piece)
+    if current:
+        windows.append(" ".join(current))
+    return windows
@@ -0,0 +1,60 @@
+import logging
+import re
+from itertools import accumulate, islice
+from typing import List, Optional, Tuple
+
+# Set up a logger for this module.
+logger = logging.getLogger('tokens')
+logger.info("Tokens module initialized")
+
+# Words/numbers and individual punctuation marks.
+_TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+# Subword tokenizers (SentencePiece/BPE) keep common short words whole and
+# split longer ones; roughly one extra token per this many characters.
+_CHARS_PER_SUBWORD = 6
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimates the number of model tokens in a piece of text.
+
+    This is a fast, local approximation of a subword tokenizer: every word
+    or number counts as one token plus one more for each additional
+    `_CHARS_PER_SUBWORD` characters, and every punctuation mark counts as one
+    token. It needs no network access or model download and is accurate
+    enough for budgeting prompts.
+
+    Args:
+        text: The text to measure.
+
+    Returns:
+        The estimated token count.
+    """
+    if not text:
+        return 0
+    count = 0
+    for piece in _TOKEN_PATTERN.findall(text):
+        count += 1 + (len(piece) - 1) // _CHARS_PER_SUBWORD
+    return count
+
+
+
+def token_spans(text: str, start: int = 0, limit: Optional[int] = None) -> Tuple[List[int], List[int]]:
+    """Lists where the tokens of a text end, with the running token count at each.
+
+    Tokens are counted as in estimate_tokens(); a long word may count as
+    several.
+
+    Args:
+        text: The text to measure.
+        start: Where to start.
+        limit: The most words and punctuation marks to list (default: all).
+
+    Returns:
+        (ends, counts): ends[i] is the index just past the i-th word or punctuation mark and
+        counts[i] the estimated tokens up to and including it, so both lists are increasing.
+    """
+    matches = _TOKEN_PATTERN.finditer(text, start)
+    spans = [match.span() for match in (matches if limit is None else islice(matches, limit))]
+    counts = list(accumulate(1 + (end - begin - 1) // _CHARS_PER_SUBWORD for begin, end in spans))
+    return [end for _, end in spans], counts
@@ -10,15 +10,19 @@ from rich.table import Table
 from rich.progress import track
 from rich.live import Live
 from rich.layout import Layout
-import google.generativeai as genai
 
 from .utils import (
     generate_story,
     load_config,
     load_api_key,
+    parse_filters,
     resolve_data_path,
     _load_embeddings,
+    load_or_build_lexical_index,
     StoryGenerator,
+    StubGenerativeModel,
+    profile_output_base,
+    profile_run,
     load_character_profiles,  # Import load_character_profiles
     load_world_details,  # Import load_world_details
 )
@@ -31,11 +35,18 @@ logger = logging.getLogger("tui")
 console = Console()
 
 
-def get_embeddings_dict():
-    """Helper function to get embeddings_dict with error handling."""
+def get_embeddings_dict(story_gen: Optional[StoryGenerator] = None):
+    """Helper function to get embeddings_dict with error handling.
+
+    With a `story_gen`, the embeddings are loaded by it, so they come from the
+    retrieval service if one is configured (see StoryGenerator.load_embeddings).
+    """
     embeddings_file = resolve_data_path("data/embeddings.json")
     try:
-        embeddings_dict = _load_embeddings(embeddings_file)
+        if story_gen is not None:
+            embeddings_dict = story_gen.load_embeddings(embeddings_file)
+        else:
+            embeddings_dict = _load_embeddings(embeddings_file)
     except FileNotFoundError:
         console.print(
             f"[bold yellow]Warning: Embeddings file not found at {
@@ -48,13 +59,13 @@ def get_embeddings_dict():
     return embeddings_dict
 
 
-def generate_chapter_tui():
-    """TUI for generating a single chapter."""
+def generate_chapter_tui(profile: Optional[str] = None, stub_model: bool = False):
+    """TUI for generating a single chapter (optionally profiled, see generate_story)."""
     console.clear()
     console.print(Panel("Generate a Single Chapter", style="bold blue"))
 
     config = load_config()
-    api_key = load_api_key(config)
+    api_key = None if stub_model else load_api_key(config)
 
     query = Prompt.ask("[bold blue]Enter your story query")
     style = Prompt.ask("[bold blue]Enter the story style",
@@ -70,6 +81,8 @@ def generate_chapter_tui():
         max_iterations = int(Prompt.ask("[bold blue]Enter the max iterations", default=str(config['evaluation']['max_iterations'])))
         min_quality = float(Prompt.ask("[bold blue]Enter the min quality", default=str(config['evaluation']['min_quality_score'])))
         force = Confirm.ask("Force regeneration (ignore cache)?")
+        filters = parse_filters(Prompt.ask(
+            "[bold blue]Enter metadata filters, e.g. type=manuscript (optional)", default=""))
     else:
         top_n = 3
         temperature = config['generation']['temperature']
@@ -77,6 +90,7 @@ def generate_chapter_tui():
         max_iterations = config['evaluation']['max_iterations']
         min_quality = config['evaluation']['min_quality_score']
         force = False
+        filters = None
 
     log_level = "INFO"
 
@@ -89,27 +103,12 @@ def generate_chapter_tui():
                 table.add_row(f"{step}/{total}", f"[progress.percentage]{(step + 1) / total * 100:>3.0f}%")
                 live.update(table)
 
-            update_progress(1, 4, "Loading Configuration and API Key")
+            update_progress(1, 2, "Loading Configuration and API Key")
             config = load_config()
-            api_key = load_api_key(config)
-
-            update_progress(2, 4, "Initializing Model")
-            generation_config = {
-                "temperature": temperature,
-                "top_p": config['generation']['top_p'],
-                "max_output_tokens": max_tokens
-            }
-            model = genai.GenerativeModel(
-                model_name=config['generation']['model'],
-                generation_config=generation_config
-            )
+            api_key = None if stub_model else load_api_key(config)
 
-            update_progress(3, 4, "Loading Embeddings and Data")
-            embeddings_dict = _load_embeddings(Path("data/embeddings.json"))
-            character_profiles = load_character_profiles(config['paths']['character_profiles'])
-            world_details = load_world_details(config['paths']['world_details'])
-
-            update_progress(4, 4, "Generating Story")
+            # generate_story creates the model (or the stub) and loads the embeddings and world data itself
+            update_progress(2, 2, "Generating Story")
             generate_story(
                 query,
                 Path("data/embeddings.json"),
@@ -126,6 +125,9 @@ def generate_chapter_tui():
                 api_key,
                 log_level,
                 force,
+                filters,
+                profile=profile,
+                stub_model=stub_model,
             )
 
         console.print(Panel(f"Story generation complete. Check the output file: {output_file}", style="bold green"))
@@ -133,14 +135,13 @@ def generate_chapter_tui():
         console.print(f"[bold red]Error during story generation: {e}[/bold red]")
 
 
-def interactive_story_tui():
-    """TUI for interactive story generation."""
+def interactive_story_tui(profile: Optional[str] = None, stub_model: bool = False):
+    """TUI for interactive story generation (optionally profiled, see generate_story)."""
     console.clear()
     console.print(Panel("Interactive Story Generation", style="bold blue"))
 
     config = load_config()
-    api_key = load_api_key(config)
-    embeddings_dict = get_embeddings_dict()
+    api_key = None if stub_model else load_api_key(config)
     character_profiles_path = resolve_data_path(config["paths"]["character_profiles"])
     world_details_path = resolve_data_path(config["paths"]["world_details"])
 
@@ -148,22 +149,32 @@ def interactive_story_tui():
     world_details = load_world_details(world_details_path)
 
     try:
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel(
-            model_name=config["generation"]["model"],
-            generation_config={
-                "temperature": config["generation"]["temperature"],
-                "top_p": config["generation"]["top_p"],
-                "max_output_tokens": config["generation"]["max_tokens"],
-            }
-        )
+        if stub_model:
+            model = StubGenerativeModel()
+        else:
+            import google.generativeai as genai
+
+            genai.configure(api_key=api_key)
+            model = genai.GenerativeModel(
+                model_name=config["generation"]["model"],
+                generation_config={
+                    "temperature": config["generation"]["temperature"],
+                    "top_p": config["generation"]["top_p"],
+                    "max_output_tokens": config["generation"]["max_tokens"],
+                }
+            )
     except Exception as e:
         logger.exception("Error initializing model")
         console.print(f"[bold red]Error initializing model: {e}[/bold red]")
         return
 
     try:
-        story_gen = StoryGenerator(model, character_profiles, world_details)
+        story_gen = StoryGenerator(model, character_profiles, world_details, config)
+        embeddings_dict = get_embeddings_dict(story_gen)
+        if (embeddings_dict and config.get("retrieval", {}).get("mode") == "hybrid"
+                and story_gen.retrieval_client is None):
+            story_gen.lexical_index = load_or_build_lexical_index(
+                resolve_data_path("data/embeddings.json"), embeddings_dict)
         plot_gen = PlotGenerator(story_gen.model)
     except Exception as e:
         logger.exception("Error initializing story components")
@@ -173,11 +184,26 @@ def interactive_story_tui():
     session_history = []
     current_settings = {}
 
-    interactive_loop(story_gen, plot_gen, embeddings_dict, session_history, current_settings)
+    if profile is None:
+        interactive_loop(story_gen, plot_gen, embeddings_dict, session_history, current_settings)
+        return
+
+    profiling = config.get("profiling", {}) or {}
+    with profile_run(profile_output_base(None, profiling.get("directory")),
+                     profile or profiling.get("engine", "cprofile"),
+                     top_n=profiling.get("top_n", 30), interval=profiling.get("interval", 0.005)) as outputs:
+        interactive_loop(story_gen, plot_gen, embeddings_dict, session_history, current_settings)
+    console.print(f"[green]✓[/green] Profile saved to {outputs['profile']} (hotspots: {outputs['hotspots']})")
+
 
+def main_menu(profile: Optional[str] = None, stub_model: bool = False):
+    """Main menu for the TUI.
 
-def main_menu():
-    """Main menu for the TUI."""
+    Args:
+        profile: If given, every generation run is profiled with this profiler
+            ('' for the configured one, see generate_story).
+        stub_model: Replace the generative model by an offline stub.
+    """
     setup_logging("INFO")  # Set up logging with INFO level
     while True:
         console.clear()
@@ -191,9 +217,9 @@ def main_menu():
                             "1", "2", "3"], default="3")
 
         if choice == "1":
-            generate_chapter_tui()
+            generate_chapter_tui(profile, stub_model)
         elif choice == "2":
-            interactive_story_tui()
+            interactive_story_tui(profile, stub_model)
         elif choice == "3":
             console.print("Exiting...")
             break
@@ -1,11 +1,10 @@
 import logging
-from typing import Any, Dict, List, Optional, Tuple, Union
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple, Union
 from pathlib import Path
 import hashlib
 import json
 
 import yaml
-import google.generativeai as genai
 
 from rich.console import Console
 from rich.progress import (
@@ -19,19 +18,32 @@ from rich.table import Table
 from rich.text import Text
 from rich.panel import Panel
 
-from rouge import Rouge
-from sklearn.metrics.pairwise import cosine_similarity
-from sentence_transformers import SentenceTransformer
 from .character import load_character_profiles
+from .embedding_store import find_store, load_embedding_store
+from .encoder import configure_encoder, set_encoder
+from .index import configure_index, get_index
 from .world import load_world_details
-from .semantic_search import semantic_search
-from .context import prepare_context
-from .prompt import create_prompt
-from .session import save_session, load_session
+from .semantic_search import add_document, encode_long_text, remove_document, semantic_search, hybrid_search
+from .lexical_index import BM25Index, load_or_build_lexical_index
+from .context import prepare_context_chunks
+from .rerank import gather_chunk_embeddings, mmr_rerank, score_cutoff
+from .metrics import export_metrics, get_recorder, record_cache, span
+from .profiling import profile_output_base, profile_run
+from .stubs import StubGenerativeModel
+from .prompt import build_prompt
+from .world_index import WorldIndex
+from .memory import StoryMemory
+from .session import SessionJournal, configure_sessions, load_session, new_session, resume_session, save_session
 from .export import export_story
 from .path_utils import resolve_data_path
 from .setup_logging import setup_logging
 
+if TYPE_CHECKING:
+    import google.generativeai as genai
+    import numpy as np
+
+    from .retrieval_service import RetrievalClient
+
 # Initialize console
 console = Console()
 
@@ -126,16 +138,18 @@ def calculate_rouge_scores(text: str, embeddings_dict: Dict, top_n: int) -> Dict
         return {'rouge-1': 0.0, 'rouge-2': 0.0, 'rouge-l': 0.0}
 
     # Extract relevant chunks from embeddings (adapt this based on your embeddings structure)
+    # Only the first top_n are used; stop there, since store chunks are decompressed when read
     references = []
     for file_path, data in embeddings_dict.items():
-                for chunk in data.get('chunk_content', []):
-                    references.append(chunk)
+        for chunk in data.get('chunk_content', []):
+            if len(references) >= top_n:
+                break
+            references.append(chunk)
 
     if not references:
         return {'rouge-1': 0.0, 'rouge-2': 0.0, 'rouge-l': 0.0}
 
-    # Get top_n references if necessary
-    references = references[:top_n]
+    from rouge import Rouge
 
     rouge = Rouge()
     try:
@@ -152,29 +166,36 @@ def calculate_rouge_scores(text: str, embeddings_dict: Dict, top_n: int) -> Dict
         logger.error(f"Unexpected error during ROUGE calculation: {e}")
         return {'rouge-1': 0.0, 'rouge-2': 0.0, 'rouge-l': 0.0}
 
-# Assuming you have a pre-trained SentenceTransformer model
-semantic_model = SentenceTransformer('all-mpnet-base-v2')
-
-def calculate_semantic_similarity(text: str, embeddings_dict: Dict) -> float:
-    """Calculates average semantic similarity to relevant chunks using Sentence Transformers."""
+def calculate_semantic_similarity(text: str, embeddings_dict: Dict,
+                                  long_text: Optional[Dict[str, Any]] = None,
+                                  mean_vector: Optional['np.ndarray'] = None) -> float:
+    """Calculates average semantic similarity to relevant chunks using Sentence Transformers.
+
+    The text is encoded in sentence windows whose embeddings are pooled (see
+    encode_long_text), so all of a long chapter is measured. `long_text` holds the
+    'window_words', 'pooling' and 'max_segments' settings (the `evaluation.long_text`
+    config section). `mean_vector` is the mean of the normalized chunk embeddings
+    if it is known already, e.g. from a retrieval service; otherwise it is taken
+    from the index of `embeddings_dict`.
+    """
     if not embeddings_dict:
         return 0.0
 
-    # Extract chunk embeddings
-    chunk_embeddings = []
-    for file_path, data in embeddings_dict.items():
-        chunk_embeddings.extend(data['chunk_embeddings'])
-
-    if not chunk_embeddings:
-        return 0.0
+    if mean_vector is None:
+        # The chunk embeddings, as the normalized rows of the shared index
+        index = get_index(embeddings_dict)
+        if not len(index):
+            return 0.0
+        mean_vector = index.mean_vector()
 
     try:
-        # Generate embedding for the generated text
-        text_embedding = semantic_model.encode([text])[0]  # Encode expects a list of strings
+        # Generate embedding for the generated text, one sentence window at a time
+        long_text = long_text or {}
+        text_embedding = encode_long_text(text, long_text.get('window_words', 200),
+                                          long_text.get('pooling', 'mean'), long_text.get('max_segments', 32))
 
-        # Calculate average cosine similarity
-        similarities = cosine_similarity([text_embedding], chunk_embeddings)[0]
-        avg_similarity = sum(similarities) / len(similarities)
+        # The average cosine similarity is the similarity to the mean of the normalized chunk embeddings
+        avg_similarity = float(mean_vector @ text_embedding)
         return avg_similarity
     except Exception as e:
         logger.error(f"Error during semantic similarity calculation: {e}")
@@ -187,21 +208,30 @@ def calculate_lexical_diversity(text: str) -> float:
         return 0.0
     return len(set(words)) / len(words)
 
-def evaluate_story(text: str, embeddings_dict: Dict[str, Any], top_n: int, rouge_threshold: float) -> Dict[str, Any]:
-    """Evaluates the generated story based on various metrics."""
+def evaluate_story(text: str, embeddings_dict: Dict[str, Any], top_n: int, rouge_threshold: float,
+                   long_text: Optional[Dict[str, Any]] = None,
+                   mean_vector: Optional['np.ndarray'] = None) -> Dict[str, Any]:
+    """Evaluates the generated story based on various metrics.
+
+    `long_text` sets how long texts are encoded for the semantic similarity, and
+    `mean_vector` is the mean chunk embedding it compares with (see
+    calculate_semantic_similarity).
+    """
     metrics = {}
 
     # 1. Quality Score (placeholder - replace with your actual quality metric)
     metrics['quality_score'] = calculate_quality_score(text)
 
     # 2. ROUGE Scores
-    rouge_scores = calculate_rouge_scores(text, embeddings_dict, top_n)
+    with span('rouge'):
+        rouge_scores = calculate_rouge_scores(text, embeddings_dict, top_n)
     metrics.update(rouge_scores)
 
     # 3. Semantic Similarity
-    metrics['semantic_similarity'] = calculate_semantic_similarity(
-        text, embeddings_dict
-    )
+    with span('semantic_similarity'):
+        metrics['semantic_similarity'] = calculate_semantic_similarity(
+            text, embeddings_dict, long_text, mean_vector
+        )
 
     # 4. Statistics
     metrics['word_count'] = len(text.split())
@@ -247,6 +277,39 @@ def create_metrics_table(metrics: Dict[str, float]) -> Table:
 
     return table
 
+def create_timing_table(stage_summary: Dict[str, Dict[str, Any]],
+                        cache_hit_rates: Dict[str, Dict[str, Any]]) -> Table:
+    """Create a rich table for displaying per-stage timings and cache hit rates."""
+    table = Table(title="Pipeline Timings", show_header=True,
+                  header_style="bold magenta")
+
+    table.add_column("Stage", style="cyan")
+    table.add_column("Calls", justify="right")
+    table.add_column("Total (ms)", justify="right", style="green")
+    table.add_column("Mean (ms)", justify="right", style="green")
+    table.add_column("Max (ms)", justify="right", style="yellow")
+    table.add_column("Counts", style="dim")
+
+    for name, stage in stage_summary.items():
+        indent = "  " if stage['parent'] else ""
+        counts = ", ".join(f"{key}={value:g}" for key, value in stage['attributes'].items())
+        table.add_row(
+            f"{indent}{name}",
+            str(stage['calls']),
+            f"{stage['total_s'] * 1000:.1f}",
+            f"{stage['mean_s'] * 1000:.1f}",
+            f"{stage['max_s'] * 1000:.1f}",
+            counts
+        )
+
+    if cache_hit_rates:
+        table.add_row("[bold]Caches[/bold]", "", "", "", "", "", style="dim")
+        for cache, counts in cache_hit_rates.items():
+            table.add_row(f"  {cache}", str(counts['hits'] + counts['misses']), "", "", "",
+                          f"hit rate {counts['hit_rate']:.0%}")
+
+    return table
+
 def format_story_output(text: str, title: Optional[str] = None) -> Panel:
     """Format story text with enhanced rich formatting."""
     formatted_text = Text()
@@ -323,16 +386,22 @@ def ensure_directory(path: Path) -> None:
         raise InputError(f"Could not create directory {path}: {e}")
 
 def _load_embeddings(embeddings_file: Path) -> dict:
-    """Helper function to load embeddings."""
+    """Helper function to load embeddings, from their converted store if there is one (see embedding_store)."""
     try:
+        store = find_store(embeddings_file)
+        if store is not None:
+            return load_embedding_store(store)
         with open(embeddings_file, 'r') as f:
             return json.load(f)
     except Exception as e:
         raise ConfigError(f"Error loading embeddings: {e}")
 
 def load_embeddings(path: Path) -> Dict[str, Any]:
-    """Load embeddings from JSON file."""
+    """Load embeddings from JSON file, or from its converted store if there is one (see embedding_store)."""
     try:
+        store = find_store(path)
+        if store is not None:
+            return load_embedding_store(store)
         with open(path, 'r', encoding='utf-8') as f:
             return json.load(f)
     except json.JSONDecodeError as e:
@@ -340,6 +409,22 @@ def load_embeddings(path: Path) -> Dict[str, Any]:
     except Exception as e:
         raise InputError(f"Could not load embeddings from {path}: {e}")
 
+def parse_filters(text: Optional[str]) -> Optional[Dict[str, Any]]:
+    """Parse metadata filters written as 'key=value, key=value|value'.
+
+    Repeated keys and '|'-separated values are alternatives; different keys must all match.
+    """
+    if not text or not text.strip():
+        return None
+    filters: Dict[str, List[str]] = {}
+    for part in text.split(','):
+        if '=' not in part:
+            raise InputError(f"Invalid filter '{part.strip()}', expected key=value")
+        key, values = part.split('=', 1)
+        filters.setdefault(key.strip(), []).extend(
+            value.strip() for value in values.split('|') if value.strip())
+    return filters
+
 def load_api_key(config: Dict = None, api_key: Optional[str] = None) -> str:
     """Load API key from config, secrets file or command line."""
     if api_key:
@@ -388,6 +473,14 @@ def _override_config(config: dict, temperature: Optional[float], max_tokens: Opt
     if min_quality is not None:
         config['evaluation']['min_quality_score'] = min_quality
 
+def _report_timings(config: Dict[str, Any]) -> None:
+    """Helper function to print and export the per-stage timings of a run."""
+    metrics_config = config.get('metrics', {}) or {}
+    recorder = get_recorder()
+    if metrics_config.get('summary', True):
+        console.print(create_timing_table(recorder.stage_summary(), recorder.cache_hit_rates()))
+    export_metrics(metrics_config)
+
 def _display_story_output(result: Dict[str, Any], output_file: Optional[Path]) -> None:
     """Helper function to display or save story output."""
     story = result['text']
@@ -399,27 +492,117 @@ def _display_story_output(result: Dict[str, Any], output_file: Optional[Path]) -
         console.print(format_story_output(story))
 
 class StoryGenerator:
-    def __init__(self, model: genai.GenerativeModel, character_profiles: Dict[str, Any], world_details: Dict[str, Any]):
-        """Initialize story generator with character profiles, and world details."""
+    def __init__(self, model: 'genai.GenerativeModel', character_profiles: Dict[str, Any], world_details: Dict[str, Any],
+                 config: Optional[Dict[str, Any]] = None):
+        """Initialize story generator with character profiles, world details and (optionally) the loaded config."""
         logger.info("Initializing StoryGenerator")
         self.model = model
         self.character_profiles = character_profiles
         self.world_details = world_details
-
-    def semantic_search(self, query: str, embeddings_dict: Dict[str, Any], top_n: int = 3) -> List[Tuple[str, int, float]]:
-        return semantic_search(self.model, query, embeddings_dict, top_n)
-
-    def prepare_context(self, embeddings_dict: Dict[str, Any], relevant_chunks: List[Tuple[str, int, float]]) -> str:
-        return prepare_context(embeddings_dict, relevant_chunks)
-
-    def _create_prompt(self, style: str, character: str, situation: str, context: str,
-                       previous_attempt: str = None, feedback: Dict[str, Any] = None, style_prompt: str = None) -> str:
-        return create_prompt(style, character, situation, context, self.character_profiles, self.world_details, previous_attempt, feedback, style_prompt)
+        self.world_index = WorldIndex(world_details, character_profiles)
+        self.config = config or {}
+        self.lexical_index: Optional[BM25Index] = None
+        retrieval = self.config.get('retrieval', {}) or {}
+        configure_index(retrieval.get('index'))
+        configure_encoder(self.config.get('encoder'))
+        configure_sessions(self.config.get('session'))
+
+        # With a retrieval service, searches, chunk lookups and text encoding go through it, so
+        # this process loads no embeddings, builds no search index and loads no sentence encoder
+        self.retrieval_client: Optional['RetrievalClient'] = None
+        service = retrieval.get('service') or {}
+        if service.get('address'):
+            from .retrieval_service import RetrievalClient
+            self.retrieval_client = RetrievalClient(service['address'], service.get('timeout', 30))
+            set_encoder(self.retrieval_client)
+
+    def semantic_search(self, query: str, embeddings_dict: Dict[str, Any], top_n: int = 3,
+                        filters: Optional[Dict[str, Any]] = None) -> List[Tuple[str, int, float]]:
+        retrieval = self.config.get('retrieval', {})
+        hybrid = retrieval.get('mode', 'dense') == 'hybrid'
+        if self.retrieval_client is not None:
+            with span('remote_search'):
+                if hybrid:
+                    return self.retrieval_client.hybrid_search(query, top_n, retrieval.get('hybrid_candidates', 50),
+                                                               retrieval.get('rrf_k', 60), filters)
+                return self.retrieval_client.search(query, top_n, filters)
+        if hybrid:
+            if self.lexical_index is None:
+                self.lexical_index = BM25Index.build(embeddings_dict)
+            return hybrid_search(self.model, query, embeddings_dict, self.lexical_index, top_n,
+                                 candidates=retrieval.get('hybrid_candidates', 50),
+                                 rrf_k=retrieval.get('rrf_k', 60), filters=filters)
+        return semantic_search(self.model, query, embeddings_dict, top_n, filters)
+
+    def load_embeddings(self, embeddings_file: Path) -> Dict[str, Any]:
+        """Loads the embeddings to generate from.
+
+        With a retrieval service, only the file list is fetched, and chunk texts
+        are read from the service when they are used (see RetrievalClient.embeddings).
+        """
+        if self.retrieval_client is not None:
+            return self.retrieval_client.embeddings()
+        return _load_embeddings(embeddings_file)
+
+    def chunk_embeddings(self, embeddings_dict: Dict[str, Any],
+                         chunks: List[Tuple[str, int, float]]) -> 'np.ndarray':
+        """Collects the embeddings of the given chunks, from the retrieval service if there is one."""
+        if self.retrieval_client is not None:
+            return self.retrieval_client.chunk_embeddings([(file_path, chunk_idx) for file_path, chunk_idx, _ in chunks])
+        return gather_chunk_embeddings(embeddings_dict, chunks)
+
+    def mean_vector(self) -> Optional['np.ndarray']:
+        """Returns the retrieval service's mean chunk embedding, or None to use the local index."""
+        return self.retrieval_client.mean_vector() if self.retrieval_client is not None else None
+
+    def add_document(self, embeddings_dict: Dict[str, Any], file_path: str, text: str,
+                     metadata: Optional[Dict[str, Any]] = None) -> int:
+        """Makes a document searchable without rebuilding the index, chunked as configured under `embedding`."""
+        if self.retrieval_client is not None:
+            raise ConfigError("Documents cannot be added through the retrieval service; "
+                              "add them to its embeddings file and restart it")
+        embedding = self.config.get('embedding', {}) or {}
+        added = add_document(embeddings_dict, file_path, text, metadata,
+                             chunk_size=embedding.get('chunk_size', 5000),
+                             chunk_overlap=embedding.get('chunk_overlap', 200))
+        # The lexical index is built again on the next hybrid search
+        self.lexical_index = None
+        return added
+
+    def remove_document(self, embeddings_dict: Dict[str, Any], file_path: str) -> bool:
+        if self.retrieval_client is not None:
+            raise ConfigError("Documents cannot be removed through the retrieval service; "
+                              "remove them from its embeddings file and restart it")
+        removed = remove_document(embeddings_dict, file_path)
+        if removed:
+            self.lexical_index = None
+        return removed
+
+    def prepare_context(self, embeddings_dict: Dict[str, Any], relevant_chunks: List[Tuple[str, int, float]],
+                        query: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Looks up (and compresses) the context chunks for the prompt (see context.prepare_context_chunks)."""
+        compression = self.config.get('context', {}).get('compression')
+        adaptive = self.config.get('retrieval', {}).get('adaptive') or {}
+        return prepare_context_chunks(embeddings_dict, relevant_chunks, query, compression,
+                                      adaptive.get('max_context_chars'))
+
+    def _create_prompt(self, style: str, character: str, situation: str,
+                       context: Union[str, List[Dict[str, Any]]],
+                       previous_attempt: str = None, feedback: Dict[str, Any] = None, style_prompt: str = None,
+                       token_budget: Optional[int] = None, query: Optional[str] = None,
+                       story_memory: Optional[Dict[str, Any]] = None,
+                       plot_outline: Optional[str] = None) -> Tuple[str, List[Dict[str, Any]]]:
+        return build_prompt(style, character, situation, context, self.character_profiles, self.world_details,
+                            previous_attempt, feedback, style_prompt, token_budget, query, self.world_index,
+                            story_memory, plot_outline)
 
     def generate_chapter(self, queries: List[str], embeddings_dict: Dict[str, Any],
                          style: str = "dark fantasy", character: Optional[str] = None,
                          situation: Optional[str] = None, top_n: int = 3,
-                         style_prompt: str = None, plot_outline: Optional[str] = None) -> Dict[str, Any]:
+                         style_prompt: str = None, plot_outline: Optional[str] = None,
+                         token_budget: Optional[int] = None,
+                         filters: Optional[Dict[str, Any]] = None,
+                         memory: Optional[StoryMemory] = None) -> Dict[str, Any]:
         """
         Generate a chapter using multiple queries and optional plot outline.
 
@@ -429,12 +612,42 @@ class StoryGenerator:
         current goal (represented by the queries). The final list of relevant chunks
         used for context might be less than the initial sum of top_n per query due to
         deduplication.
+
+        With `retrieval.adaptive` configured, the number of chunks follows their
+        scores instead: up to `max_n` chunks (default top_n) are kept, but the
+        list is cut at the first score below `min_score` or the first relative
+        drop larger than `max_gap`, keeping at least `min_n`. The context is
+        then limited to `max_context_chars` characters of chunk text.
+
+        The prompt is limited to `token_budget` estimated tokens (default:
+        `prompt.token_budget` from the config, unlimited if unset). The per-section
+        token counts are returned under 'prompt_sections'.
+
+        `filters` restricts retrieval to files whose metadata matches, e.g.
+        {'type': 'manuscript'} (see EmbeddingIndex.files_matching).
+
+        With a `memory` (see new_memory), the rolling summary of the earlier
+        chapters and the past passages most similar to the queries are added
+        to the prompt. Adding the generated chapter to it is left to the
+        caller, once the chapter is accepted.
         """
+        if token_budget is None:
+            token_budget = self.config.get('prompt', {}).get('token_budget')
+
+        # Adaptive retrieval can go deeper than top_n when the scores stay high
+        adaptive = self.config.get('retrieval', {}).get('adaptive') or {}
+        max_n = max(adaptive.get('max_n') or top_n, top_n)
+
+        # With MMR enabled, retrieve extra candidates to choose a diverse top_n from
+        mmr = self.config.get('retrieval', {}).get('mmr', {})
+        fetch_n = max_n * mmr.get('fetch_factor', 4) if mmr.get('enabled') else max_n
+
         all_relevant_chunks = []
-        for query in queries:
-            relevant_chunks = self.semantic_search(
-                query, embeddings_dict, top_n)
-            all_relevant_chunks.extend(relevant_chunks)
+        with span('retrieval', queries=len(queries)):
+            for query in queries:
+                relevant_chunks = self.semantic_search(
+                    query, embeddings_dict, fetch_n, filters)
+                all_relevant_chunks.extend(relevant_chunks)
 
         # Deduplicate chunks based on file path and chunk index
         unique_chunks = {(file_path, chunk_idx): (file_path, chunk_idx, similarity)
@@ -444,24 +657,48 @@ class StoryGenerator:
         # Sort by similarity after deduplication
         all_relevant_chunks.sort(key=lambda x: x[2], reverse=True)
 
-        # Limit to top_n unique chunks based on highest similarity.
-        # This ensures that even after considering multiple queries, the context
-        # is limited to the most relevant pieces of information.
-        all_relevant_chunks = all_relevant_chunks[:top_n]
-
-        context = self.prepare_context(embeddings_dict, all_relevant_chunks)
+        # Drop the chunks past a score threshold or a sharp drop in score
+        if adaptive.get('min_score') is not None or adaptive.get('max_gap') is not None:
+            with span('score_cutoff', candidates=len(all_relevant_chunks)) as attributes:
+                count = score_cutoff([similarity for _, _, similarity in all_relevant_chunks],
+                                     adaptive.get('min_score'), adaptive.get('max_gap'), adaptive.get('min_n', 1))
+                all_relevant_chunks = all_relevant_chunks[:count]
+                attributes['kept'] = count
 
-        # Add plot outline to prompt if provided
-        if plot_outline:
-            prompt = f"Plot Outline:\n{plot_outline}\n\n"
-            prompt += self._create_prompt(style, character,
-                                          situation, context, style_prompt=style_prompt)
+        # Limit to max_n (by default top_n) unique chunks based on highest similarity.
+        # This ensures that even after considering multiple queries, the context
+        # is limited to the most relevant pieces of information. With MMR, chunks
+        # that are near-duplicates of an already selected chunk are passed over.
+        if mmr.get('enabled'):
+            with span('rerank', candidates=len(all_relevant_chunks)):
+                all_relevant_chunks = mmr_rerank(
+                    all_relevant_chunks, self.chunk_embeddings(embeddings_dict, all_relevant_chunks),
+                    max_n, mmr.get('lambda', 0.7))
         else:
-            prompt = self._create_prompt(
-                style, character, situation, context, style_prompt=style_prompt)
+            all_relevant_chunks = all_relevant_chunks[:max_n]
+
+        with span('context_assembly', chunks=len(all_relevant_chunks)) as attributes:
+            context = self.prepare_context(embeddings_dict, all_relevant_chunks, "\n".join(queries))
+            attributes['chars'] = sum(len(chunk['text']) for chunk in context)
+
+        story_memory = None
+        if memory is not None:
+            with span('memory_recall', passages=len(memory)) as attributes:
+                story_memory = memory.recall("\n".join(queries))
+                attributes['recalled'] = len(story_memory['passages'])
+
+        with span('prompt_build') as attributes:
+            prompt, prompt_sections = self._create_prompt(
+                style, character, situation, context, style_prompt=style_prompt,
+                token_budget=token_budget, query="\n".join(queries), story_memory=story_memory,
+                plot_outline=plot_outline)
+            attributes['tokens'] = sum(section['tokens'] for section in prompt_sections)
+            attributes['chars'] = len(prompt)
 
         logger.info("Generating initial draft...")
-        response = self.model.generate_content(prompt)
+        with span('model_call', prompt_chars=len(prompt)) as attributes:
+            response = self.model.generate_content(prompt)
+            attributes['response_chars'] = len(response.text or "")
         if not response.text:
             logger.warning("Empty response from the language model.")
             return None
@@ -469,7 +706,8 @@ class StoryGenerator:
         logger.info("Story generation complete.")
         return {
             'text': response.text,
-            'prompt': prompt
+            'prompt': prompt,
+            'prompt_sections': prompt_sections
         }
 
     def save_session(self, session_data: Dict[str, Any], filename: str = None):
@@ -478,6 +716,23 @@ class StoryGenerator:
     def load_session(self, filename: str) -> Dict[str, Any]:
         return load_session(filename)
 
+    def new_memory(self) -> Optional[StoryMemory]:
+        """Returns an empty story memory configured by the `memory` config section, or None if it is disabled."""
+        memory_config = self.config.get('memory', {}) or {}
+        if not memory_config.get('enabled'):
+            return None
+        return StoryMemory(summary_tokens=memory_config.get('summary_tokens', 400),
+                           passage_tokens=memory_config.get('passage_tokens', 600),
+                           passage_words=memory_config.get('passage_words', 120),
+                           summarizer=memory_config.get('summarizer', 'extractive'),
+                           model=self.model)
+
+    def new_session(self, name: Optional[str] = None) -> SessionJournal:
+        return new_session(name)
+
+    def resume_session(self, name: str) -> SessionJournal:
+        return resume_session(name)
+
     def export_story(self, text: str, format: str = "txt", filename: str = None):
         export_story(text, format, filename)
 
@@ -496,13 +751,40 @@ def generate_story(
     min_quality: Optional[float],
     api_key: Optional[str],
     log_level: str,
-    force: bool
+    force: bool,
+    filters: Optional[Dict[str, Any]] = None,
+    profile: Optional[str] = None,
+    stub_model: bool = False
 ) -> None:
-    """Generate a story chapter using embeddings."""
+    """Generate a story chapter using embeddings.
+
+    `filters` optionally restricts retrieval to sources whose metadata matches (see parse_filters).
+
+    With `profile`, the whole run is profiled and the profile and a hotspot summary are
+    written next to the output file (see profiling.profile_run). `profile` names the
+    profiler ('cprofile', 'sampling' or 'pyinstrument'); an empty string uses
+    `profiling.engine` from the config. With `stub_model`, the generative model is replaced
+    by an offline stub, so a profile shows only local work.
+    """
+    if profile is not None:
+        try:
+            profiling = load_config(config_path).get('profiling', {}) or {}
+        except (FileNotFoundError, yaml.YAMLError):
+            profiling = {}
+        output_base = profile_output_base(output_file, profiling.get('directory'))
+        with profile_run(output_base, profile or profiling.get('engine', 'cprofile'),
+                         top_n=profiling.get('top_n', 30), interval=profiling.get('interval', 0.005)) as outputs:
+            generate_story(query, embeddings_file, output_file, config_path, style, character, situation,
+                           top_n, temperature, max_tokens, max_iterations, min_quality, api_key, log_level,
+                           force, filters, stub_model=stub_model)
+        console.print(f"[green]✓[/green] Profile saved to {outputs['profile']} (hotspots: {outputs['hotspots']})")
+        return
+
     setup_logging(log_level)
 
     logger = logging.getLogger('generate_story')
     logger.info("Starting story generation")
+    get_recorder().reset()
 
     try:
         # Load configuration
@@ -511,12 +793,15 @@ def generate_story(
         console.print(f"[bold red]{e}[/bold red]")
         return
 
-    try:
-        api_key = load_api_key(config, api_key)
-        genai.configure(api_key=api_key)
-    except APIKeyError as e:
-        console.print(f"[bold red]{e}[/bold red]")
-        return
+    if not stub_model:
+        import google.generativeai as genai
+
+        try:
+            api_key = load_api_key(config, api_key)
+            genai.configure(api_key=api_key)
+        except APIKeyError as e:
+            console.print(f"[bold red]{e}[/bold red]")
+            return
 
     try:
         _override_config(config, temperature, max_tokens, max_iterations, min_quality)
@@ -527,19 +812,24 @@ def generate_story(
             "max_output_tokens": config['generation']['max_tokens']
         }
 
-        model = genai.GenerativeModel(
-            model_name=config['generation']['model'],
-            generation_config=generation_config
-        )
-
-        embeddings_dict = _load_embeddings(embeddings_file)
-        if not embeddings_dict:
-            raise FileNotFoundError(f"Embeddings file not found or empty at {embeddings_file}")
+        if stub_model:
+            model = StubGenerativeModel()
+        else:
+            model = genai.GenerativeModel(
+                model_name=config['generation']['model'],
+                generation_config=generation_config
+            )
 
         character_profiles = load_character_profiles(config['paths']['character_profiles'])
         world_details = load_world_details(config['paths']['world_details'])
 
-        story_gen = StoryGenerator(model, character_profiles, world_details)
+        story_gen = StoryGenerator(model, character_profiles, world_details, config)
+        with span('load_embeddings'):
+            embeddings_dict = story_gen.load_embeddings(embeddings_file)
+        if not embeddings_dict:
+            raise FileNotFoundError(f"Embeddings file not found or empty at {embeddings_file}")
+        if config.get('retrieval', {}).get('mode') == 'hybrid' and story_gen.retrieval_client is None:
+            story_gen.lexical_index = load_or_build_lexical_index(embeddings_file, embeddings_dict)
 
         cache_path = Path(config['paths']['cache_file'])
         story_cache = load_story_cache(cache_path)
@@ -550,14 +840,20 @@ def generate_story(
             'situation': situation,
             'top_n': top_n,
             'temperature': config['generation']['temperature'],
-            'max_tokens': config['generation']['max_tokens']
+            'max_tokens': config['generation']['max_tokens'],
+            'token_budget': config.get('prompt', {}).get('token_budget'),
+            'compression': config.get('context', {}).get('compression'),
+            'retrieval': config.get('retrieval'),
+            'filters': filters
         }
         cache_key = compute_cache_key(cache_params)
 
+        record_cache('story', cache_key in story_cache and not force)
         if cache_key in story_cache and not force:
             console.print("[bold blue]Using cached story...[/bold blue] (use --force to regenerate)")
             result = story_cache[cache_key]
             _display_story_output(result, output_file)
+            export_metrics(config.get('metrics'))
             return
 
         best_story = None
@@ -574,11 +870,14 @@ def generate_story(
                     style=style,
                     character=character,
                     situation=situation,
-                    top_n=top_n
+                    top_n=top_n,
+                    filters=filters
                 )
 
                 if result:
-                    metrics = evaluate_story(result['text'], embeddings_dict, top_n, config['evaluation']['rouge_threshold'])
+                    with span('evaluation'):
+                        metrics = evaluate_story(result['text'], embeddings_dict, top_n, config['evaluation']['rouge_threshold'],
+                                                 config['evaluation'].get('long_text'), story_gen.mean_vector())
                     metrics_history.append(metrics)
 
                     if metrics['quality_score'] > best_quality:
@@ -600,6 +899,8 @@ def generate_story(
         else:
             console.print("[bold red]Story generation failed. No acceptable story found.[/bold red]")
 
+        _report_timings(config)
+
     except Exception as e:
         logger.exception("An error occurred during story generation")
         console.print(f"[bold red]An error occurred: {e}[/bold red]")
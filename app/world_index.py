@@ -0,0 +1,186 @@
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .semantic_search import embed_texts
+
+# Set up a logger for this module.
+logger = logging.getLogger('world_index')
+logger.info("World index module initialized")
+
+_TERMINAL = ""  # Trie key marking the end of a name.
+
+# Number of (world details, character profiles) pairs whose WorldIndex is kept by get_world_index().
+_WORLD_INDEX_CACHE_SIZE = 4
+_world_index_cache: "OrderedDict[Tuple[int, int], Tuple[Any, Any, WorldIndex]]" = OrderedDict()
+
+
+class MentionTrie:
+    """A case-insensitive character trie for finding names mentioned in text.
+
+    Matching walks the trie from every position of the text, so the cost
+    depends on the length of the text and of the longest name, not on the
+    number of names. Like a lowercase substring test, names are matched
+    anywhere in the text.
+    """
+
+    def __init__(self, names: List[str]):
+        self.root: Dict[str, Any] = {}
+        self.max_length = 0
+        for name in names:
+            key = name.lower()
+            if not key:
+                continue
+            node = self.root
+            for char in key:
+                node = node.setdefault(char, {})
+            node.setdefault(_TERMINAL, []).append(name)
+            self.max_length = max(self.max_length, len(key))
+
+    def find(self, text: str) -> List[str]:
+        """Returns the names that occur in the text, in order of their first occurrence."""
+        text = text.lower()
+        found = {}
+        for start in range(len(text)):
+            node = self.root
+            for char in text[start:start + self.max_length]:
+                node = node.get(char)
+                if node is None:
+                    break
+                for name in node.get(_TERMINAL, ()):
+                    found.setdefault(name, start)
+        return sorted(found, key=found.get)
+
+
+class WorldIndex:
+    """A compiled form of the world details and character profiles for prompt construction.
+
+    Built once when the data is loaded, it holds the prompt fragments for
+    every theme, motif, style, location and character already rendered, tries
+    for detecting location and character mentions, and (computed on first use)
+    the embedding vectors of the theme and motif fragments.
+    """
+
+    def __init__(self, world_details: Dict[str, Any], character_profiles: Dict[str, Any]):
+        world_details = world_details or {}
+        character_profiles = character_profiles or {}
+
+        self.theme_lines = [
+            f"- {theme}: {', '.join(details.get('subthemes', []))}"
+            for theme, details in world_details.get('themes', {}).items()
+            if isinstance(details, dict)
+        ]
+        self.motif_lines = [f"- {motif}: {meaning}"
+                            for motif, meaning in world_details.get('motifs', {}).items()]
+        self.style_fragments = {
+            style: f"\nStyle guidelines for {style}:\n{details}"
+            for style, details in world_details.get('styles', {}).items() if details
+        }
+
+        self.location_fragments = {}
+        self._location_order = {}
+        for location_name, location_details in world_details.get('locations', {}).items():
+            if isinstance(location_details, dict):
+                self._location_order[location_name] = len(self._location_order)
+                self.location_fragments[location_name] = self._render_location(
+                    location_name, location_details)
+
+        self.character_fragments = {}
+        self.character_summaries = {}
+        for name, profile in character_profiles.items():
+            if not isinstance(profile, dict):
+                continue
+            if all(key in profile for key in ('personality', 'backstory', 'goal')):
+                self.character_fragments[name] = "\n".join([
+                    f"Focus on the character of {name}:",
+                    f"- Personality: {profile['personality']}",
+                    f"- Backstory: {profile['backstory']}",
+                    f"- Goal: {profile['goal']}",
+                ])
+            summary = "; ".join(f"{key}: {profile[key]}"
+                                for key in ('personality', 'goal') if key in profile)
+            self.character_summaries[name] = f"- {name}" + (f" ({summary})" if summary else "")
+
+        self.location_trie = MentionTrie(list(self.location_fragments))
+        self.character_trie = MentionTrie(list(self.character_summaries))
+        self._world_embeddings: Optional[np.ndarray] = None
+
+        logger.info(f"World index compiled: {len(self.location_fragments)} locations, {
+                    len(self.character_summaries)} characters, {len(self.theme_lines)} themes, {
+                    len(self.motif_lines)} motifs")
+
+    @staticmethod
+    def _render_location(location_name: str, location_details: Dict[str, Any]) -> str:
+        """Renders the setting details of a location."""
+        lines = [
+            f"\nSetting details for {location_name}:",
+            f"- Description: {location_details.get('description')}",
+            f"- Significance: {location_details.get('significance')}",
+        ]
+        if 'places' in location_details:
+            lines.append("- Notable places within this location:")
+            for place_name, place_description in location_details['places'].items():
+                lines.append(f"  - {place_name}: {place_description}")
+        if 'rooms' in location_details:
+            lines.append("- Rooms within this location:")
+            for room_name, room_description in location_details['rooms'].items():
+                lines.append(f"  - {room_name}: {room_description}")
+        return "\n".join(lines)
+
+    def find_location(self, text: str) -> Optional[str]:
+        """Returns the first location (in world details order) mentioned in the text, if any."""
+        if not text:
+            return None
+        matches = self.location_trie.find(text)
+        if not matches:
+            return None
+        return min(matches, key=self._location_order.get)
+
+    def find_characters(self, text: str) -> List[str]:
+        """Returns the characters mentioned in the text, in order of first mention."""
+        if not text:
+            return []
+        return self.character_trie.find(text)
+
+    def score_world_items(self, query: str) -> np.ndarray:
+        """Scores the theme and motif fragments by embedding similarity to a query.
+
+        The fragment embeddings are computed once and reused for every query.
+
+        Args:
+            query: The text to compare against.
+
+        Returns:
+            An array of cosine similarities: the themes first, then the motifs.
+        """
+        if not self.theme_lines and not self.motif_lines:
+            return np.zeros(0, dtype=np.float32)
+        if self._world_embeddings is None:
+            self._world_embeddings = embed_texts(self.theme_lines + self.motif_lines)
+        query_embedding = embed_texts([query])[0]
+        return self._world_embeddings @ query_embedding
+
+
+def get_world_index(world_details: Dict[str, Any], character_profiles: Dict[str, Any]) -> WorldIndex:
+    """Returns the WorldIndex of the world details and character profiles, building it on first use.
+
+    Indexes of the most recently used pairs of dictionaries are kept, so
+    build_prompt called without a world_index compiles them, and encodes the
+    theme and motif fragments, once rather than on every call. Like
+    index.get_index, the cache is keyed by the dictionary objects: after
+    changing one in place, build a new WorldIndex and pass it explicitly.
+    """
+    key = (id(world_details), id(character_profiles))
+    cached = _world_index_cache.get(key)
+    if cached is not None and cached[0] is world_details and cached[1] is character_profiles:
+        _world_index_cache.move_to_end(key)
+        return cached[2]
+
+    world_index = WorldIndex(world_details, character_profiles)
+    _world_index_cache[key] = (world_details, character_profiles, world_index)
+    _world_index_cache.move_to_end(key)
+    while len(_world_index_cache) > _WORLD_INDEX_CACHE_SIZE:
+        _world_index_cache.popitem(last=False)
+    return world_index
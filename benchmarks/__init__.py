@@ -0,0 +1,4 @@
+"""Reproducible offline benchmarks for the story generation pipeline.
+
+Run with `python -m benchmarks.run`. See docs/benchmarks.md.
+"""
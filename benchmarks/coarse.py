@@ -0,0 +1,107 @@
+"""Measure recall and latency of coarse-to-fine search against the flat scan.
+
+Usage:
+    python -m benchmarks.coarse --size 100k --sections 4 8 16 32 64
+
+Builds one index over a synthetic corpus (see benchmarks/corpus.py) and
+searches it with every value of `coarse_sections` (0 is the flat scan).
+The queries are perturbed copies of random chunk embeddings, like a query
+that paraphrases a passage. Recall is the share of the flat scan's top-n
+chunks that the coarse search returns, averaged over the queries.
+"""
+import argparse
+import json
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from rich.console import Console
+from rich.table import Table
+
+from .corpus import make_corpus, parse_size
+from .run import RESULTS_DIRECTORY, environment_info, measure
+
+console = Console()
+
+
+def make_query_embeddings(corpus: Dict[str, Any], num_queries: int, noise: float, seed: int) -> np.ndarray:
+    """Returns random chunk embeddings of the corpus with Gaussian noise of relative size `noise` added."""
+    rng = np.random.default_rng(seed)
+    files = list(corpus.values())
+    queries = []
+    for _ in range(num_queries):
+        embeddings = files[rng.integers(len(files))]['chunk_embeddings']
+        chunk = np.asarray(embeddings[rng.integers(len(embeddings))], dtype=np.float32)
+        scale = noise * np.linalg.norm(chunk) / np.sqrt(len(chunk))
+        queries.append(chunk + rng.standard_normal(len(chunk), dtype=np.float32) * scale)
+    return np.array(queries)
+
+
+def main(argv: Optional[List[str]] = None) -> Dict[str, Any]:
+    from app.index import EmbeddingIndex
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', default='100k', help="Corpus size in chunks (e.g. 1k, 100k, 1m)")
+    parser.add_argument('--dimensions', type=int, default=768)
+    parser.add_argument('--chunks-per-file', type=int, default=100)
+    parser.add_argument('--sections', type=int, nargs='+', default=[4, 8, 16, 32, 64],
+                        help="Values of coarse_sections to measure")
+    parser.add_argument('--section-chunks', type=int, default=0,
+                        help="Most chunks per section (default: one section per file)")
+    parser.add_argument('--precision', choices=('float32', 'float16', 'int8'), default='float32')
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--noise', type=float, default=1.0, help="Query noise relative to the chunk embeddings")
+    parser.add_argument('--top-n', type=int, default=10)
+    parser.add_argument('--iterations', type=int, default=100, help="Maximum timed searches per setting")
+    parser.add_argument('--time-budget', type=float, default=20.0, help="Seconds after which a setting stops repeating")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=Path, help="Result file (default: benchmarks/results/coarse-<timestamp>.json)")
+    args = parser.parse_args(argv)
+
+    num_chunks = parse_size(args.size)
+    corpus = make_corpus(num_chunks, args.dimensions, chunks_per_file=args.chunks_per_file, seed=args.seed)
+    queries = make_query_embeddings(corpus, args.queries, args.noise, args.seed + 1)
+    index = EmbeddingIndex.from_embeddings_dict(corpus, args.precision, section_chunks=args.section_chunks)
+    exact = [{(path, chunk) for path, chunk, _ in index.search(query, args.top_n)} for query in queries]
+
+    results: Dict[str, Any] = {
+        'environment': environment_info(),
+        'parameters': dict(vars(args), output=str(args.output) if args.output else None),
+        'corpus': {'chunks': num_chunks, 'files': len(corpus)},
+        'settings': {},
+    }
+    for coarse_sections in [0] + [m for m in args.sections if m > 0]:
+        index.coarse_sections = coarse_sections
+        found = sum(len({(path, chunk) for path, chunk, _ in index.search(query, args.top_n)} & truth)
+                    for query, truth in zip(queries, exact))
+        stats = measure(lambda i: index.search(queries[i % len(queries)], args.top_n), args.iterations,
+                        args.time_budget)
+        ranges = index._coarse_ranges(index._sections, np.ones(len(index._sections[1]), dtype=bool),
+                                      queries[:1], 0) if coarse_sections else None
+        scanned = sum(end - start for start, end in ranges) if ranges else num_chunks
+        results['settings'][str(coarse_sections)] = dict(
+            stats, recall_at_n=found / sum(len(truth) for truth in exact), scanned_fraction=scanned / num_chunks)
+
+    table = Table(title=f"Coarse-to-fine search, {num_chunks} chunks in {len(corpus)} files, top {args.top_n}",
+                  show_header=True, header_style="bold magenta")
+    table.add_column("coarse_sections", style="cyan")
+    table.add_column("recall@n", justify="right", style="yellow")
+    table.add_column("scanned", justify="right")
+    table.add_column("p50 ms", justify="right", style="green")
+    table.add_column("p95 ms", justify="right", style="green")
+    for coarse_sections, stats in results['settings'].items():
+        table.add_row("flat" if coarse_sections == '0' else coarse_sections, f"{stats['recall_at_n']:.3f}",
+                      f"{stats['scanned_fraction']:.1%}", f"{stats['p50_ms']:.2f}", f"{stats['p95_ms']:.2f}")
+    console.print(table)
+
+    output = args.output or RESULTS_DIRECTORY / f"coarse-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    console.print(f"[green]✓[/green] Results saved to {output}")
+    return results
+
+
+if __name__ == '__main__':
+    main()
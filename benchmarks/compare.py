@@ -0,0 +1,89 @@
+"""Compare two benchmark result files and report regressions.
+
+Usage:
+    python -m benchmarks.compare baseline.json candidate.json --metric p95_ms --threshold 0.1
+
+Exits with status 1 if any stage got slower than the threshold allows.
+"""
+import argparse
+import json
+import sys
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from rich.console import Console
+from rich.table import Table
+
+console = Console()
+
+
+def load_results(path: Path) -> Dict[str, Any]:
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def compare_results(baseline: Dict[str, Any], candidate: Dict[str, Any], metric: str = 'p50_ms',
+                    threshold: float = 0.1) -> List[Tuple[str, str, float, float, float, bool]]:
+    """Compares a metric for every (size, stage) present in both runs.
+
+    Args:
+        baseline: The reference results.
+        candidate: The results to check.
+        metric: The statistic to compare. Latency metrics ('_ms') regress when they grow,
+            throughput and RSS metrics as marked below.
+        threshold: The relative change tolerated before a stage counts as regressed.
+
+    Returns:
+        A list of (size, stage, baseline_value, candidate_value, relative_change, regressed) tuples.
+    """
+    higher_is_better = metric.startswith('throughput') or metric.startswith('items_per_s')
+    rows = []
+    for size, size_results in candidate['results'].items():
+        baseline_stages = baseline['results'].get(size, {}).get('stages', {})
+        for stage, stats in size_results['stages'].items():
+            old = baseline_stages.get(stage, {}).get(metric)
+            new = stats.get(metric)
+            if old is None or new is None or old == 0:
+                continue
+            change = (new - old) / old
+            regressed = change < -threshold if higher_is_better else change > threshold
+            rows.append((size, stage, old, new, change, regressed))
+    return rows
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('baseline', type=Path)
+    parser.add_argument('candidate', type=Path)
+    parser.add_argument('--metric', default='p50_ms',
+                        help="Statistic to compare, e.g. p50_ms, p99_ms, throughput_per_s, peak_rss_mb")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="Tolerated relative change (default: 0.1, i.e. 10%%)")
+    args = parser.parse_args(argv)
+
+    baseline = load_results(args.baseline)
+    candidate = load_results(args.candidate)
+    rows = compare_results(baseline, candidate, args.metric, args.threshold)
+
+    table = Table(title=f"{args.metric}: {args.baseline.name} -> {args.candidate.name}",
+                  show_header=True, header_style="bold magenta")
+    table.add_column("Size", style="cyan")
+    table.add_column("Stage", style="cyan")
+    table.add_column("Baseline", justify="right")
+    table.add_column("Candidate", justify="right")
+    table.add_column("Change", justify="right")
+    for size, stage, old, new, change, regressed in rows:
+        color = "red" if regressed else "green"
+        table.add_row(size, stage, f"{old:.2f}", f"{new:.2f}", f"[{color}]{change:+.1%}[/{color}]")
+    console.print(table)
+
+    regressions = [row for row in rows if row[5]]
+    if regressions:
+        console.print(f"[bold red]{len(regressions)} regression(s) above {args.threshold:.0%}[/bold red]")
+        return 1
+    console.print("[green]✓[/green] No regressions")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
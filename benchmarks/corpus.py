@@ -0,0 +1,148 @@
+import logging
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+
+# Set up a logger for this module.
+logger = logging.getLogger('benchmarks.corpus')
+logger.info("Benchmark corpus module initialized")
+
+# Named corpus sizes, in chunks.
+SIZES = {
+    '1k': 1_000,
+    '100k': 100_000,
+    '1m': 1_000_000,
+}
+
+# Topics of the synthetic corpus. Every file belongs to one topic; its chunk
+# embeddings are noisy copies of the topic centroid and its text favours the
+# topic's words, so retrieval has real structure to find.
+NUM_TOPICS = 64
+
+_SYLLABLES = ["ka", "ri", "mo", "the", "an", "el", "dra", "vin", "sor", "lu",
+              "mer", "tal", "os", "quen", "ith", "bar", "nel", "ys", "gor", "fa"]
+
+
+def parse_size(label: str) -> int:
+    """Converts a size label ('1k', '100k', '1m' or a plain number) to a chunk count."""
+    label = label.lower()
+    if label in SIZES:
+        return SIZES[label]
+    multiplier = {'k': 1_000, 'm': 1_000_000}.get(label[-1:], 1)
+    return int(float(label.rstrip('km')) * multiplier)
+
+
+def make_vocabulary(size: int = 4096, seed: int = 0) -> List[str]:
+    """Generates distinct pronounceable pseudo-words."""
+    rng = np.random.default_rng(seed)
+    words = []
+    seen = set()
+    while len(words) < size:
+        word = "".join(_SYLLABLES[i] for i in rng.integers(0, len(_SYLLABLES), rng.integers(2, 5)))
+        if word not in seen:
+            seen.add(word)
+            words.append(word)
+    return words
+
+
+def _make_chunk_texts(rng: np.random.Generator, vocabulary: List[str], topic_words: np.ndarray,
+                      num_chunks: int, chunk_words: int) -> List[str]:
+    """Generates chunk texts: a mix of topic words and general vocabulary, in sentences of 12 words."""
+    general = rng.integers(0, len(vocabulary), (num_chunks, chunk_words))
+    topical = topic_words[rng.integers(0, len(topic_words), (num_chunks, chunk_words))]
+    picks = np.where(rng.random((num_chunks, chunk_words)) < 0.3, topical, general)
+    texts = []
+    for row in picks:
+        words = [vocabulary[i] for i in row]
+        sentences = [" ".join(words[start:start + 12]).capitalize() + "."
+                     for start in range(0, chunk_words, 12)]
+        texts.append(" ".join(sentences))
+    return texts
+
+
+def make_corpus(num_chunks: int, dimensions: int = 768, chunks_per_file: int = 100,
+                chunk_words: int = 60, seed: int = 0) -> Dict[str, Any]:
+    """Generates a synthetic embeddings dictionary.
+
+    The layout is the one of data/embeddings.json, except that each file's
+    'chunk_embeddings' is a float32 array rather than a list of lists (a
+    million 768-dimensional chunks would not fit in memory as Python floats).
+
+    Args:
+        num_chunks: The total number of chunks.
+        dimensions: The embedding dimensions.
+        chunks_per_file: The number of chunks per file (the last file may have fewer).
+        chunk_words: The number of words per chunk.
+        seed: The random seed; the same arguments always give the same corpus.
+
+    Returns:
+        The embeddings dictionary. Files carry 'type' and 'tags' metadata.
+    """
+    rng = np.random.default_rng(seed)
+    vocabulary = make_vocabulary()
+    centroids = rng.standard_normal((NUM_TOPICS, dimensions), dtype=np.float32)
+    topic_words = rng.integers(0, len(vocabulary), (NUM_TOPICS, 32))
+
+    embeddings_dict = {}
+    for file_id, start in enumerate(range(0, num_chunks, chunks_per_file)):
+        count = min(chunks_per_file, num_chunks - start)
+        topic = file_id % NUM_TOPICS
+        chunk_embeddings = centroids[topic] + rng.standard_normal((count, dimensions), dtype=np.float32)
+        chunks = _make_chunk_texts(rng, vocabulary, topic_words[topic], count, chunk_words)
+        embeddings_dict[f"book{file_id % 8}/file{file_id:06d}.md"] = {
+            'content': "\n\n".join(chunks),
+            'chunk_content': chunks,
+            'chunk_embeddings': chunk_embeddings,
+            'metadata': {
+                'type': 'manuscript' if file_id % 4 else 'notes',
+                'tags': [f"topic{topic}"],
+            },
+        }
+
+    logger.info(f"Generated synthetic corpus: {num_chunks} chunks in {len(embeddings_dict)} files")
+    return embeddings_dict
+
+
+def make_queries(num_queries: int = 20, query_words: int = 8, seed: int = 1) -> List[str]:
+    """Generates queries from the corpus vocabulary."""
+    rng = np.random.default_rng(seed)
+    vocabulary = make_vocabulary()
+    return [" ".join(vocabulary[i] for i in rng.integers(0, len(vocabulary), query_words))
+            for _ in range(num_queries)]
+
+
+def make_world(num_characters: int = 12, num_locations: int = 8,
+               seed: int = 2) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """Generates synthetic world details and character profiles.
+
+    Returns:
+        A (world_details, character_profiles) tuple, in the layout of the data/ files.
+    """
+    rng = np.random.default_rng(seed)
+    vocabulary = make_vocabulary()
+
+    def phrase(words: int) -> str:
+        return " ".join(vocabulary[i] for i in rng.integers(0, len(vocabulary), words))
+
+    world_details = {
+        'themes': {phrase(2).title(): {'subthemes': [phrase(2) for _ in range(3)]} for _ in range(6)},
+        'motifs': {phrase(1).title(): phrase(10) for _ in range(6)},
+        'styles': {'dark fantasy': phrase(40)},
+        'locations': {
+            phrase(1).title(): {
+                'description': phrase(30),
+                'significance': phrase(20),
+                'places': {phrase(1).title(): phrase(15) for _ in range(3)},
+            }
+            for _ in range(num_locations)
+        },
+    }
+    character_profiles = {
+        phrase(1).title(): {
+            'personality': phrase(15),
+            'backstory': phrase(40),
+            'goal': phrase(12),
+        }
+        for _ in range(num_characters)
+    }
+    return world_details, character_profiles
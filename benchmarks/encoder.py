@@ -0,0 +1,109 @@
+"""Compare the PyTorch and ONNX Runtime backends of the sentence encoder.
+
+Usage:
+    python -m benchmarks.encoder --quantize --threads 4
+
+Needs sentence-transformers and onnxruntime; the ONNX model is exported on
+first use (see app/onnx_encoder.py). Every backend encodes the same
+synthetic queries, passages and chapter. The results report latency per
+query, passage throughput, the time to encode a chapter, and the lowest
+cosine similarity of each backend's embeddings to the PyTorch ones.
+"""
+import argparse
+import json
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from rich.console import Console
+from rich.table import Table
+
+from .corpus import make_corpus, make_queries
+from .run import RESULTS_DIRECTORY, environment_info, measure
+
+console = Console()
+
+
+def benchmark_backend(encoder: Any, queries: List[str], passages: List[str], chapter: str,
+                      iterations: int, time_budget: float) -> Dict[str, Any]:
+    """Times one encoder on single queries, passage batches and a whole chapter."""
+    return {
+        'query': measure(lambda i: encoder.encode([queries[i % len(queries)]]), iterations, time_budget),
+        'passages': measure(lambda i: encoder.encode(passages), max(iterations // 10, 1), time_budget,
+                            items_per_call=len(passages)),
+        'chapter': measure(lambda i: encoder.encode([chapter]), max(iterations // 10, 1), time_budget),
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> Dict[str, Any]:
+    from sentence_transformers import SentenceTransformer
+
+    from app.encoder import ENCODER_MODEL
+    from app.onnx_encoder import load_onnx_encoder, min_cosine_similarity
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--model', default=ENCODER_MODEL)
+    parser.add_argument('--passages', type=int, default=64, help="Passages encoded per batch")
+    parser.add_argument('--iterations', type=int, default=100, help="Maximum timed single-query calls")
+    parser.add_argument('--time-budget', type=float, default=20.0, help="Seconds after which a case stops repeating")
+    parser.add_argument('--threads', type=int, help="ONNX Runtime intra-op threads (default: its own choice)")
+    parser.add_argument('--quantize', action='store_true', help="Also benchmark the int8-quantized ONNX model")
+    parser.add_argument('--directory', type=Path, help="Directory of exported ONNX models")
+    parser.add_argument('--output', type=Path, help="Result file (default: benchmarks/results/encoder-<timestamp>.json)")
+    args = parser.parse_args(argv)
+
+    corpus = make_corpus(args.passages, dimensions=8, chunks_per_file=args.passages)
+    passages = next(iter(corpus.values()))['chunk_content']
+    queries = make_queries()
+    chapter = " ".join(passages)
+
+    backends = {'torch': SentenceTransformer(args.model, device='cpu')}
+    onnx_config = {'directory': args.directory, 'threads': args.threads}
+    backends['onnx'] = load_onnx_encoder(args.model, onnx_config)
+    if args.quantize:
+        backends['onnx-int8'] = load_onnx_encoder(args.model, dict(onnx_config, quantize=True))
+
+    reference = backends['torch'].encode(passages + queries)
+    results: Dict[str, Any] = {
+        'environment': environment_info(),
+        'parameters': dict(vars(args), directory=str(args.directory) if args.directory else None,
+                           output=str(args.output) if args.output else None),
+        'backends': {},
+    }
+    for name, encoder in backends.items():
+        console.print(f"[bold blue]Benchmarking {name}...[/bold blue]")
+        started = time.perf_counter()
+        backend_results = benchmark_backend(encoder, queries, passages, chapter, args.iterations, args.time_budget)
+        backend_results['min_cosine_to_torch'] = min_cosine_similarity(reference, encoder.encode(passages + queries))
+        backend_results['elapsed_s'] = time.perf_counter() - started
+        results['backends'][name] = backend_results
+
+    table = Table(title=f"{args.model} on CPU", show_header=True, header_style="bold magenta")
+    table.add_column("Backend", style="cyan")
+    table.add_column("query p50 ms", justify="right", style="green")
+    table.add_column("query p95 ms", justify="right", style="green")
+    table.add_column("passages/s", justify="right")
+    table.add_column("chapter ms", justify="right")
+    table.add_column("min cosine", justify="right", style="yellow")
+    for name, backend_results in results['backends'].items():
+        table.add_row(
+            name,
+            f"{backend_results['query']['p50_ms']:.2f}",
+            f"{backend_results['query']['p95_ms']:.2f}",
+            f"{backend_results['passages']['items_per_s']:.1f}",
+            f"{backend_results['chapter']['p50_ms']:.1f}",
+            f"{backend_results['min_cosine_to_torch']:.5f}",
+        )
+    console.print(table)
+
+    output = args.output or RESULTS_DIRECTORY / f"encoder-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    console.print(f"[green]✓[/green] Results saved to {output}")
+    return results
+
+
+if __name__ == '__main__':
+    main()
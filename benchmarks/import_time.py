@@ -0,0 +1,118 @@
+"""Measure how long importing the application takes, and check that heavy dependencies load lazily.
+
+Usage:
+    python -m benchmarks.import_time --budget 0.5
+
+Imports the module (app.main by default) in fresh interpreters with
+`python -X importtime`, reports the slowest imports and exits with status 1
+if the best import time exceeds the budget or if any heavy dependency
+(torch, sentence_transformers, ...) was imported at startup.
+"""
+import argparse
+import json
+import re
+import subprocess
+import sys
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from rich.console import Console
+from rich.table import Table
+
+console = Console()
+
+PROJECT_ROOT = Path(__file__).parent.parent
+
+# Dependencies that must only be imported when their feature is first used.
+HEAVY_MODULES = (
+    'torch',
+    'transformers',
+    'sentence_transformers',
+    'sklearn',
+    'rouge',
+    'google.generativeai',
+    'google.api_core',
+    'markdown',
+    'requests',
+)
+
+_IMPORTTIME_PATTERN = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)\s*$")
+
+
+def parse_importtime(stderr: str) -> List[Tuple[str, int, int, int]]:
+    """Parses `-X importtime` output into (module, self_us, cumulative_us, depth) tuples."""
+    entries = []
+    for line in stderr.splitlines():
+        match = _IMPORTTIME_PATTERN.match(line)
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            entries.append((module, int(self_us), int(cumulative_us), (len(indent) - 1) // 2))
+    return entries
+
+
+def measure_import(module: str) -> Tuple[List[Tuple[str, int, int, int]], List[str]]:
+    """Imports a module in a fresh interpreter.
+
+    Returns:
+        The parsed import times and the names of all modules loaded afterwards.
+    """
+    code = f"import json, sys, {module}; print(json.dumps(sorted(sys.modules)))"
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=PROJECT_ROOT,
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+    return parse_importtime(result.stderr), json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--module', default='app.main', help="Module to import (default: app.main)")
+    parser.add_argument('--runs', type=int, default=5, help="Fresh interpreters to start; the fastest counts")
+    parser.add_argument('--budget', type=float, default=0.5, help="Maximum import time in seconds")
+    parser.add_argument('--top', type=int, default=15, help="Number of slowest imports to list")
+    parser.add_argument('--output', type=Path, help="Also write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    runs = [measure_import(args.module) for _ in range(args.runs)]
+    totals = [next((cumulative for name, _, cumulative, _ in entries if name == args.module), 0)
+              for entries, _ in runs]
+    best = min(range(len(runs)), key=lambda i: totals[i])
+    entries, loaded = runs[best]
+    total_s = totals[best] / 1e6
+    heavy = sorted(name for name in loaded if name.split('.')[0] in HEAVY_MODULES or name in HEAVY_MODULES)
+
+    table = Table(title=f"Slowest imports of {args.module}", show_header=True, header_style="bold magenta")
+    table.add_column("Module", style="cyan")
+    table.add_column("Self (ms)", justify="right")
+    table.add_column("Cumulative (ms)", justify="right", style="green")
+    for name, self_us, cumulative_us, _ in sorted(entries, key=lambda entry: entry[1], reverse=True)[:args.top]:
+        table.add_row(name, f"{self_us / 1000:.1f}", f"{cumulative_us / 1000:.1f}")
+    console.print(table)
+
+    results: Dict[str, Any] = {
+        'module': args.module,
+        'runs_s': [total / 1e6 for total in totals],
+        'best_s': total_s,
+        'budget_s': args.budget,
+        'heavy_modules_loaded': heavy,
+        'python': sys.version.split()[0],
+    }
+    if args.output:
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+    failed = False
+    if total_s > args.budget:
+        console.print(f"[bold red]Importing {args.module} took {total_s:.3f} s, over the {args.budget:.3f} s budget[/bold red]")
+        failed = True
+    else:
+        console.print(f"[green]✓[/green] Importing {args.module} took {total_s:.3f} s (budget {args.budget:.3f} s)")
+    if heavy:
+        console.print(f"[bold red]Heavy dependencies imported at startup: {', '.join(heavy)}[/bold red]")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
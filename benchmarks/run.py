@@ -0,0 +1,350 @@
+"""Benchmark the retrieval, context, prompt and evaluation stages on synthetic corpora.
+
+Usage:
+    python -m benchmarks.run --sizes 1k 100k 1m --output results.json
+
+Everything runs offline: the sentence encoder is replaced by a hashing
+encoder and the generative model by a deterministic stub (see app/stubs.py).
+Each corpus size is measured in a fresh process, so the peak RSS of one
+size does not leak into the next.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from multiprocessing import get_context
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+import yaml
+from rich.console import Console
+from rich.table import Table
+
+from .corpus import make_corpus, make_queries, make_world, parse_size
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Set up a logger for this module.
+logger = logging.getLogger('benchmarks.run')
+
+console = Console()
+
+RESULTS_DIRECTORY = Path(__file__).parent / 'results'
+
+STAGES = [
+    'index_build',
+    'semantic_search',
+    'semantic_search_filtered',
+    'prepare_context',
+    'create_prompt',
+    'evaluate_story',
+    'generate_chapter',
+]
+
+PERCENTILES = [50, 90, 95, 99]
+
+
+def current_rss_mb() -> Optional[float]:
+    """Returns the resident set size of this process in MiB (Linux only)."""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def peak_rss_mb() -> Optional[float]:
+    """Returns the peak resident set size of this process in MiB."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 1024
+
+
+def summarize(samples: List[float], items_per_call: Optional[int] = None) -> Dict[str, Any]:
+    """Computes latency percentiles and throughput from per-call durations in seconds."""
+    latencies = np.array(samples) * 1000
+    total = float(np.sum(samples))
+    stats = {
+        'samples': len(samples),
+        'mean_ms': float(latencies.mean()),
+        'min_ms': float(latencies.min()),
+        'max_ms': float(latencies.max()),
+    }
+    for percentile, value in zip(PERCENTILES, np.percentile(latencies, PERCENTILES)):
+        stats[f'p{percentile}_ms'] = float(value)
+    stats['throughput_per_s'] = len(samples) / total if total > 0 else None
+    if items_per_call is not None:
+        stats['items_per_call'] = items_per_call
+        stats['items_per_s'] = items_per_call * len(samples) / total if total > 0 else None
+    return stats
+
+
+def measure(fn: Callable[[int], Any], iterations: int, time_budget: float, warmup: int = 1,
+            items_per_call: Optional[int] = None) -> Dict[str, Any]:
+    """Times repeated calls of fn(i).
+
+    Args:
+        fn: The operation; it receives the iteration number (used to cycle through queries).
+        iterations: The maximum number of timed calls.
+        time_budget: Seconds after which no further calls are started (at least one call is timed).
+        warmup: Untimed calls made first.
+        items_per_call: The number of items (e.g. chunks) one call processes, to report items/s.
+
+    Returns:
+        The latency and throughput statistics, plus the peak RSS after the stage.
+    """
+    for i in range(warmup):
+        fn(i)
+    peak_before = peak_rss_mb()
+    samples = []
+    started = time.perf_counter()
+    for i in range(iterations):
+        call_started = time.perf_counter()
+        fn(i)
+        samples.append(time.perf_counter() - call_started)
+        if time.perf_counter() - started > time_budget:
+            break
+    stats = summarize(samples, items_per_call)
+    stats['peak_rss_mb'] = peak_rss_mb()
+    if peak_before is not None:
+        stats['peak_rss_growth_mb'] = stats['peak_rss_mb'] - peak_before
+    return stats
+
+
+def index_report(index: Any, corpus: Dict[str, Any], query_embeddings: List[np.ndarray],
+                 top_n: int) -> Dict[str, Any]:
+    """Reports the memory of the index and, if it is quantized or projected, its recall against exact search."""
+    from app.index import EmbeddingIndex
+
+    info = {
+        'precision': index.precision,
+        'projection_dimensions': len(index.projection[0]) if index.projection is not None else None,
+        'memory_mb': index.memory_bytes() / 2**20,
+        'float32_memory_mb': len(index) * index.full_precision.shape[1] * 4 / 2**20 if len(index) else 0.0,
+        'recall_at_n': 1.0,
+    }
+    if index.approximate:
+        exact = EmbeddingIndex.from_embeddings_dict(corpus)
+        found = expected = 0
+        for query_embedding in query_embeddings:
+            approximate = {(path, chunk) for path, chunk, _ in index.search(query_embedding, top_n)}
+            truth = {(path, chunk) for path, chunk, _ in exact.search(query_embedding, top_n)}
+            found += len(approximate & truth)
+            expected += len(truth)
+        info['recall_at_n'] = found / expected if expected else 1.0
+        del exact
+    return info
+
+
+def run_size(size: str, dimensions: int, iterations: int, time_budget: float, top_n: int,
+             seed: int, config: Dict[str, Any], stages: List[str]) -> Dict[str, Any]:
+    """Generates one corpus and benchmarks every stage on it."""
+    from app.context import prepare_context, prepare_context_chunks
+    from app.encoder import get_encoder, set_encoder
+    from app.index import EmbeddingIndex, get_index
+    from app.prompt import create_prompt
+    from app.semantic_search import semantic_search
+    from app.stubs import HashingEncoder, StubGenerativeModel
+    from app.utils import StoryGenerator, evaluate_story
+
+    set_encoder(HashingEncoder(dimensions))
+    model = StubGenerativeModel()
+
+    num_chunks = parse_size(size)
+    rss_before = current_rss_mb()
+    started = time.perf_counter()
+    corpus = make_corpus(num_chunks, dimensions, seed=seed)
+    corpus_info = {
+        'chunks': num_chunks,
+        'files': len(corpus),
+        'dimensions': dimensions,
+        'generation_s': time.perf_counter() - started,
+        'rss_mb': current_rss_mb(),
+    }
+    if rss_before is not None and corpus_info['rss_mb'] is not None:
+        corpus_info['corpus_rss_mb'] = corpus_info['rss_mb'] - rss_before
+
+    queries = make_queries(seed=seed + 1)
+    world_details, character_profiles = make_world(seed=seed + 2)
+    characters = list(character_profiles)
+    locations = list(world_details['locations'])
+    situations = [f"{characters[i % len(characters)]} arrives in {locations[i % len(locations)]}"
+                  for i in range(len(queries))]
+    generator = StoryGenerator(model, character_profiles, world_details, config)
+    filters = {'type': 'manuscript'}
+
+    # Inputs of the later stages, computed once from the earlier ones
+    relevant = [semantic_search(model, query, corpus, top_n) for query in queries]
+    contexts = [prepare_context_chunks(corpus, chunks, query) for chunks, query in zip(relevant, queries)]
+    prompts = [create_prompt("dark fantasy", characters[0], situation, context, character_profiles, world_details)
+               for situation, context in zip(situations, contexts)]
+    texts = [model.generate_content(prompt).text for prompt in prompts]
+
+    def pick(items: List[Any], i: int) -> Any:
+        return items[i % len(items)]
+
+    operations = {
+        'semantic_search': lambda i: semantic_search(model, pick(queries, i), corpus, top_n),
+        'semantic_search_filtered': lambda i: semantic_search(model, pick(queries, i), corpus, top_n, filters),
+        'prepare_context': lambda i: prepare_context(corpus, pick(relevant, i), pick(queries, i)),
+        'create_prompt': lambda i: create_prompt("dark fantasy", characters[0], pick(situations, i),
+                                                 pick(contexts, i), character_profiles, world_details),
+        'evaluate_story': lambda i: evaluate_story(pick(texts, i), corpus, top_n, 0.4),
+        'generate_chapter': lambda i: generator.generate_chapter([pick(queries, i)], corpus,
+                                                                 character=characters[0],
+                                                                 situation=pick(situations, i), top_n=top_n),
+    }
+    index = get_index(corpus)
+    index_info = index_report(index, corpus, [get_encoder().encode([query])[0] for query in queries], top_n)
+    filtered_rows = sum(end - start for start, end in index.row_ranges(filters))
+    items = {'semantic_search': num_chunks, 'semantic_search_filtered': filtered_rows,
+             'evaluate_story': num_chunks}
+
+    results = {}
+    for stage in stages:
+        if stage == 'index_build':
+            # The cached index was built by the first search; time a cold build
+            results[stage] = measure(lambda i: EmbeddingIndex.from_embeddings_dict(
+                                         corpus, index.precision, index.rescore_factor,
+                                         projection_dimensions=index.projection_dimensions),
+                                     1, time_budget, warmup=0, items_per_call=num_chunks)
+        else:
+            results[stage] = measure(operations[stage], iterations, time_budget,
+                                     items_per_call=items.get(stage))
+        logger.info(f"{size} {stage}: p50 {results[stage]['p50_ms']:.2f} ms")
+
+    return {'corpus': corpus_info, 'index': index_info, 'stages': results}
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              check=True, cwd=Path(__file__).parent).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment_info() -> Dict[str, Any]:
+    """Describes the machine and code a run was made on."""
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'git_commit': _git_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def print_results(results: Dict[str, Any]) -> None:
+    """Prints one table per corpus size."""
+    for size, size_results in results['results'].items():
+        corpus = size_results['corpus']
+        table = Table(title=f"{size}: {corpus['chunks']} chunks x {corpus['dimensions']} dims",
+                      show_header=True, header_style="bold magenta")
+        table.add_column("Stage", style="cyan", no_wrap=True)
+        table.add_column("n", justify="right")
+        for percentile in PERCENTILES:
+            table.add_column(f"p{percentile} ms", justify="right", style="green")
+        table.add_column("ops/s", justify="right")
+        table.add_column("peak RSS MiB", justify="right", style="yellow")
+        for stage, stats in size_results['stages'].items():
+            table.add_row(
+                stage, str(stats['samples']),
+                *(f"{stats[f'p{percentile}_ms']:.2f}" for percentile in PERCENTILES),
+                f"{stats['throughput_per_s']:.1f}" if stats['throughput_per_s'] else "-",
+                f"{stats['peak_rss_mb']:.0f}" if stats['peak_rss_mb'] is not None else "-",
+            )
+        console.print(table)
+        index = size_results.get('index')
+        if index:
+            projection = f", {index['projection_dimensions']} dims" if index.get('projection_dimensions') else ""
+            console.print(f"{index['precision']}{projection} index: {index['memory_mb']:.1f} MiB "
+                          f"(float32: {index['float32_memory_mb']:.1f} MiB), "
+                          f"recall@top_n {index['recall_at_n']:.3f}")
+
+
+def main(argv: Optional[List[str]] = None) -> Dict[str, Any]:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', nargs='+', default=['1k', '100k'],
+                        help="Corpus sizes in chunks, e.g. 1k 100k 1m (default: 1k 100k)")
+    parser.add_argument('--dimensions', type=int, default=768)
+    parser.add_argument('--iterations', type=int, default=50, help="Maximum timed calls per stage")
+    parser.add_argument('--time-budget', type=float, default=20.0,
+                        help="Seconds after which a stage stops repeating")
+    parser.add_argument('--top-n', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES)
+    parser.add_argument('--config', type=Path,
+                        help="YAML config whose retrieval/context/prompt settings StoryGenerator uses "
+                             "(default: none, i.e. dense retrieval without compression)")
+    parser.add_argument('--precision', choices=('float32', 'float16', 'int8'),
+                        help="Storage precision of the index (overrides retrieval.index.precision of --config)")
+    parser.add_argument('--projection', type=int, metavar='DIMENSIONS',
+                        help="Scan PCA-projected rows of this many dimensions "
+                             "(overrides retrieval.index.projection_dimensions of --config)")
+    parser.add_argument('--output', type=Path, help="Result file (default: benchmarks/results/<timestamp>.json)")
+    parser.add_argument('--in-process', action='store_true',
+                        help="Run all sizes in this process instead of one fresh process per size")
+    args = parser.parse_args(argv)
+
+    config = {}
+    if args.config:
+        with open(args.config, 'r') as f:
+            config = yaml.safe_load(f) or {}
+    if args.precision:
+        config.setdefault('retrieval', {}).setdefault('index', {})['precision'] = args.precision
+    if args.projection is not None:
+        config.setdefault('retrieval', {}).setdefault('index', {})['projection_dimensions'] = args.projection
+
+    results = {
+        'environment': environment_info(),
+        'parameters': {
+            'sizes': args.sizes,
+            'dimensions': args.dimensions,
+            'iterations': args.iterations,
+            'time_budget': args.time_budget,
+            'top_n': args.top_n,
+            'seed': args.seed,
+            'stages': args.stages,
+            'config': config,
+        },
+        'results': {},
+    }
+
+    for size in args.sizes:
+        console.print(f"[bold blue]Benchmarking {size} chunks...[/bold blue]")
+        run_args = (size, args.dimensions, args.iterations, args.time_budget, args.top_n,
+                    args.seed, config, args.stages)
+        if args.in_process:
+            results['results'][size] = run_size(*run_args)
+        else:
+            with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+                results['results'][size] = executor.submit(run_size, *run_args).result()
+
+    output = args.output or RESULTS_DIRECTORY / f"{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+
+    print_results(results)
+    console.print(f"[green]✓[/green] Results saved to {output}")
+    return results
+
+
+if __name__ == '__main__':
+    main()
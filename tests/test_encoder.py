@@ -0,0 +1,40 @@
+import threading
+
+from app import encoder
+from app.encoder import BatchingEncoder
+from app.stubs import HashingEncoder
+
+
+def test_closed_batching_encoder_still_encodes():
+    batching = BatchingEncoder(HashingEncoder(dimensions=16))
+    assert batching.encode(['first']).shape == (1, 16)
+    batching.close()
+    batching.close()
+
+    # Answered by the wrapped encoder instead of waiting on the stopped thread
+    result = []
+    caller = threading.Thread(target=lambda: result.append(batching.encode(['after close'])), daemon=True)
+    caller.start()
+    caller.join(timeout=5)
+    assert result and result[0].shape == (1, 16)
+    assert batching.batches == 1
+
+
+def test_reconfiguring_closes_the_replaced_wrapper(monkeypatch):
+    monkeypatch.setattr(encoder, '_encoder_options', dict(encoder._encoder_options))
+    monkeypatch.setattr(encoder, '_encoder', None)
+    monkeypatch.setattr(encoder, '_loaded_model', False)
+
+    encoder.configure_encoder({'batching': True})
+    encoder.set_encoder(HashingEncoder(dimensions=16))
+    first = encoder.get_encoder()
+    first.encode(['start the thread'])
+
+    encoder.configure_encoder({'batching': True, 'max_batch': 8})
+    second = encoder.get_encoder()
+    assert second is not first and second.encoder is first.encoder
+    assert not first._thread.is_alive()
+
+    second.encode(['start the thread'])
+    encoder.set_encoder(None)
+    assert not second._thread.is_alive()
@@ -0,0 +1,15 @@
+import numpy as np
+
+from app.index import get_index
+
+
+def test_add_to_empty_index():
+    rng = np.random.default_rng(0)
+    for embeddings_dict in ({}, {'empty.md': {'chunk_embeddings': [], 'metadata': {}}}):
+        index = get_index(embeddings_dict)
+        first = rng.random((3, 64))
+        index.add('a.md', first)
+        index.add('b.md', rng.random((2, 64)))
+
+        assert len(index) == 5
+        assert index.search(first[1], 1)[0][:2] == ('a.md', 1)
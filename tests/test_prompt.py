@@ -0,0 +1,37 @@
+from app.context import format_context
+from app.prompt import build_prompt
+
+
+def test_context_chunk_with_horizontal_rule_stays_one_part():
+    chunks = [
+        {'file_path': 'notes/intro.md', 'chunk_indices': [0], 'similarity': 0.9,
+         'text': "The gate opens.\n---\nBeyond the rule, the crypt."},
+        {'file_path': 'notes/other.md', 'chunk_indices': [2], 'similarity': 0.3, 'text': "Low " * 10},
+    ]
+
+    prompt, report = build_prompt('dark fantasy', '', '', chunks, {}, {})
+    assert prompt == build_prompt('dark fantasy', '', '', format_context(chunks), {}, {})[0]
+    context = next(entry for entry in report if entry['section'] == 'context')
+    assert context['items'] == 2
+
+    # With room for one part, the more relevant chunk is kept whole
+    prompt, report = build_prompt('dark fantasy', '', '', chunks, {}, {}, token_budget=80)
+    context = next(entry for entry in report if entry['section'] == 'context')
+    assert (context['items'], context['dropped_items']) == (1, 1)
+    assert "The gate opens.\n---\nBeyond the rule, the crypt." in prompt
+    assert "Low" not in prompt
+
+
+def test_plot_outline_counts_against_the_budget():
+    chunks = [{'file_path': 'notes/intro.md', 'chunk_indices': [0], 'similarity': 0.9,
+               'text': "Context text " * 20}]
+    outline = "The knight reaches the gate. " * 5
+
+    prompt, report = build_prompt('dark fantasy', '', '', chunks, {}, {}, plot_outline=outline)
+    assert prompt.startswith(f"Plot Outline:\n{outline}\n")
+    assert report[0]['section'] == 'plot_outline' and report[0]['tokens'] > 0
+
+    budget = sum(entry['tokens'] for entry in build_prompt('dark fantasy', '', '', chunks, {}, {})[1])
+    _, report = build_prompt('dark fantasy', '', '', chunks, {}, {}, token_budget=budget, plot_outline=outline)
+    assert sum(entry['tokens'] for entry in report) <= budget
+    assert next(entry for entry in report if entry['section'] == 'context')['items'] == 0
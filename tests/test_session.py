@@ -0,0 +1,59 @@
+import pytest
+
+from app import session
+from app.session import configure_sessions, new_session, resume_session
+
+
+@pytest.fixture
+def session_directory(tmp_path, monkeypatch):
+    # configure_sessions() changes module state; give each test its own copy
+    monkeypatch.setattr(session, '_session_options', dict(session._session_options))
+    configure_sessions({'directory': tmp_path, 'fsync': 'never'})
+    return tmp_path
+
+
+def test_settings_changed_in_place_survive_resume(session_directory):
+    settings = {'style': 'dark fantasy', 'situation': 'At the gate'}
+    journal = new_session('in-place')
+    journal.update_state(settings=settings, chapter_counter=0)
+
+    # interactive.py changes its settings dict in place before recording it again
+    settings['situation'] = 'In the crypt'
+    journal.update_state(settings=settings, chapter_counter=1)
+    # No close(): the session is resumed as after a crash, from the journal alone
+
+    resumed = resume_session('in-place')
+    assert resumed.settings == {'style': 'dark fantasy', 'situation': 'In the crypt'}
+    assert resumed.chapter_counter == 1
+
+    # The resumed state is not shared with a dict changed in place either
+    current_settings = resumed.settings
+    current_settings['situation'] = 'On the bridge'
+    resumed.update_state(settings=current_settings)
+    resumed.close()
+    assert resume_session('in-place').settings['situation'] == 'On the bridge'
+
+
+def test_unreadable_record_does_not_drop_later_ones(session_directory):
+    journal = new_session('corrupt')
+    journal.append('generation', content='Chapter one')
+    journal.append('generation', content='Chapter two')
+    journal.update_state(chapter_counter=2)
+    journal._file.close()
+
+    # Damage the middle record and tear off the end of a record appended last
+    journal_path = session_directory / 'corrupt' / 'journal.jsonl'
+    lines = journal_path.read_bytes().splitlines(keepends=True)
+    lines[1] = b'{"seq": 2, "type": "gener\xff\n'
+    journal_path.write_bytes(b''.join(lines) + b'{"seq": 4, "type": "gen')
+
+    resumed = resume_session('corrupt')
+    assert [entry['content'] for entry in resumed.history] == ['Chapter one']
+    assert resumed.chapter_counter == 2
+    resumed.append('generation', content='Chapter three')
+    resumed.close()
+    assert journal_path.read_bytes().startswith(b''.join(lines))
+
+    reopened = resume_session('corrupt')
+    assert [entry['content'] for entry in reopened.history] == ['Chapter one', 'Chapter three']
+    reopened.close()
@@ -0,0 +1,18 @@
+import io
+import random
+
+from app.text_processing import iter_chunks
+
+
+def test_chunks_do_not_depend_on_the_read_size():
+    rng = random.Random(0)
+    words = ['alpha', 'beta', 'gamma.', 'delta!', 'eps\n\n', 'zeta,', '"quote."', 'x' * 60, 'end?)',
+             '\r\n\r\n', 'tab\t', 'Übergrößenträger.']
+    text = ' '.join(rng.choice(words) for _ in range(5000))
+
+    for unit, chunk_size, overlap in (('chars', 50, 0), ('chars', 500, 100), ('tokens', 12, 0), ('tokens', 40, 8)):
+        expected = list(iter_chunks(io.StringIO(text), chunk_size, overlap, unit))
+        for read_size in (1, 7, 64, 1000):
+            chunks = list(iter_chunks(io.StringIO(text), chunk_size, overlap, unit, read_size=read_size))
+            assert chunks == expected, (unit, chunk_size, overlap, read_size)
+        assert all(text[start:end] == chunk for start, end, chunk in expected)